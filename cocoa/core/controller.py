@@ -2,6 +2,7 @@ from __future__ import print_function
 
 import json
 import random
+import time
 
 from util import generate_uuid
 from dataset import Example
@@ -98,6 +99,8 @@ class Controller(object):
         Called by the web backend.
         '''
         with self.lock:
+            # Events are logged to the database in one batch
+            new_events = []
             # try to send messages from one session to the other(s)
             for agent, session in enumerate(self.sessions):
                 if session is None:
@@ -114,8 +117,7 @@ class Controller(object):
                     self.session_status[agent] = 'sent'
                 self.event_callback(event)
                 self.events.append(event)
-                if backend is not None:
-                    backend.add_event_to_db(self.get_chat_id(), event)
+                new_events.append(event)
 
                 for partner, other_session in enumerate(self.sessions):
                     if agent != partner:
@@ -123,6 +125,30 @@ class Controller(object):
                         if not event.action in Event.decorative_events:
                             self.session_status[partner] = 'received'
 
+            if backend is not None and new_events:
+                backend.add_events_to_db(self.get_chat_id(), new_events)
+
+    def next_step_time(self):
+        """
+        Earliest time at which step() may produce an event from a timed session (e.g. a bot wrapped in
+        TimedSessionWrapper), or None if no such session has anything pending. Sessions without next_ready_time
+        (e.g. bots that are not wrapped in debug mode) may produce an event at any time.
+        """
+        if self.inactive() or self.game_over():
+            return None
+        times = []
+        for agent, session in enumerate(self.sessions):
+            if (not self.allow_cross_talk) and self.session_status[agent] != 'received':
+                continue
+            next_ready_time = getattr(session, 'next_ready_time', None)
+            if next_ready_time is None:
+                times.append(time.time())
+                continue
+            t = next_ready_time()
+            if t is not None:
+                times.append(t)
+        return min(times) if times else None
+
     def inactive(self):
         """
         Return whether this controller is currently controlling an active chat session or not (by checking whether both
@@ -2,7 +2,7 @@
 Data structures for events, examples, and datasets.
 '''
 
-from util import read_json
+from util import read_json, write_json, is_jsonl, iter_jsonl, write_jsonl
 from event import Event
 from kb import KB
 
@@ -107,18 +107,38 @@ class EvalExample(object):
 
 ############################################################
 
-def read_examples(paths, max_examples, Scenario):
+def iter_examples(paths, max_examples, Scenario):
     '''
-    Read a maximum of |max_examples| examples from |paths|.
+    Lazily yield a maximum of |max_examples| examples from |paths|.
+    JSON lines files (.jsonl) are streamed one example at a time; other
+    files are read as a single JSON list.
     '''
-    examples = []
+    num_examples = 0
     for path in paths:
         print 'read_examples: %s' % path
-        for raw in read_json(path):
-            if max_examples >= 0 and len(examples) >= max_examples:
-                break
-            examples.append(Example.from_dict(raw, Scenario))
-    return examples
+        raws = iter_jsonl(path) if is_jsonl(path) else read_json(path)
+        for raw in raws:
+            if max_examples >= 0 and num_examples >= max_examples:
+                return
+            yield Example.from_dict(raw, Scenario)
+            num_examples += 1
+
+def read_examples(paths, max_examples, Scenario):
+    '''
+    Read a maximum of |max_examples| examples from |paths|.
+    '''
+    return list(iter_examples(paths, max_examples, Scenario))
+
+def write_examples(examples, path):
+    '''
+    Write |examples| (any iterable) to |path|, one example per line if
+    |path| is a JSON lines file (.jsonl).
+    '''
+    raws = (ex.to_dict() for ex in examples)
+    if is_jsonl(path):
+        write_jsonl(raws, path)
+    else:
+        write_json(list(raws), path)
 
 def read_dataset(args, Scenario):
     '''
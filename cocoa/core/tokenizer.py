@@ -1,15 +1,231 @@
-import nltk
-nltk.download('punkt')
-from nltk.tokenize import word_tokenize
-from nltk.tokenize.moses import MosesDetokenizer
+'''
+Tokenization of utterances.
 
-detokenizer = MosesDetokenizer()
+Nothing is loaded at import time. The backend is chosen on first use:
+    - 'nltk': nltk's word_tokenize (punkt) and MosesDetokenizer, used if nltk
+      and its resources are found locally (see `configure`);
+    - 'regex': a dependency-free port of the Treebank rules used by
+      word_tokenize, with a regex sentence splitter instead of punkt.
+Resources are never downloaded implicitly; run `download_resources` once on a
+machine with network access. Set COCOA_TOKENIZER=nltk|regex to force a backend
+and NLTK_DATA to the local resource directory.
+
+Results are cached (LRU) since the same utterances (templates, bot responses)
+are tokenized over and over.
+'''
+
+import os
+import re
+import warnings
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        try:
+            value = self.cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            value = compute(key)
+            self.misses += 1
+            if len(self.cache) >= self.maxsize:
+                self.cache.popitem(last=False)
+        self.cache[key] = value
+        return value
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = self.misses = 0
+
+
+############# Regex backend #############
+
+class RegexTokenizer(object):
+    '''
+    Treebank word tokenizer (as used by nltk.word_tokenize) applied to sentences
+    split on [.!?] followed by whitespace.
+    '''
+    SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+    STARTING_QUOTES = [
+        (re.compile(r'^\"'), r'``'),
+        (re.compile(r'(``)'), r' \1 '),
+        (re.compile(r'([ (\[{<])"'), r'\1 `` '),
+    ]
+    PUNCTUATION = [
+        (re.compile(r'([:,])([^\d])'), r' \1 \2'),
+        (re.compile(r'([:,])$'), r' \1 '),
+        (re.compile(r'\.\.\.'), r' ... '),
+        (re.compile(r'[;@#$%&]'), r' \g<0> '),
+        (re.compile(r'([^\.])(\.)([\]\)}>"\']*)\s*$'), r'\1 \2\3 '),
+        (re.compile(r'[?!]'), r' \g<0> '),
+        (re.compile(r"([^'])' "), r"\1 ' "),
+    ]
+    PARENS_BRACKETS = (re.compile(r'[\]\[\(\)\{\}\<\>]'), r' \g<0> ')
+    DOUBLE_DASHES = (re.compile(r'--'), r' -- ')
+    ENDING_QUOTES = [
+        (re.compile(r'"'), " '' "),
+        (re.compile(r'(\S)(\'\')'), r'\1 \2 '),
+        (re.compile(r"([^' ])('[sS]|'[mM]|'[dD]|') "), r"\1 \2 "),
+        (re.compile(r"([^' ])('ll|'LL|'re|'RE|'ve|'VE|n't|N'T) "), r"\1 \2 "),
+    ]
+    CONTRACTIONS = [re.compile(pattern) for pattern in (
+        r"(?i)\b(can)(not)\b",
+        r"(?i)\b(d)('ye)\b",
+        r"(?i)\b(gim)(me)\b",
+        r"(?i)\b(gon)(na)\b",
+        r"(?i)\b(got)(ta)\b",
+        r"(?i)\b(lem)(me)\b",
+        r"(?i)\b(mor)('n)\b",
+        r"(?i)\b(wan)(na) ",
+        r"(?i) ('t)(is)\b",
+        r"(?i) ('t)(was)\b",
+        )]
+
+    def tokenize_sentence(self, text):
+        for regexp, substitution in self.STARTING_QUOTES:
+            text = regexp.sub(substitution, text)
+        for regexp, substitution in self.PUNCTUATION:
+            text = regexp.sub(substitution, text)
+        regexp, substitution = self.PARENS_BRACKETS
+        text = regexp.sub(substitution, text)
+        regexp, substitution = self.DOUBLE_DASHES
+        text = regexp.sub(substitution, text)
+        text = ' ' + text + ' '
+        for regexp, substitution in self.ENDING_QUOTES:
+            text = regexp.sub(substitution, text)
+        for regexp in self.CONTRACTIONS:
+            text = regexp.sub(r' \1 \2 ', text)
+        return text.split()
+
+    def tokenize(self, text):
+        return [token for sent in self.SENTENCE_END.split(text.strip()) for token in self.tokenize_sentence(sent)]
+
+
+class RegexDetokenizer(object):
+    '''
+    Join tokens with spaces, attaching punctuation, closing brackets and
+    clitics to the previous token and opening brackets/currency to the next.
+    '''
+    ATTACH_LEFT = re.compile(r"^([.,!?;:%)\]}]+|\.\.\.|'[a-zA-Z]+|n't|'|'')$")
+    ATTACH_RIGHT = re.compile(r'^([(\[{$#]|``)$')
+
+    def detokenize(self, tokens):
+        text = []
+        attach = True
+        for token in tokens:
+            if not attach and not self.ATTACH_LEFT.match(token):
+                text.append(' ')
+            attach = bool(self.ATTACH_RIGHT.match(token))
+            if token in ('``', "''"):
+                token = '"'
+            text.append(token)
+        return ''.join(text)
+
+
+############# Backend resolution #############
+
+_config = {
+        'backend': os.environ.get('COCOA_TOKENIZER', 'auto'),
+        'resource_path': os.environ.get('NLTK_DATA'),
+        }
+_word_tokenize = None
+_detokenize = None
+_tokenize_cache = LRUCache()
+_detokenize_cache = LRUCache()
+
+def configure(backend=None, resource_path=None, cache_size=None):
+    '''
+    Args:
+        backend (str): 'auto', 'nltk' or 'regex'.
+        resource_path (str): local directory containing nltk data.
+        cache_size (int): number of utterances kept in each LRU cache.
+    '''
+    global _word_tokenize, _detokenize
+    if backend is not None:
+        _config['backend'] = backend
+    if resource_path is not None:
+        _config['resource_path'] = resource_path
+    if cache_size is not None:
+        _tokenize_cache.maxsize = _detokenize_cache.maxsize = cache_size
+    _word_tokenize = _detokenize = None
+    _tokenize_cache.clear()
+    _detokenize_cache.clear()
+
+def _find_nltk_resource(name):
+    '''
+    Return True if the nltk resource `name` is available locally.
+    '''
+    try:
+        import nltk
+    except ImportError:
+        return False
+    path = _config['resource_path']
+    if path and path not in nltk.data.path:
+        nltk.data.path.insert(0, path)
+    try:
+        nltk.data.find(name)
+        return True
+    except LookupError:
+        return False
+
+def _use_nltk(resource):
+    backend = _config['backend']
+    if backend == 'regex':
+        return False
+    found = _find_nltk_resource(resource)
+    if backend == 'nltk' and not found:
+        raise LookupError('nltk resource {} not found; run cocoa.core.tokenizer.download_resources()'.format(resource))
+    if not found:
+        warnings.warn('nltk resource {} not found; using the regex tokenizer'.format(resource))
+    return found
+
+def get_word_tokenize():
+    global _word_tokenize
+    if _word_tokenize is None:
+        if _use_nltk('tokenizers/punkt'):
+            from nltk.tokenize import word_tokenize
+            _word_tokenize = word_tokenize
+        else:
+            _word_tokenize = RegexTokenizer().tokenize
+    return _word_tokenize
+
+def get_detokenize():
+    global _detokenize
+    if _detokenize is None:
+        if _use_nltk('misc/perluniprops'):
+            from nltk.tokenize.moses import MosesDetokenizer
+            detokenizer = MosesDetokenizer()
+            _detokenize = lambda tokens: detokenizer.detokenize(tokens, return_str=True)
+        else:
+            _detokenize = RegexDetokenizer().detokenize
+    return _detokenize
+
+def download_resources(path=None):
+    '''
+    Download the nltk resources used by the 'nltk' backend to `path`.
+    '''
+    import nltk
+    path = path or _config['resource_path']
+    for resource in ('punkt', 'perluniprops'):
+        nltk.download(resource, download_dir=path)
+
+############# API #############
+
+def word_tokenize(utterance):
+    return get_word_tokenize()(utterance)
 
 def detokenize(tokens):
-    return detokenizer.detokenize(tokens, return_str=True)
+    return _detokenize_cache.get(tuple(tokens), lambda tokens: get_detokenize()(list(tokens)))
 
 def tokenize(utterance, lowercase=True):
     if lowercase:
         utterance = utterance.lower()
-    tokens = word_tokenize(utterance)
-    return tokens
+    tokens = _tokenize_cache.get(utterance, lambda utterance: tuple(word_tokenize(utterance)))
+    return list(tokens)
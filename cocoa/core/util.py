@@ -24,6 +24,24 @@ def write_json(raw, path):
     with open(path, 'w') as out:
         print >>out, json.dumps(raw)
 
+def is_jsonl(path):
+    return path.endswith('.jsonl')
+
+def iter_jsonl(path):
+    '''
+    Lazily yield one object per line of a JSON lines file.
+    '''
+    with open(path) as fin:
+        for line in fin:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def write_jsonl(raws, path):
+    with open(path, 'w') as out:
+        for raw in raws:
+            print >>out, json.dumps(raw)
+
 def read_pickle(path):
     with open(path, 'rb') as fin:
         return pickle.load(fin)
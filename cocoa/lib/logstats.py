@@ -1,47 +1,176 @@
+import os
 import json
-from cocoa.core.util import read_json
+import time
+import atexit
+from cocoa.core.util import read_json, is_jsonl
 
 # Global statistics that we can output to monitor the run.
+#
+# If the stats path is a .jsonl file, changes are buffered and appended as
+# JSON lines {"key": [k1, k2, ...], "value": v} (see `read_stats`) instead of
+# rewriting the whole file on every change. Buffered lines are written every
+# `flush_every` changes or `flush_interval` seconds (and at exit); the file
+# is compacted to one line per top-level key when it has grown to
+# `compact_factor` times that (and at least `min_compact_lines`). When `update`
+# sets the same summary map again, only the entries changed by
+# `update_summary_map` since it was last written are appended; change it only
+# through `update_summary_map` or pass a new dict.
 
 stats_path = None
 STATS = {}
 
-def init(path, verbose=False):
+_config = {
+        'flush_every': 100,
+        'flush_interval': 10.,
+        'compact_factor': 4,
+        'min_compact_lines': 1000,
+        }
+_buffer = {
+        'pending': [],
+        'last_flush': time.time(),
+        'num_lines': 0,
+        # Top-level dict values last written by `update`
+        'written': {},
+        # id of a written dict -> its keys changed by update_summary_map since
+        'touched': {},
+        }
+
+def _set(stats, key, value):
+    s = stats
+    for k in key[:-1]:
+        if k not in s:
+            s[k] = {}
+        s = s[k]
+    s[key[-1]] = value
+
+def _replay(path):
+    stats = {}
+    num_lines = 0
+    with open(path) as fin:
+        for line in fin:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                _set(stats, record['key'], record['value'])
+                num_lines += 1
+    return stats, num_lines
+
+def read_stats(path):
+    '''
+    Read a stats file; for .jsonl files, replay the changes to reconstruct
+    the nested stats (e.g. summary maps).
+    '''
+    if is_jsonl(path):
+        return _replay(path)[0]
+    return read_json(path)
+
+def init(path, verbose=False, flush_every=None, flush_interval=None):
     global stats_path, STATS
     stats_path = path
+    if flush_every is not None:
+        _config['flush_every'] = flush_every
+    if flush_interval is not None:
+        _config['flush_interval'] = flush_interval
+    _buffer['pending'] = []
+    _buffer['last_flush'] = time.time()
+    _buffer['written'] = {}
+    _buffer['touched'] = {}
     try:
-        STATS = read_json(stats_path)
+        if is_jsonl(stats_path):
+            STATS, _buffer['num_lines'] = _replay(stats_path)
+        else:
+            STATS = read_json(stats_path)
         if verbose:
             print("Stats file loaded from {}".format(stats_path))
     except Exception:
         STATS = {}
+        _buffer['num_lines'] = 0
         if verbose:
             print("New stats file created, will be stored in {}".format(stats_path))
 
+def _record(changes):
+    '''
+    Write or buffer the (key path, value) pairs in `changes`.
+    '''
+    if not (stats_path and is_jsonl(stats_path)):
+        flush()
+        return
+    for key, value in changes:
+        _buffer['pending'].append(json.dumps({'key': key, 'value': value}))
+    if len(_buffer['pending']) >= _config['flush_every'] or \
+            time.time() - _buffer['last_flush'] >= _config['flush_interval']:
+        flush()
+
 def add(*args):
     # Example: add_stats('data', 'num_examples', 3)
-    s = STATS
-    prefix = args[:-2]
-    for k in prefix:
-        if k not in s:
-            s[k] = {}
-        s = s[k]
-    s[args[-2]] = args[-1]
-    flush()
+    _set(STATS, args[:-1], args[-1])
+    # The next update of this key writes it entirely
+    _forget(args[0])
+    _record([(list(args[:-1]), args[-1])])
 
 def add_args(key, args):
     add(key, dict((arg, getattr(args, arg)) for arg in vars(args)))
 
+def _forget(k):
+    old = _buffer['written'].pop(k, None)
+    if old is not None:
+        _buffer['touched'].pop(id(old), None)
+
+def _changes(k, value):
+    '''
+    (key path, value) pairs to write for `update` of `k`: the touched
+    entries if `value` is the dict last written for `k`, else the whole value.
+    '''
+    touched = None
+    if _buffer['written'].get(k) is value:
+        touched = _buffer['touched'].get(id(value))
+    _forget(k)
+    if isinstance(value, dict):
+        # Keep a reference so that the id is not reused
+        _buffer['written'][k] = value
+        _buffer['touched'][id(value)] = set()
+    if touched is None:
+        return [([k], value)]
+    return [([k, sub_k], value[sub_k]) for sub_k in touched if sub_k in value]
+
 def update(stats):
+    changes = []
     for k in stats:
         STATS[k] = stats[k]
-    flush()
+        if stats_path and is_jsonl(stats_path):
+            changes.extend(_changes(k, stats[k]))
+    _record(changes)
 
 def flush():
-    if stats_path:
+    if not stats_path:
+        return
+    if not is_jsonl(stats_path):
         out = open(stats_path, 'w')
         print >>out, json.dumps(STATS)
         out.close()
+        return
+    pending = _buffer['pending']
+    if pending:
+        with open(stats_path, 'a') as out:
+            out.write('\n'.join(pending) + '\n')
+        _buffer['num_lines'] += len(pending)
+        _buffer['pending'] = []
+    _buffer['last_flush'] = time.time()
+    if _buffer['num_lines'] > max(_config['min_compact_lines'], _config['compact_factor'] * len(STATS)):
+        compact()
+
+def compact():
+    '''
+    Rewrite a .jsonl stats file with one line per top-level key.
+    '''
+    tmp_path = stats_path + '.tmp'
+    with open(tmp_path, 'w') as out:
+        for k, v in STATS.iteritems():
+            print >>out, json.dumps({'key': [k], 'value': v})
+    os.rename(tmp_path, stats_path)
+    _buffer['num_lines'] = len(STATS)
+
+atexit.register(flush)
 
 ############################################################
 
@@ -55,6 +184,9 @@ def summary_map_to_str(m):
     return ' '.join('%s=%g' % (k, s['mean'] if isinstance(s, dict) else s) for k, s in sorted(m.items()))
 
 def update_summary_map(m1, m2):
+    touched = _buffer['touched'].get(id(m1))
+    if touched is not None:
+        touched.update(m2)
     for k, s in m2.items():
         if k not in m1:
             m1[k] = {}
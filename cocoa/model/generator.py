@@ -5,18 +5,39 @@ from sklearn.feature_extraction.text import TfidfVectorizer
 from cocoa.core.util import read_pickle, write_pickle
 from cocoa.model.counter import build_vocabulary, count_ngrams
 from cocoa.model.ngram import MLENgramModel
+from cocoa.model.template_store import TemplateStore
 
 from core.tokenizer import detokenize
 
 class Generator(object):
+    # Generators that only access templates through `TemplateIndex` and
+    # `take` can work on a memory-mapped TemplateStore; others get a DataFrame.
+    supports_template_store = False
+
     def __init__(self, templates):
         self.templates = templates.templates
-        self.vectorizer = TfidfVectorizer()
+        if isinstance(self.templates, TemplateStore) and not self.supports_template_store:
+            self.store = self.templates
+            self.templates = self.store.to_dataframe()
+        else:
+            self.store = self.templates if isinstance(self.templates, TemplateStore) else None
         self.build_tfidf()
 
     def build_tfidf(self):
-        documents = self.templates['context'].values
-        self.tfidf_matrix = self.vectorizer.fit_transform(documents)
+        if self.store is not None:
+            # Fitted when the store was compiled
+            self.vectorizer = self.store.vectorizer
+            self.tfidf_matrix = self.store.tfidf_matrix
+        else:
+            self.vectorizer = TfidfVectorizer()
+            documents = self.templates['context'].values
+            self.tfidf_matrix = self.vectorizer.fit_transform(documents)
+
+    def compile(self, path, sort_by=None):
+        """Save templates, vectorizer and tf-idf matrix as a TemplateStore.
+        """
+        templates = self.templates.to_dataframe() if isinstance(self.templates, TemplateStore) else self.templates
+        TemplateStore.write(path, templates, self.vectorizer, self.tfidf_matrix, sort_by=sort_by)
 
     def _add_filter(self, locs, cond):
         locs.append(locs[-1] & cond)
@@ -81,6 +102,18 @@ class Templates(object):
         templates = read_pickle(path)
         return cls(templates=templates, finalized=True)
 
+    @classmethod
+    def from_store(cls, path):
+        return cls(templates=TemplateStore.open(path), finalized=True)
+
+    @classmethod
+    def load(cls, path):
+        """Load a compiled TemplateStore (directory) or pickled templates.
+        """
+        if TemplateStore.is_store(path):
+            return cls.from_store(path)
+        return cls.from_pickle(path)
+
     def add_template(self, utterance, dialogue_state):
         raise NotImplementedError
 
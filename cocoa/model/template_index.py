@@ -0,0 +1,143 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+
+class TemplateGroup(object):
+    """Templates matching one set of field values.
+    """
+    def __init__(self, positions, tfidf_matrix, weights, ids):
+        # Row positions in the templates DataFrame
+        self.positions = positions
+        self.tfidf_matrix = tfidf_matrix
+        self.weights = weights
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.positions)
+
+
+class TemplateIndex(object):
+    """Group-partitioned index over a templates DataFrame for retrieval.
+
+    Templates are grouped by the values of `keys`, e.g. (category, role,
+    context_tag, response_tag); each group holds its rows of the tf-idf matrix
+    (CSR) and its weights (counts or logp), so a query only touches the
+    templates it can return. Groups of all `keys` are built up front; groups
+    of fewer keys (used when falling back to a looser filter) are built on
+    first use and cached.
+
+    `used_templates` (a set of template ids) is excluded with a boolean mask
+    over template ids, and top-k uses argpartition instead of a full sort.
+
+    `templates` is a DataFrame or a `TemplateStore`. When the rows of a group
+    are contiguous (a store compiled with `sort_by=keys`), its tf-idf
+    submatrix is a view of the (memory-mapped) matrix instead of a copy.
+    """
+    def __init__(self, templates, tfidf_matrix, keys, weight_column):
+        self.keys = tuple(keys)
+        self.columns = {key: templates[key].values for key in self.keys}
+        self.ids = templates['id'].values.astype(np.int64)
+        self.weights = templates[weight_column].values.astype(np.float64)
+        self.tfidf_matrix = tfidf_matrix.tocsr()
+        self.num_ids = int(self.ids.max()) + 1 if len(self.ids) > 0 else 0
+        self.groups = {}
+        groups = pd.DataFrame(self.columns).groupby(list(self.keys)).indices
+        for values, positions in groups.iteritems():
+            if not isinstance(values, tuple):
+                values = (values,)
+            self.groups[tuple(zip(self.keys, values))] = self._build_group(positions)
+
+    def _row_slice(self, start, end):
+        m = self.tfidf_matrix
+        s, e = m.indptr[start], m.indptr[end]
+        return csr_matrix((m.data[s:e], m.indices[s:e], m.indptr[start:end+1] - s),
+                shape=(end - start, m.shape[1]), copy=False)
+
+    def _build_group(self, positions):
+        positions = np.sort(np.asarray(positions, dtype=np.int64))
+        if len(positions) > 0 and positions[-1] - positions[0] + 1 == len(positions):
+            tfidf_matrix = self._row_slice(positions[0], positions[-1] + 1)
+        else:
+            tfidf_matrix = self.tfidf_matrix[positions]
+        return TemplateGroup(positions, tfidf_matrix, self.weights[positions], self.ids[positions])
+
+    def get_group(self, fields):
+        """Return the group of templates matching `fields`, a tuple of
+        (key, value) pairs. The empty tuple is the group of all templates.
+        """
+        group = self.groups.get(fields)
+        if group is None:
+            loc = np.ones(len(self.ids), dtype=bool)
+            for key, value in fields:
+                loc &= (self.columns[key] == value)
+            group = self.groups[fields] = self._build_group(np.flatnonzero(loc))
+        return group
+
+    def used_mask(self, used_templates):
+        used = np.zeros(self.num_ids, dtype=bool)
+        if used_templates:
+            ids = np.fromiter(used_templates, dtype=np.int64, count=len(used_templates))
+            used[ids[ids < self.num_ids]] = True
+        return used
+
+    def select(self, levels, used_templates=None):
+        """Select templates by progressively stricter filters.
+
+        Args:
+            levels (list): field tuples (see `get_group`), from the loosest to
+                the strictest filter.
+            used_templates (set): ids of templates to exclude.
+
+        Returns:
+            (group, available): `available` is a boolean mask over the group
+            (None if nothing is excluded). The strictest level with available
+            templates is chosen; if there is none, the loosest level is
+            returned (possibly empty).
+        """
+        if used_templates:
+            levels = [()] + list(levels)
+            used = self.used_mask(used_templates)
+        else:
+            used = None
+        for fields in reversed(levels):
+            group = self.get_group(fields)
+            available = None if used is None else ~used[group.ids]
+            num_available = len(group) if available is None else np.count_nonzero(available)
+            if num_available > 0:
+                break
+        return group, available
+
+    def scores(self, group, features):
+        """Tf-idf similarity between templates in `group` and `features`
+        (a 1 x vocab sparse matrix).
+        """
+        return (group.tfidf_matrix * features.T).toarray().ravel()
+
+    @classmethod
+    def topk(cls, scores, k):
+        """Indices of the k largest scores in descending order.
+        """
+        if len(scores) > k:
+            ids = np.argpartition(-scores, k)[:k]
+        else:
+            ids = np.arange(len(scores))
+        return ids[np.argsort(-scores[ids], kind='mergesort')]
+
+    def search(self, group, available, features, topk=20):
+        """Return positions and weights of the `topk` available templates
+        of `group` most similar to `features`.
+        """
+        scores = self.scores(group, features)
+        positions, weights = group.positions, group.weights
+        if available is not None:
+            scores, positions, weights = scores[available], positions[available], weights[available]
+        ids = self.topk(scores, topk)
+        return positions[ids], weights[ids]
+
+    def candidates(self, group, available):
+        """Return positions and weights of all available templates of `group`.
+        """
+        if available is None:
+            return group.positions, group.weights
+        return group.positions[available], group.weights[available]
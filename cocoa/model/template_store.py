@@ -0,0 +1,190 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from cocoa.core.util import read_pickle, write_pickle
+
+
+class TemplateStore(object):
+    """Compiled templates: the fitted tf-idf vectorizer, the CSR tf-idf matrix
+    of template contexts and the template columns, saved in a directory of
+    .npy files that are memory-mapped read-only when opened. Processes that
+    open the same store share its pages through the OS page cache instead of
+    each unpickling a DataFrame and refitting the vectorizer.
+
+    Layout of the directory:
+        meta.json: number of templates, columns and tf-idf shape;
+        vectorizer.pkl: the fitted TfidfVectorizer (vocabulary and idf);
+        tfidf_{data,indices,indptr}.npy: the CSR tf-idf matrix;
+        per column, by kind:
+            numeric: <column>.npy;
+            category (strings with few distinct values): <column>.codes.npy,
+                levels are in meta.json;
+            text: utf-8 bytes <column>.bytes.npy, row offsets
+                <column>.offsets.npy and None flags <column>.null.npy;
+            object (anything else): <column>.pkl (loaded, not mapped).
+    """
+    VERSION = 1
+
+    def __init__(self, path, meta, vectorizer, tfidf_matrix, arrays, levels, objects):
+        self.path = path
+        self.meta = meta
+        self.vectorizer = vectorizer
+        self.tfidf_matrix = tfidf_matrix
+        self.columns = [c['name'] for c in meta['columns']]
+        self.kinds = {c['name']: c['kind'] for c in meta['columns']}
+        self.arrays = arrays
+        self.levels = levels
+        self.objects = objects
+
+    def __len__(self):
+        return self.meta['num_templates']
+
+    @classmethod
+    def is_store(cls, path):
+        return os.path.isdir(path) and os.path.exists(os.path.join(path, 'meta.json'))
+
+    @classmethod
+    def _column_kind(cls, values, max_levels):
+        if values.dtype != np.object_:
+            return 'numeric' if (np.issubdtype(values.dtype, np.number) or values.dtype == np.bool_) else 'object'
+        if not all(v is None or isinstance(v, basestring) for v in values):
+            return 'object'
+        num_levels = len(set(values))
+        if num_levels <= max_levels and num_levels < max(2, len(values) / 2):
+            return 'category'
+        return 'text'
+
+    @classmethod
+    def write(cls, path, templates, vectorizer, tfidf_matrix, sort_by=None, max_levels=1000):
+        """Compile `templates` (DataFrame) and the fitted `vectorizer` and
+        `tfidf_matrix` (one row per template) to the directory `path`.
+
+        If `sort_by` (list of columns) is given, rows are stored sorted by
+        these columns so that templates sharing their values are contiguous
+        (see `TemplateIndex`).
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        tfidf_matrix = csr_matrix(tfidf_matrix)
+        if sort_by:
+            order = np.argsort(templates[list(sort_by)].fillna('').apply(tuple, axis=1).values, kind='mergesort')
+            templates = templates.iloc[order]
+            tfidf_matrix = tfidf_matrix[order]
+        tfidf_matrix.sort_indices()
+
+        def save(name, array):
+            np.save(os.path.join(path, name + '.npy'), np.ascontiguousarray(array))
+
+        save('tfidf_data', tfidf_matrix.data)
+        save('tfidf_indices', tfidf_matrix.indices)
+        save('tfidf_indptr', tfidf_matrix.indptr)
+        write_pickle(vectorizer, os.path.join(path, 'vectorizer.pkl'))
+
+        columns = []
+        for name in templates.columns:
+            values = templates[name].values
+            kind = cls._column_kind(values, max_levels)
+            column = {'name': name, 'kind': kind}
+            if kind == 'numeric':
+                save(name, values)
+            elif kind == 'category':
+                levels = sorted(set(values), key=lambda v: (v is not None, v))
+                codes = {v: i for i, v in enumerate(levels)}
+                save(name + '.codes', np.array([codes[v] for v in values], dtype=np.int32))
+                column['levels'] = levels
+            elif kind == 'text':
+                encoded = [(v or u'').encode('utf-8') if not isinstance(v, str) else v for v in values]
+                offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+                offsets[1:] = np.cumsum([len(v) for v in encoded])
+                save(name + '.bytes', np.array(bytearray(''.join(encoded)), dtype=np.uint8))
+                save(name + '.offsets', offsets)
+                save(name + '.null', np.array([v is None for v in values], dtype=np.bool_))
+            else:
+                write_pickle(list(values), os.path.join(path, name + '.pkl'))
+            columns.append(column)
+
+        meta = {
+                'version': cls.VERSION,
+                'num_templates': len(templates),
+                'columns': columns,
+                'tfidf_shape': list(tfidf_matrix.shape),
+                'sort_by': list(sort_by) if sort_by else None,
+                }
+        with open(os.path.join(path, 'meta.json'), 'w') as fout:
+            json.dump(meta, fout)
+
+    @classmethod
+    def open(cls, path):
+        """Open a compiled store; arrays are memory-mapped read-only.
+        """
+        with open(os.path.join(path, 'meta.json')) as fin:
+            meta = json.load(fin)
+        if meta.get('version') != cls.VERSION:
+            raise ValueError('Template store {} has version {}, expected {}; recompile it'.format(path, meta.get('version'), cls.VERSION))
+
+        def load(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+        tfidf_matrix = csr_matrix((load('tfidf_data'), load('tfidf_indices'), load('tfidf_indptr')),
+                shape=tuple(meta['tfidf_shape']), copy=False)
+        vectorizer = read_pickle(os.path.join(path, 'vectorizer.pkl'))
+
+        arrays, levels, objects = {}, {}, {}
+        for column in meta['columns']:
+            name, kind = column['name'], column['kind']
+            if kind == 'numeric':
+                arrays[name] = load(name)
+            elif kind == 'category':
+                arrays[name] = load(name + '.codes')
+                levels[name] = np.array(column['levels'], dtype=np.object_)
+            elif kind == 'text':
+                arrays[name] = (load(name + '.bytes'), load(name + '.offsets'), load(name + '.null'))
+            else:
+                objects[name] = read_pickle(os.path.join(path, name + '.pkl'))
+        return cls(path, meta, vectorizer, tfidf_matrix, arrays, levels, objects)
+
+    def _text(self, name, i):
+        data, offsets, null = self.arrays[name]
+        if null[i]:
+            return None
+        return data[offsets[i]:offsets[i+1]].tostring().decode('utf-8')
+
+    def get_value(self, name, i):
+        kind = self.kinds[name]
+        if kind == 'numeric':
+            return self.arrays[name][i].item()
+        elif kind == 'category':
+            return self.levels[name][self.arrays[name][i]]
+        elif kind == 'text':
+            return self._text(name, i)
+        return self.objects[name][i]
+
+    def column(self, name):
+        """Return all values of column `name` as an array. Numeric columns
+        are memory-mapped; other columns are decoded.
+        """
+        kind = self.kinds[name]
+        if kind == 'numeric':
+            return self.arrays[name]
+        elif kind == 'category':
+            return self.levels[name][self.arrays[name]]
+        elif kind == 'text':
+            return np.array([self._text(name, i) for i in xrange(len(self))], dtype=np.object_)
+        return np.array(self.objects[name], dtype=np.object_)
+
+    def __getitem__(self, name):
+        return pd.Series(self.column(name), name=name)
+
+    def take(self, positions):
+        """Return the rows at `positions` as a DataFrame (like DataFrame.take).
+        """
+        positions = list(positions)
+        data = {name: [self.get_value(name, i) for i in positions] for name in self.columns}
+        return pd.DataFrame(data, index=positions, columns=self.columns)
+
+    def to_dataframe(self):
+        return pd.DataFrame({name: self.column(name) for name in self.columns}, columns=self.columns)
@@ -13,7 +13,13 @@ class Scorer(object):
         Additional term add to log probability
         See https://arxiv.org/pdf/1609.08144.pdf.
         """
-        l_term = (((5 + len(beam.next_ys)) ** self.alpha) /
+        return self.length_normalize(logprobs, len(beam.next_ys))
+
+    def length_normalize(self, logprobs, length):
+        """
+        Length penalty applied to logprobs (any shape) of sequences of |length|.
+        """
+        l_term = (((5 + length) ** self.alpha) /
                   ((5 + 1) ** self.alpha))
         return (logprobs / l_term)
 
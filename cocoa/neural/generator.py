@@ -59,31 +59,47 @@ class Generator(object):
 
         return dec_states, memory_bank
 
-    def _run_attention_memory(self, batch, enc_memory_bank):
+    def _embed(self, embedder, inputs, memory_cache=None, name=None):
+        """Return the memory bank of |embedder| on |inputs|.
+
+        If |memory_cache| (a dict owned by the caller, e.g. a session) is
+        given, the memory bank is cached by embedder name and input token ids.
+        Only pass it for inputs that are static across turns (KB title,
+        description, scene); the context utterances change every turn and
+        would never be reused.
+        """
+        if memory_cache is None:
+            return embedder(inputs)[1]
+        key = (name, tuple(inputs.data.view(-1).tolist()))
+        if key not in memory_cache:
+            memory_cache[key] = embedder(inputs)[1]
+        return memory_cache[key]
+
+    def _run_attention_memory(self, batch, enc_memory_bank, memory_cache=None):
         if batch.num_context > 0 and hasattr(self.model, 'kb_embedder'):
             context_inputs = batch.context_inputs
-            _, context_memory_bank = self.model.context_embedder(context_inputs)
+            context_memory_bank = self._embed(self.model.context_embedder, context_inputs)
             memory_bank = [enc_memory_bank, context_memory_bank]
 
             # TODO: hacky. fix.
             if hasattr(batch, 'title_inputs') and self.model.kb_embedder:
                 title_inputs = batch.title_inputs
-                _, title_memory_bank = self.model.kb_embedder(title_inputs)
+                title_memory_bank = self._embed(self.model.kb_embedder, title_inputs, memory_cache, 'title')
                 memory_bank.append(title_memory_bank)
 
                 desc_inputs = batch.desc_inputs
-                _, desc_memory_bank = self.model.kb_embedder(desc_inputs)
+                desc_memory_bank = self._embed(self.model.kb_embedder, desc_inputs, memory_cache, 'desc')
                 memory_bank.append(desc_memory_bank)
 
             elif hasattr(batch, 'scene_inputs') and self.model.kb_embedder:
                 scene_inputs = batch.scene_inputs
-                _, scene_memory_bank = self.model.kb_embedder(scene_inputs)
+                scene_memory_bank = self._embed(self.model.kb_embedder, scene_inputs, memory_cache, 'scene')
                 memory_bank.append(scene_memory_bank)
         else:
             memory_bank = enc_memory_bank
         return memory_bank
 
-    def generate_batch(self, batch, gt_prefix=1, enc_state=None):
+    def generate_batch(self, batch, gt_prefix=1, enc_state=None, memory_cache=None):
         """
         Generate a batch of sentences.
 
@@ -92,6 +108,7 @@ class Generator(object):
         Args:
            batch (:obj:`Batch`): a batch from a dataset object
            gt_prefix (int): ground truth prefix length(bos)
+           memory_cache (dict): cache of attention memory banks (see `_embed`)
 
         """
 
@@ -132,7 +149,7 @@ class Generator(object):
         # (1) Run the encoder on the src.
         lengths = batch.lengths
         dec_states, enc_memory_bank = self._run_encoder(batch, enc_state)
-        memory_bank = self._run_attention_memory(batch, enc_memory_bank)
+        memory_bank = self._run_attention_memory(batch, enc_memory_bank, memory_cache)
 
         # (1.1) Go over forced prefix.
         if gt_prefix > 1:
@@ -263,6 +280,155 @@ class Generator(object):
             gold_scores += scores
         return gold_scores
 
+class BatchedBeamGenerator(Generator):
+    """
+    Beam search that keeps the beams of all batch elements in single score and
+    backpointer tensors of shape (batch_size, beam_size), instead of advancing
+    one :obj:`Beam` per example. Search and output format follow
+    :obj:`Generator`.
+    """
+    def generate_batch(self, batch, gt_prefix=1, enc_state=None, memory_cache=None):
+        beam_size = self.beam_size
+        batch_size = batch.size
+        n_best = self.n_best
+        assert n_best <= beam_size
+        pad = self.vocab.word_to_ind[markers.PAD]
+        eos = self.vocab.word_to_ind[markers.EOS]
+        tt = torch.cuda if self.cuda else torch
+
+        def var(a): return Variable(a, volatile=True)
+
+        def rvar(a): return var(a.repeat(1, beam_size, 1))
+
+        # (1) Run the encoder on the src.
+        lengths = batch.lengths
+        dec_states, enc_memory_bank = self._run_encoder(batch, enc_state)
+        memory_bank = self._run_attention_memory(batch, enc_memory_bank, memory_cache)
+
+        # (1.1) Go over forced prefix.
+        if gt_prefix > 1:
+            inp = batch.decoder_inputs[:gt_prefix-1]
+            _, dec_states, _ = self.model.decoder(
+                inp, memory_bank, dec_states, memory_lengths=lengths)
+
+        # (2) Repeat src objects `beam_size` times.
+        if batch.num_context > 0 and hasattr(self.model, 'context_embedder'):
+            memory_bank = [rvar(bank.data) for bank in memory_bank]
+        else:
+            memory_bank = rvar(memory_bank.data)
+        memory_lengths = lengths.repeat(beam_size)
+        dec_states.repeat_beam_size_times(beam_size)
+
+        # Beam state: (batch_size, beam_size). Only the first hypothesis is
+        # alive at the start so that the first step expands a single beam.
+        tokens = tt.LongTensor(batch_size, beam_size).fill_(pad)
+        tokens[:, 0] = batch.decoder_inputs[gt_prefix-1].data
+        scores = tt.FloatTensor(batch_size, beam_size).fill_(-1e20)
+        scores[:, 0] = 0
+        batch_offset = tt.LongTensor(range(batch_size)).unsqueeze(0)
+        eos_top = tt.ByteTensor(batch_size).zero_()
+        num_finished = tt.LongTensor(batch_size).zero_()
+        # History of each step, all (batch_size, beam_size)
+        next_ys, prev_ks, attns = [], [], []
+        # Length-normalized scores of hypotheses ending with EOS at each step
+        finished_scores = []
+
+        # (3) run the decoder to generate sentences, using beam search.
+        for i in range(self.max_length):
+            inp = var(tokens.t().contiguous().view(1, -1))
+            dec_out, dec_states, attn = self.model.decoder(inp, memory_bank,
+                        dec_states, memory_lengths=memory_lengths)
+            out = self.model.generator.forward(dec_out.squeeze(0)).data
+            # (beam_size * batch_size, vocab_size) -> (batch_size, beam_size, vocab_size)
+            log_probs = out.view(beam_size, batch_size, -1).transpose(0, 1)
+            vocab_size = log_probs.size(2)
+
+            # Force the output to be longer than self.min_length
+            if i + 1 < self.min_length:
+                log_probs[:, :, eos] = -1e20
+
+            beam_scores = log_probs + scores.unsqueeze(2).expand_as(log_probs)
+            # Don't let EOS have children.
+            if i > 0:
+                beam_scores.masked_fill_(tokens.eq(eos).unsqueeze(2).expand_as(beam_scores), -1e20)
+
+            scores, best_ids = beam_scores.view(batch_size, -1).topk(beam_size, 1, True, True)
+            prev_k = best_ids / vocab_size
+            tokens = best_ids - prev_k * vocab_size
+            prev_ks.append(prev_k)
+            next_ys.append(tokens)
+
+            step_attn = attn["std"].data.view(beam_size, batch_size, -1).transpose(0, 1)
+            attns.append(step_attn.gather(1, prev_k.unsqueeze(2).expand(
+                batch_size, beam_size, step_attn.size(2))))
+
+            is_eos = tokens.eq(eos)
+            normalized_scores = self._normalize(scores, i + 2)
+            finished_scores.append(normalized_scores.masked_fill(is_eos.eq(0), -float('inf')))
+            num_finished += is_eos.long().sum(1)
+            eos_top = (eos_top + is_eos[:, 0]).gt(0)
+
+            # Make the decoder states follow the backpointers.
+            positions = prev_k.t() * batch_size + batch_offset.expand(beam_size, batch_size)
+            dec_states.beam_reorder(positions.contiguous().view(-1))
+
+            # End condition is when top-of-beam is EOS for all examples.
+            if (eos_top * num_finished.ge(n_best)).all():
+                break
+
+        # (4) Extract sentences from beam.
+        ret = self._from_beam_tensors(next_ys, prev_ks, attns, finished_scores,
+                normalized_scores, is_eos, num_finished, lengths, pad)
+        ret["gold_score"] = [0] * batch_size
+        ret["batch"] = batch
+        return ret
+
+    def _normalize(self, scores, length):
+        if self.global_scorer is None:
+            return scores
+        return self.global_scorer.length_normalize(scores, length)
+
+    def _from_beam_tensors(self, next_ys, prev_ks, attns, finished_scores,
+            last_scores, last_eos, num_finished, lengths, pad):
+        batch_size, beam_size = next_ys[0].size()
+        num_steps = len(next_ys)
+        n_best = self.n_best
+
+        # Examples with fewer than n_best finished hypotheses fall back to the
+        # best unfinished ones of the last step.
+        unfinished = last_eos.eq(0).long()
+        rank = unfinished.cumsum(1)
+        needed = (n_best - num_finished).clamp(min=0).unsqueeze(1).expand_as(rank)
+        fallback = unfinished.byte() * rank.le(needed)
+        finished_scores[-1] = torch.where(fallback, last_scores, finished_scores[-1])
+
+        # Select the n_best (step, beam) pairs of each example
+        finished_scores = torch.stack(finished_scores, 1).view(batch_size, -1)
+        best_scores, best_ids = finished_scores.topk(n_best, 1, True, True)
+        best_steps = best_ids / beam_size
+        k = best_ids - best_steps * beam_size
+
+        # Walk back to construct the full hypotheses.
+        src_len = attns[0].size(2)
+        preds = next_ys[0].new(batch_size, n_best, num_steps).fill_(pad)
+        hyp_attns = attns[0].new(batch_size, n_best, num_steps, src_len).zero_()
+        for j in range(num_steps - 1, -1, -1):
+            active = best_steps.ge(j)
+            preds[:, :, j] = next_ys[j].gather(1, k).masked_fill_(active.eq(0), pad)
+            hyp_attns[:, :, j] = attns[j].gather(1, k.unsqueeze(2).expand(batch_size, n_best, src_len))
+            k = torch.where(active, prev_ks[j].gather(1, k), k)
+
+        ret = {"predictions": [],
+               "scores": [],
+               "attention": [],
+               }
+        hyp_lengths = (best_steps + 1).tolist()
+        for b in range(batch_size):
+            ret["predictions"].append([preds[b, n, :hyp_lengths[b][n]].tolist() for n in range(n_best)])
+            ret["scores"].append(best_scores[b].tolist())
+            ret["attention"].append([hyp_attns[b, n, :hyp_lengths[b][n], :int(lengths[b])] for n in range(n_best)])
+        return ret
+
 class Sampler(Generator):
     def __init__(self, model, vocab,
                  temperature=1, max_length=100, cuda=False):
@@ -277,11 +443,11 @@ class Sampler(Generator):
         # For debugging
         self.builder = UtteranceBuilder(vocab)
 
-    def generate_batch(self, batch, gt_prefix=1, enc_state=None):
+    def generate_batch(self, batch, gt_prefix=1, enc_state=None, memory_cache=None):
         # (1) Run the encoder on the src.
         lengths = batch.lengths
         dec_states, enc_memory_bank = self._run_encoder(batch, enc_state)
-        memory_bank = self._run_attention_memory(batch, enc_memory_bank)
+        memory_bank = self._run_attention_memory(batch, enc_memory_bank, memory_cache)
 
         # (1.1) Go over forced prefix.
         inp = batch.decoder_inputs[:gt_prefix]
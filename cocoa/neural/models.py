@@ -670,6 +670,16 @@ class DecoderState(object):
             sent_states.data.copy_(
                 sent_states.data.index_select(1, positions))
 
+    def beam_reorder(self, positions):
+        """Reorder the beams of all batch elements at once.
+
+        Args:
+            positions (LongTensor): new order of the flattened
+                (beam_size x batch_size) dimension.
+        """
+        for e in self._all:
+            e.data.copy_(e.data.index_select(1, positions))
+
 
 class RNNDecoderState(DecoderState):
     def __init__(self, hidden_size, rnnstate):
@@ -0,0 +1,55 @@
+import sys
+import time
+import threading
+import Queue
+
+import torch
+
+
+class Prefetcher(object):
+    """Iterate over `iterator` in a background thread.
+
+    Up to `depth` upcoming items (e.g. `Batch` objects from
+    `DataGenerator.generator`) are built ahead while the consumer is busy
+    (e.g. training on the current batch). A single thread fills the queue so
+    the order of items (dialogue turns, None at the end of a dialogue) is
+    preserved. Exceptions raised by `iterator` are re-raised by `next`.
+    If `device` is given, the thread builds CUDA tensors on that device (the
+    current device is per thread).
+
+    `wait_time` is the time the consumer spent waiting for items.
+    """
+    _END = object()
+
+    def __init__(self, iterator, depth, device=None):
+        self.queue = Queue.Queue(maxsize=depth)
+        self.device = device
+        self.wait_time = 0.
+        self.thread = threading.Thread(target=self._fill, args=(iterator,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _fill(self, iterator):
+        if self.device is not None:
+            torch.cuda.set_device(self.device)
+        try:
+            for item in iterator:
+                self.queue.put((item, None))
+        except Exception:
+            self.queue.put((None, sys.exc_info()))
+        self.queue.put((self._END, None))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start_time = time.time()
+        item, exc_info = self.queue.get()
+        self.wait_time += time.time() - start_time
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if item is self._END:
+            # Stay exhausted
+            self.queue.put((self._END, None))
+            raise StopIteration
+        return item
@@ -11,6 +11,7 @@ from onmt.Trainer import Statistics as BaseStatistics
 from onmt.Utils import use_gpu
 
 from cocoa.io.utils import create_path
+from cocoa.neural.prefetch import Prefetcher
 
 
 class Statistics(BaseStatistics):
@@ -89,12 +90,12 @@ class Trainer(object):
             print('')
 
             # 1. Train for one epoch on the training set.
-            train_iter = data.generator('train', cuda=use_gpu(opt))
+            train_iter = self.prefetch(data.generator('train', cuda=use_gpu(opt)), opt)
             train_stats = self.train_epoch(train_iter, opt, epoch, report_func)
             print('Train loss: %g' % train_stats.mean_loss())
 
             # 2. Validate on the validation set.
-            valid_iter = data.generator('dev', cuda=use_gpu(opt))
+            valid_iter = self.prefetch(data.generator('dev', cuda=use_gpu(opt)), opt)
             valid_stats = self.validate(valid_iter)
             print('Validation loss: %g' % valid_stats.mean_loss())
 
@@ -114,6 +115,17 @@ class Trainer(object):
                 self.drop_checkpoint(opt, epoch, valid_stats)
 
 
+    def prefetch(self, data_iter, opt):
+        """Build upcoming batches of `data_iter` in a background thread while
+        the model trains (if `opt.prefetch_batches` > 0). Whether this helps
+        depends on the time spent building batches: compare the throughput
+        and wait time reported by train_epoch.
+        """
+        if opt.prefetch_batches > 0:
+            device = torch.cuda.current_device() if use_gpu(opt) else None
+            return Prefetcher(data_iter, opt.prefetch_batches, device=device)
+        return data_iter
+
     def train_epoch(self, train_iter, opt, epoch, report_func=None):
         """ Train next epoch.
         Args:
@@ -134,8 +146,12 @@ class Trainer(object):
         normalization = 0
         num_batches = train_iter.next()
         self.cuda = use_gpu(opt)
+        start_time = time.time()
+        num_trained = 0
 
         for batch_idx, batch in enumerate(train_iter):
+            if batch is not None:
+                num_trained += 1
             true_batchs.append(batch)
             accum += 1
 
@@ -155,6 +171,11 @@ class Trainer(object):
             self._gradient_accumulation(true_batchs, total_stats, report_stats)
             true_batchs = []
 
+        elapsed = time.time() - start_time
+        print('Train throughput: %.2f batches/s' % (num_trained / (elapsed + 1e-5)))
+        if isinstance(train_iter, Prefetcher):
+            print('Waited %.1f s (of %.1f s) for batches' % (train_iter.wait_time, elapsed))
+
         return total_stats
 
     def validate(self, valid_iter):
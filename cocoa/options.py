@@ -56,6 +56,8 @@ def add_trainer_arguments(parser):
     #                    help='Data comes from a generator, which is unlimited, so we need to set some artificial limit.')
     group.add_argument('--epochs', type=int, default=14,
                        help='Number of training epochs')
+    group.add_argument('--prefetch-batches', type=int, default=0,
+                       help='Number of batches built ahead in a background thread while training (0 = no prefetching)')
     group.add_argument('--optim', default='sgd', help="""Optimization method.""",
                        choices=['sgd', 'adagrad', 'adadelta', 'adam'])
     group.add_argument('--max-grad-norm', type=float, default=5,
@@ -126,6 +128,8 @@ def add_generator_arguments(parser):
                 help="""If verbose is set, will output the n_best decoded sentences""")
     group.add_argument('--alpha', type=float, default=0.5,
                 help="""length penalty parameter (higher = longer generation)""")
+    group.add_argument('--batched-beam', action='store_true',
+                help="""Search beams of all examples in a batch with tensor operations""")
 
     group = parser.add_argument_group('Sample')
     group.add_argument('--sample', action="store_true",
@@ -146,6 +150,6 @@ def add_generator_arguments(parser):
 
 # =============== system ===============
 def add_rulebased_arguments(parser):
-    parser.add_argument('--templates', help='Path to templates (.pkl)')
+    parser.add_argument('--templates', help='Path to templates (.pkl) or compiled template store (directory)')
     parser.add_argument('--policy', help='Path to manager model (.pkl)')
 
@@ -27,7 +27,15 @@ class HumanSession(Session):
     def receive(self, event):
         self.inbox.append(event)
 
+    def requeue(self, events):
+        # Put back events that could not be delivered, before the newer ones
+        self.inbox[:0] = events
+
     def enqueue(self, event):
         self.outbox.append(event)
 
+    def next_ready_time(self):
+        # Events are sent by the web backend, which steps the controller
+        return None
+
 
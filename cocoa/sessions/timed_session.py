@@ -29,6 +29,10 @@ class TimedSessionWrapper(Session):
         self.received = False
         self.num_utterances = 0
         self.start_typing = False
+        # Delay of the event at the head of queued_event
+        self.delay = None
+        # Time at which the session last had nothing to send
+        self.idle_timestamp = None
 
     @property
     def config(self):
@@ -47,6 +51,57 @@ class TimedSessionWrapper(Session):
         self.session.receive(event)
         self.received = True
         self.queued_event.clear()
+        self.delay = None
+        self.idle_timestamp = None
+
+    def get_delay(self, event):
+        '''
+        Simulated time (in seconds) taken to type/perform `event`.
+        '''
+        if event.action == 'message':
+            delay = float(len(event.data)) / self.CHAR_RATE + random.uniform(0, self.EPSILON)
+        elif event.action == 'select':
+            delay = self.SELECTION_DELAY + random.uniform(0, self.EPSILON)
+            if self.prev_action == 'select':
+                delay += self.REPEATED_SELECTION_DELAY
+        # TODO: refactor this
+        elif event.action in ('offer', 'accept', 'reject', 'done', 'quit'):
+            delay = self.SELECTION_DELAY + random.uniform(0, self.EPSILON)
+        elif event.action == 'join':
+            delay = 0.5
+        else:
+            raise ValueError('Unknown event type: %s' % event.action)
+        return delay
+
+    def next_ready_time(self):
+        '''
+        Earliest time at which send() may return an event, or None if the session
+        is waiting for its partner. Calling send() earlier is harmless but useless.
+        '''
+        if self.num_utterances >= 1:
+            return None
+        if self.received is False:
+            if self.prev_action == 'select':
+                return None
+            # Lower bound of the patience before talking again
+            earliest = self.last_message_timestamp + 1
+        else:
+            earliest = time.time()
+        if len(self.queued_event) == 0 or self.queued_event[0] is None:
+            # The underlying session has to be asked for its next event
+            if self.idle_timestamp is not None:
+                # It had nothing to send; don't ask again before the patience
+                return max(earliest, self.idle_timestamp + self.PATIENCE)
+            return earliest
+        event = self.queued_event[0]
+        if self.delay is None:
+            self.delay = self.get_delay(event)
+        ready_time = self.last_message_timestamp + self.delay
+        if event.action == 'message' and self.start_typing is False:
+            # Typing starts after the reading time
+            reading_time = 0 if self.prev_action == 'join' else 0.5
+            ready_time = min(ready_time, self.last_message_timestamp + reading_time)
+        return max(earliest, ready_time)
 
     def send(self):
         # TODO: even if cross talk is enabled, we don't want the bot to talk in a row
@@ -61,20 +116,11 @@ class TimedSessionWrapper(Session):
 
         event = self.queued_event[0]
         if event is None:
+            self.idle_timestamp = time.time()
             return self.queued_event.popleft()
-        if event.action == 'message':
-            delay = float(len(event.data)) / self.CHAR_RATE + random.uniform(0, self.EPSILON)
-        elif event.action == 'select':
-            delay = self.SELECTION_DELAY + random.uniform(0, self.EPSILON)
-            if self.prev_action == 'select':
-                delay += self.REPEATED_SELECTION_DELAY
-        # TODO: refactor this
-        elif event.action in ('offer', 'accept', 'reject', 'done', 'quit'):
-            delay = self.SELECTION_DELAY + random.uniform(0, self.EPSILON)
-        elif event.action == 'join':
-            delay = 0.5
-        else:
-            raise ValueError('Unknown event type: %s' % event.action)
+        if self.delay is None:
+            self.delay = self.get_delay(event)
+        delay = self.delay
 
         if self.last_message_timestamp + delay > time.time():
             # Add reading time before start typing
@@ -91,9 +137,11 @@ class TimedSessionWrapper(Session):
                 return Event.TypingEvent(self.agent, 'stopped')
             elif event.action == 'join':
                 event = self.queued_event.popleft()
+                self.delay = None
                 return event
             else:
                 event = self.queued_event.popleft()
+                self.delay = None
                 self.prev_action = event.action
                 self.received = False
                 self.num_utterances += 1
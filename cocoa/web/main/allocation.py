@@ -0,0 +1,203 @@
+import atexit
+import json
+import random
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from storage import ConnectionPool
+from logger import WebLogger
+
+
+class IndexedSet(object):
+    """A set supporting O(1) add, remove and uniform random choice.
+    """
+    def __init__(self):
+        self.items = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def add(self, item):
+        if item not in self.positions:
+            self.positions[item] = len(self.items)
+            self.items.append(item)
+
+    def discard(self, item):
+        i = self.positions.pop(item, None)
+        if i is None:
+            return
+        last = self.items.pop()
+        if i < len(self.items):
+            self.items[i] = last
+            self.positions[last] = i
+
+    def choice(self):
+        return random.choice(self.items)
+
+
+class ScenarioAllocationIndex(object):
+    """In-memory view of the `scenario` table used to assign scenarios to new chats.
+
+    For each (scenario, partner type) we track the complete and active chats;
+    the number of chats still needed is `num_chats_per_scenario[partner_type]`
+    minus their total. Scenarios that still need chats are kept in indexed sets
+    (one over all partner types and one per partner type), so choosing a
+    scenario takes constant time regardless of the size of the scenario DB.
+
+    The table is read once when the index is created. Changes are written back
+    by `persist`, at most once every `persist_interval` seconds, and by a
+    background thread every `persist_interval` seconds and at exit. Update
+    the index only after the transaction that changed the chats has committed
+    (see `Connection.on_commit`).
+    """
+    indexes = {}
+    indexes_lock = threading.Lock()
+
+    def __init__(self, num_chats_per_scenario, persist_interval=10.):
+        self.num_chats_per_scenario = num_chats_per_scenario
+        self.persist_interval = persist_interval
+        self.complete = {}
+        self.active = {}
+        self.scenario_ids = IndexedSet()
+        # Scenarios that need more chats with any / a specific partner type
+        self.needed = IndexedSet()
+        self.needed_by_type = defaultdict(IndexedSet)
+        self.needed_types = defaultdict(set)
+        self.dirty = set()
+        self.last_persist_time = time.time()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get_index(cls, db_file, conn, num_chats_per_scenario, **kwargs):
+        """Return the process-wide index for `db_file`, loading it from `conn` if needed.
+        """
+        with cls.indexes_lock:
+            if db_file not in cls.indexes:
+                index = cls(num_chats_per_scenario, **kwargs)
+                index.load(conn.cursor())
+                index.start_persisting(ConnectionPool.get_pool(db_file))
+                cls.indexes[db_file] = index
+            return cls.indexes[db_file]
+
+    def load(self, cursor):
+        cursor.execute('''SELECT scenario_id, partner_type, complete, active FROM scenario''')
+        for scenario_id, partner_type, complete, active in cursor.fetchall():
+            key = (scenario_id, partner_type)
+            self.complete[key] = set(json.loads(complete))
+            self.active[key] = set(json.loads(active))
+            self.scenario_ids.add(scenario_id)
+            self._update_needed(scenario_id, partner_type)
+
+    def _num_chats(self, key):
+        return len(self.complete[key]) + len(self.active[key])
+
+    def _update_needed(self, scenario_id, partner_type):
+        key = (scenario_id, partner_type)
+        types = self.needed_types[scenario_id]
+        if self._num_chats(key) < self.num_chats_per_scenario.get(partner_type, 0):
+            types.add(partner_type)
+            self.needed_by_type[partner_type].add(scenario_id)
+        else:
+            types.discard(partner_type)
+            self.needed_by_type[partner_type].discard(scenario_id)
+        if types:
+            self.needed.add(scenario_id)
+        else:
+            self.needed.discard(scenario_id)
+
+    def choose(self, partner_types):
+        """Choose a scenario that still needs chats and a partner type it needs.
+
+        Args:
+            partner_types (list): partner types allowed for the new chat.
+
+        Returns:
+            (scenario_id, partner_type); if no scenario needs more chats, a
+            random scenario and partner type.
+
+        """
+        with self.lock:
+            if len(partner_types) == 1:
+                needed = self.needed_by_type[partner_types[0]]
+                if len(needed) > 0:
+                    return needed.choice(), partner_types[0]
+            elif len(self.needed) > 0:
+                scenario_id = self.needed.choice()
+                types = [p for p in partner_types if p in self.needed_types[scenario_id]]
+                if types:
+                    return scenario_id, random.choice(types)
+            return self.scenario_ids.choice(), random.choice(partner_types)
+
+    def _get_chats(self, chats, scenario_id, partner_type):
+        key = (scenario_id, partner_type)
+        if key not in chats:
+            self.complete[key] = set()
+            self.active[key] = set()
+            self.scenario_ids.add(scenario_id)
+        self.dirty.add(key)
+        return chats[key]
+
+    def add_active_chat(self, scenario_id, partner_type, chat_id):
+        with self.lock:
+            self._get_chats(self.active, scenario_id, partner_type).add(chat_id)
+            self._update_needed(scenario_id, partner_type)
+
+    def remove_active_chat(self, scenario_id, partner_type, chat_id):
+        with self.lock:
+            self._get_chats(self.active, scenario_id, partner_type).discard(chat_id)
+            self._update_needed(scenario_id, partner_type)
+
+    def add_complete_chat(self, scenario_id, partner_type, chat_id):
+        with self.lock:
+            self._get_chats(self.complete, scenario_id, partner_type).add(chat_id)
+            self._update_needed(scenario_id, partner_type)
+
+    def persist(self, conn, force=False):
+        """Write changed rows back to the `scenario` table.
+
+        Must not be called inside an open transaction on `conn`.
+        """
+        with self.lock:
+            if not self.dirty or (not force and time.time() - self.last_persist_time < self.persist_interval):
+                return
+            rows = [(json.dumps(list(self.complete[key])), json.dumps(list(self.active[key]))) + key
+                    for key in self.dirty]
+            dirty, self.dirty = self.dirty, set()
+            self.last_persist_time = time.time()
+        try:
+            with conn:
+                conn.executemany('''UPDATE scenario SET complete=?, active=? WHERE scenario_id=? AND partner_type=?''',
+                                 rows)
+        except Exception:
+            with self.lock:
+                self.dirty.update(dirty)
+            raise
+
+    def start_persisting(self, pool):
+        """Force `persist` every `persist_interval` seconds and when the process exits.
+        """
+        def persist():
+            conn = pool.get()
+            try:
+                self.persist(conn, force=True)
+            finally:
+                pool.put(conn)
+
+        def run():
+            while True:
+                time.sleep(self.persist_interval)
+                try:
+                    persist()
+                except sqlite3.Error as e:
+                    WebLogger.get_logger().warning("Failed to persist scenario allocation: {}".format(e))
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        atexit.register(persist)
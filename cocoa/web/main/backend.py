@@ -4,7 +4,6 @@ import sqlite3
 import time
 import numpy as np
 from flask import Markup
-from collections import defaultdict
 import json
 
 from cocoa.systems.human_system import HumanSystem
@@ -15,6 +14,8 @@ from states import FinishedState, UserChatState, WaitingState, SurveyState
 from utils import Status, UnexpectedStatusException, ConnectionTimeoutException, StatusTimeoutException, NoSuchUserException, Messages, current_timestamp_in_seconds, User
 from db_reader import DatabaseReader
 from logger import WebLogger
+from storage import ConnectionPool, create_indexes
+from allocation import ScenarioAllocationIndex
 
 
 class DatabaseManager(object):
@@ -22,6 +23,11 @@ class DatabaseManager(object):
     """
     def __init__(self, db_file):
         self.db_file = db_file
+        self.pool = ConnectionPool.get_pool(db_file)
+        conn = self.pool.get()
+        with conn:
+            create_indexes(conn.cursor())
+        self.pool.put(conn)
 
     @classmethod
     def init_database(cls, db_file):
@@ -50,6 +56,7 @@ class DatabaseManager(object):
         c.execute(
             '''CREATE TABLE feedback (name text, comments text)'''
         )
+        create_indexes(c)
 
         conn.commit()
         conn.close()
@@ -59,17 +66,14 @@ class DatabaseManager(object):
     def add_scenarios(self, scenario_db, systems, update=False):
         """Add used scenarios to DB so that we don't collect data on duplicated scenarios.
         """
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-        for sid, scenario in scenario_db.scenarios_map.iteritems():
-            for agent_type in systems.keys():
-                if update:
-                    c.execute('''INSERT OR IGNORE INTO scenario VALUES (?,?, "[]", "[]")''', (sid, agent_type))
-                else:
-                    c.execute('''INSERT INTO scenario VALUES (?,?, "[]", "[]")''', (sid, agent_type))
-
-        conn.commit()
-        conn.close()
+        conn = self.pool.get()
+        rows = [(sid, agent_type) for sid in scenario_db.scenarios_map for agent_type in systems.keys()]
+        with conn:
+            if update:
+                conn.executemany('''INSERT OR IGNORE INTO scenario VALUES (?,?, "[]", "[]")''', rows)
+            else:
+                conn.executemany('''INSERT INTO scenario VALUES (?,?, "[]", "[]")''', rows)
+        self.pool.put(conn)
 
 
 
@@ -92,14 +96,17 @@ class Backend(object):
                              Messages,
                              active_system=app.config.get('active_system'),
                              active_scenario=app.config.get('active_scenario'),
+                             controller_scheduler=app.config.get('controller_scheduler'),
+                             event_pusher=app.config.get('event_pusher'),
                              )
             backend = g._backend
         return backend
 
-    def __init__(self, params, schema, scenario_db, systems, sessions, controller_map, num_chats_per_scenario, messages=Messages, active_system=None, active_scenario=None):
+    def __init__(self, params, schema, scenario_db, systems, sessions, controller_map, num_chats_per_scenario, messages=Messages, active_system=None, active_scenario=None, controller_scheduler=None, event_pusher=None):
         self.config = params
-        self.conn = sqlite3.connect(params["db"]["location"])
-        self.conn.row_factory = sqlite3.Row
+        # Connections are reused across requests; see close()
+        self.pool = ConnectionPool.get_pool(params["db"]["location"])
+        self.conn = self.pool.get()
 
         self.do_survey = True if "end_survey" in params.keys() and params["end_survey"] == 1 else False
         self.scenario_db = scenario_db
@@ -112,7 +119,12 @@ class Backend(object):
         self.active_scenario = active_scenario
         self.sessions = sessions
         self.controller_map = controller_map
+        # If set, controllers of bot chats are stepped in the background instead of on every poll
+        self.controller_scheduler = controller_scheduler
+        # If set, events are pushed to clients as they are added to the database
+        self.event_pusher = event_pusher
         self.num_chats_per_scenario = num_chats_per_scenario
+        self.scenario_index = ScenarioAllocationIndex.get_index(params["db"]["location"], self.conn, num_chats_per_scenario)
         self.logger = WebLogger.get_logger()
         self.messages = messages
 
@@ -257,20 +269,29 @@ class Backend(object):
             cursor.execute('''INSERT INTO chat VALUES (?,?,"",?,?,?)''', (chat_id, scenario_id, agent_ids, agents, now))
 
     def add_event_to_db(self, chat_id, event):
+        self.add_events_to_db(chat_id, [event])
+
+    def add_events_to_db(self, chat_id, events):
+        """Insert events of a chat in one transaction. A row that violates a
+        constraint is logged and skipped; the other rows are still inserted.
+        """
         def _create_row(chat_id, event):
             data = event.data
             if event.action in ('select', 'offer', 'eval'):
                 data = json.dumps(event.data)
             return chat_id, event.action, event.agent, event.time, data, event.start_time, json.dumps(event.metadata)
 
-        try:
-            with self.conn:
-                cursor = self.conn.cursor()
+        with self.conn:
+            cursor = self.conn.cursor()
+            for event in events:
                 row = _create_row(chat_id, event)
-
-                cursor.execute('''INSERT INTO event VALUES (?,?,?,?,?,?,?)''', row)
-        except sqlite3.IntegrityError:
-            print("WARNING: Rolled back transaction")
+                try:
+                    # A failed statement is undone on its own, not the transaction
+                    cursor.execute('''INSERT INTO event VALUES (?,?,?,?,?,?,?)''', row)
+                except sqlite3.IntegrityError as e:
+                    self.logger.warning("Failed to add event of chat {} ({}): {}".format(chat_id, e, row))
+        if self.event_pusher is not None:
+            self.event_pusher.push_events(self, chat_id)
 
     def attempt_join_chat(self, userid):
         def _init_controller(my_index, partner_type, scenario, chat_id):
@@ -325,6 +346,8 @@ class Backend(object):
             self.controller_map[userid] = controller
 
             self.sessions[userid] = my_session
+            if self.controller_scheduler is not None:
+                self.controller_scheduler.schedule(controller)
 
             self._update_user(cursor, userid,
                               status=Status.Chat,
@@ -343,60 +366,26 @@ class Backend(object):
             userids = [r[0] for r in cursor.fetchall()]
             return userids
 
-        def _choose_scenario_and_partner_type(cursor):
-            # for each scenario, get number of complete dialogues per agent type
+        def _choose_scenario_and_partner_type():
             all_partners = self.systems.keys() if not self.active_system else [self.active_system]
 
             if self.active_scenario is not None:
                 return self.scenario_db.scenarios_list[self.active_scenario], np.random.choice(all_partners)
 
-            cursor.execute('''SELECT * FROM scenario''')
-            db_scenarios = cursor.fetchall()
-            scenario_dialogues = defaultdict(lambda: defaultdict(int))
-
-            for (scenario_id, partner_type, complete, active) in db_scenarios:
-                complete = set(json.loads(complete))
-                active = set(json.loads(active))
-                # map from scenario ID -> partner type -> # of completed dialogues with that partner
-                if scenario_id not in scenario_dialogues:
-                    scenario_dialogues[scenario_id] = {}
-
-                scenario_dialogues[scenario_id][partner_type] = len(complete) + len(active)
-
-            # find "active" scenarios (scenarios for which at least one agent type has no completed or active dialogues)
-            active_scenarios = defaultdict(list)
-            for sid in scenario_dialogues.keys():
-                for partner_type in all_partners:
-                    if scenario_dialogues[sid][partner_type] < self.num_chats_per_scenario[partner_type]:
-                        active_scenarios[sid].append(partner_type)
-
-            # if all scenarios have at least one dialogue per agent type (i.e. no active scenarios),
-            # just select a random scenario and agent type
-            if len(active_scenarios.keys()) == 0:
-                sid = np.random.choice(scenario_dialogues.keys())
-                p = np.random.choice(all_partners)
-                return self.scenario_db.get(sid), p
-
-            # otherwise, select a random active scenario and an agent type that it's missing
-            sid = np.random.choice(active_scenarios.keys())
-            p = np.random.choice(active_scenarios[sid])
+            # select a random scenario and a partner type that it still needs chats with
+            sid, p = self.scenario_index.choose(all_partners)
             return self.scenario_db.get(sid), p
 
         def _update_used_scenarios(scenario_id, partner_type, chat_id):
-            cursor.execute(
-                '''SELECT active FROM scenario WHERE scenario_id=? AND partner_type=?''',
-                (scenario_id, partner_type))
-            active_set = set(json.loads(cursor.fetchone()[0]))
-            active_set.add(chat_id)
-            cursor.execute('''UPDATE scenario SET active=? WHERE scenario_id=? AND partner_type=?''',
-                           (json.dumps(list(active_set)), scenario_id, partner_type))
+            self.conn.on_commit(self.scenario_index.add_active_chat, scenario_id, partner_type, chat_id)
 
+        self.scenario_index.persist(self.conn)
         try:
             with self.conn:
                 cursor = self.conn.cursor()
                 others = _get_other_waiting_users(cursor, userid)
 
-                scenario, partner_type = _choose_scenario_and_partner_type(cursor)
+                scenario, partner_type = _choose_scenario_and_partner_type()
                 scenario_id = scenario.uuid
                 #my_index = np.random.choice([0, 1])
                 # TODO: hack for buyer/seller
@@ -443,16 +432,7 @@ class Backend(object):
             print("WARNING: Rolled back transaction")
 
     def decrement_active_chats(self, cursor, scenario_id, partner_type, chat_id):
-        cursor.execute('''SELECT active FROM scenario WHERE scenario_id=? AND partner_type=?''',
-                       (scenario_id, partner_type))
-        active_set = set(json.loads(cursor.fetchone()[0]))
-        if chat_id in active_set:
-            active_set.remove(chat_id)
-
-        cursor.execute(
-            '''UPDATE scenario SET active=? WHERE scenario_id=? AND partner_type=?''',
-            (json.dumps(list(active_set)), scenario_id, partner_type)
-        )
+        cursor.connection.on_commit(self.scenario_index.remove_active_chat, scenario_id, partner_type, chat_id)
 
     def user_finished(self, cursor, userid, message=None):
         if message is None:
@@ -521,7 +501,7 @@ class Backend(object):
         return False
 
     def close(self):
-        self.conn.close()
+        self.pool.put(self.conn)
         self.conn = None
 
     def connect(self, userid):
@@ -533,6 +513,17 @@ class Backend(object):
         except sqlite3.IntegrityError:
             print("WARNING: Rolled back transaction")
 
+    def refresh_connections(self, userids):
+        """Mark users with an open push socket as connected.
+        """
+        now = current_timestamp_in_seconds()
+        try:
+            with self.conn:
+                self.conn.executemany('''UPDATE active_user SET connected_status=1, connected_timestamp=? WHERE name=?''',
+                                      [(now, userid) for userid in userids])
+        except sqlite3.IntegrityError:
+            print("WARNING: Rolled back transaction")
+
     def create_user_if_not_exists(self, username):
         with self.conn:
             cursor = self.conn.cursor()
@@ -835,7 +826,8 @@ class Backend(object):
             # fail silently - this just means that receive is called between the time that the chat has ended and the
             # time that the page is refreshed
             return None
-        controller.step(self)
+        if self.controller_scheduler is None:
+            controller.step(self)
         session = self._get_session(userid)
         return session.poll_inbox()
 
@@ -867,6 +859,9 @@ class Backend(object):
             # (but before the chat has ended)
             return None
         controller.step(self)
+        if self.controller_scheduler is not None:
+            # The partner may respond to this event
+            self.controller_scheduler.schedule(controller)
         # self.add_event_to_db(controller.get_chat_id(), event)
 
     def submit_survey(self, userid, data):
@@ -876,16 +871,7 @@ class Backend(object):
         def _update_scenario_db(chat_id, partner_type):
             cursor.execute('''SELECT scenario_id FROM chat WHERE chat_id=?''', (chat_id,))
             scenario_id = cursor.fetchone()[0]
-            # make sure that the # of completed dialogues for the scenario is only updated once if both agents are human
-            cursor.execute('''SELECT complete FROM scenario WHERE scenario_id=? AND partner_type=?''',
-                           (scenario_id, partner_type))
-            complete_set = set(json.loads(cursor.fetchone()[0]))
-            complete_set.add(chat_id)
-            cursor.execute('''
-                UPDATE scenario
-                SET complete=?
-                WHERE scenario_id=? AND partner_type=?''',
-                           (json.dumps(list(complete_set)), scenario_id, partner_type))
+            self.conn.on_commit(self.scenario_index.add_complete_chat, scenario_id, partner_type, chat_id)
 
         try:
             with self.conn:
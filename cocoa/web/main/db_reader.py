@@ -2,9 +2,8 @@ import sqlite3
 from datetime import datetime
 import json
 
-from cocoa.core.dataset import Example
+from cocoa.core.dataset import Example, write_examples
 from cocoa.core.event import Event
-from cocoa.core.util import write_json
 
 class DatabaseReader(object):
     date_fmt = '%Y-%m-%d %H-%M-%S'
@@ -154,7 +153,8 @@ class DatabaseReader(object):
 
         Args:
             scenario_db (ScenarioDB): retrieve Scenario by logged uuid.
-            json_path (str): output path.
+            json_path (str): output path; chats are streamed one per line
+                if it is a JSON lines file (.jsonl).
             uids (list): if provided, only log chats from these users.
 
         """
@@ -175,11 +175,11 @@ class DatabaseReader(object):
                 agent_event[event.agent] += 1
             return agent_event[0] == 0 or agent_event[1] == 0
 
-        examples = []
-        for chat_id in ids:
-            ex = cls.get_chat_example(cursor, chat_id[0], scenario_db)
-            if ex is None or is_single_agent(ex):
-                continue
-            examples.append(ex)
+        def iter_chats():
+            for chat_id in ids:
+                ex = cls.get_chat_example(cursor, chat_id[0], scenario_db)
+                if ex is None or is_single_agent(ex):
+                    continue
+                yield ex
 
-        write_json([ex.to_dict() for ex in examples], json_path)
+        write_examples(iter_chats(), json_path)
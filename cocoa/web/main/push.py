@@ -0,0 +1,140 @@
+import time
+import itertools
+from collections import OrderedDict
+
+from flask import request
+from flask_socketio import join_room
+
+from utils import Status
+
+
+class EventPusher(object):
+    """Push chat events and status changes to clients over SocketIO.
+
+    A client emits `join` with its uid and the status of the page it is on,
+    and is added to the room of its uid. Events are pushed as they are added
+    to a chat: the backend calls `push_events` after logging them, which emits
+    the events in the inboxes of the chat's joined users to their rooms
+    (`chat_event`). The client acks each event by its `seq`; events not acked
+    when the user leaves are put back in the inbox, to be pushed again when it
+    rejoins or returned by the polling fallback. Controllers are stepped when
+    a user sends an event and by the ControllerScheduler for bots.
+
+    A background task does the rest of the work of the polling endpoints for
+    all joined users: every `check_interval` seconds it checks whether the
+    chat is still valid (or, for waiting users, tries to pair them) and emits
+    `status_change` to the user's room if the page should be reloaded. Joined
+    users are marked as connected at most once every `refresh_interval`
+    seconds, so the client only needs to poll as a fallback when the socket
+    is down.
+    """
+    def __init__(self, socketio, app, backend_class, check_interval=2., refresh_interval=30.):
+        self.socketio = socketio
+        self.app = app
+        self.backend_class = backend_class
+        self.check_interval = check_interval
+        self.refresh_interval = refresh_interval
+        # userid -> (sid, assumed_status, chat_id)
+        self.users = {}
+        self.sids = {}
+        # chat_id -> joined userids
+        self.chats = {}
+        # userid -> time its connection was last refreshed
+        self.refresh_times = {}
+        # userid -> seq -> pushed event not acked yet
+        self.unacked = {}
+        self.seq = itertools.count()
+        self.task = None
+
+    def register(self):
+        self.socketio.on_event('join', self.on_join)
+        self.socketio.on_event('ack', self.on_ack)
+        self.socketio.on_event('disconnect', self.on_disconnect)
+
+    def on_join(self, data):
+        userid = data['uid']
+        assumed_status = data.get('assumed_status', Status.Chat)
+        join_room(userid)
+        backend = self.backend_class.get_backend()
+        self.remove_user(backend, userid)
+        chat_id = None
+        if assumed_status == Status.Chat:
+            controller = backend.controller_map.get(userid)
+            if controller is not None:
+                chat_id = controller.get_chat_id()
+                self.chats.setdefault(chat_id, set()).add(userid)
+        self.users[userid] = (request.sid, assumed_status, chat_id)
+        self.sids[request.sid] = userid
+        self.refresh_times[userid] = time.time()
+        if chat_id is not None:
+            # Events received before joining (or not acked)
+            self.push_events(backend, chat_id)
+        if self.task is None:
+            self.task = self.socketio.start_background_task(self.run)
+
+    def on_ack(self, data):
+        userid = self.sids.get(request.sid)
+        if userid is not None:
+            self.unacked.get(userid, {}).pop(data['seq'], None)
+
+    def on_disconnect(self):
+        userid = self.sids.pop(request.sid, None)
+        if userid is not None and self.users.get(userid, (None,))[0] == request.sid:
+            self.remove_user(self.backend_class.get_backend(), userid)
+
+    def remove_user(self, backend, userid):
+        sid, assumed_status, chat_id = self.users.pop(userid, (None, None, None))
+        self.refresh_times.pop(userid, None)
+        unacked = self.unacked.pop(userid, None)
+        session = backend.sessions.get(userid)
+        if unacked and session is not None:
+            session.requeue(unacked.values())
+        if chat_id is not None:
+            userids = self.chats.get(chat_id, set())
+            userids.discard(userid)
+            if not userids:
+                self.chats.pop(chat_id, None)
+
+    def run(self):
+        while True:
+            self.socketio.sleep(self.check_interval)
+            with self.app.app_context():
+                self.check(self.backend_class.get_backend())
+
+    def check(self, backend):
+        users = self.users.items()
+        if not users:
+            return
+        now = time.time()
+        # Only write to the database when a connection is about to go stale
+        stale = [userid for userid, _ in users if now - self.refresh_times.get(userid, 0.) >= self.refresh_interval]
+        if stale:
+            backend.refresh_connections(stale)
+            for userid in stale:
+                self.refresh_times[userid] = now
+        changed = [userid for userid, (sid, assumed_status, chat_id) in users
+                   if self.status_changed(backend, userid, assumed_status)]
+        for userid in changed:
+            self.remove_user(backend, userid)
+            self.socketio.emit('status_change', {'uid': userid}, room=userid)
+
+    def push_events(self, backend, chat_id):
+        """Emit the events in the inboxes of the users of `chat_id` that joined.
+        """
+        for userid in list(self.chats.get(chat_id, ())):
+            session = backend.sessions.get(userid)
+            if session is None:
+                continue
+            unacked = self.unacked.setdefault(userid, OrderedDict())
+            event = session.poll_inbox()
+            while event is not None:
+                seq = next(self.seq)
+                unacked[seq] = event
+                data = backend.display_received_event(event)
+                self.socketio.emit('chat_event', dict(uid=userid, seq=seq, timestamp=event.time, **data), room=userid)
+                event = session.poll_inbox()
+
+    def status_changed(self, backend, userid, assumed_status):
+        if assumed_status == Status.Chat:
+            return not backend.is_chat_valid(userid)
+        return not backend.is_status_unchanged(userid, assumed_status)
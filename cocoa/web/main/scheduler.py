@@ -0,0 +1,135 @@
+import heapq
+import itertools
+import time
+
+import gevent
+from gevent.event import Event
+from gevent.pool import Pool
+
+from logger import WebLogger
+
+
+class ControllerScheduler(object):
+    """Step controllers of bot chats in the background.
+
+    Controllers are kept in a timer heap keyed by `Controller.next_step_time`,
+    i.e. the time at which one of their timed sessions may have an event ready.
+    A greenlet pops due controllers and steps them in a pool of `pool_size`
+    greenlets; after each step the controller is rescheduled (or dropped if
+    nothing is pending). Controllers of human-human chats are never
+    scheduled; bots without timing (e.g. in debug mode) are stepped every
+    `min_interval` seconds while it is their turn.
+
+    Call `schedule(controller)` whenever a controller may have new work, e.g.
+    when a chat with a bot is created or a human sends an event. If a step
+    fails (e.g. the database is locked), the error is logged and the
+    controller is retried after `error_interval` seconds.
+    """
+    def __init__(self, app, backend_class, pool_size=16, min_interval=0.1, error_interval=1., latency_window=1000):
+        self.app = app
+        self.backend_class = backend_class
+        self.pool = Pool(pool_size)
+        self.min_interval = min_interval
+        self.error_interval = error_interval
+        self.num_errors = 0
+        self.heap = []
+        self.counter = itertools.count()
+        # id(controller) -> scheduled time of its live heap entry
+        self.scheduled = {}
+        self.running = set()
+        self.wake = Event()
+        self.greenlet = None
+
+        self.num_steps = 0
+        self.latencies = []
+        self.latency_window = latency_window
+        self.max_latency = 0.
+
+    def start(self):
+        if self.greenlet is None:
+            self.greenlet = gevent.spawn(self.run)
+        return self
+
+    def schedule(self, controller, step_time=None):
+        """Schedule `controller` to be stepped at `step_time` (default: its next step time).
+        """
+        key = id(controller)
+        if key in self.running:
+            # Rescheduled when the current step finishes
+            return
+        if step_time is None:
+            step_time = controller.next_step_time()
+            if step_time is None:
+                return
+        scheduled_time = self.scheduled.get(key)
+        if scheduled_time is not None and scheduled_time <= step_time:
+            return
+        self.scheduled[key] = step_time
+        heapq.heappush(self.heap, (step_time, next(self.counter), controller))
+        self.wake.set()
+
+    def _pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            step_time, _, controller = heapq.heappop(self.heap)
+            key = id(controller)
+            # Skip entries superseded by an earlier schedule
+            if self.scheduled.get(key) != step_time:
+                continue
+            del self.scheduled[key]
+            self.running.add(key)
+            due.append(controller)
+        return due
+
+    def run(self):
+        while True:
+            now = time.time()
+            for controller in self._pop_due(now):
+                self.pool.spawn(self._step, controller)
+            timeout = self.heap[0][0] - now if self.heap else None
+            self.wake.clear()
+            self.wake.wait(timeout)
+
+    def _step(self, controller):
+        start_time = time.time()
+        interval = self.min_interval
+        try:
+            with self.app.app_context():
+                controller.step(self.backend_class.get_backend())
+        except Exception:
+            self.num_errors += 1
+            interval = self.error_interval
+            WebLogger.get_logger().exception("Failed to step controller of chat {}".format(controller.get_chat_id()))
+        finally:
+            self._record_latency(time.time() - start_time)
+            self.running.discard(id(controller))
+        try:
+            step_time = controller.next_step_time()
+        except Exception:
+            WebLogger.get_logger().exception("Failed to get next step time of chat {}".format(controller.get_chat_id()))
+            step_time = time.time()
+            interval = self.error_interval
+        if step_time is not None:
+            self.schedule(controller, max(step_time, time.time() + interval))
+
+    def _record_latency(self, latency):
+        self.num_steps += 1
+        self.max_latency = max(self.max_latency, latency)
+        self.latencies.append(latency)
+        if len(self.latencies) > self.latency_window:
+            self.latencies = self.latencies[-self.latency_window:]
+
+    def metrics(self):
+        """Queue depth and step latency (in seconds) over the last `latency_window` steps.
+        """
+        latencies = sorted(self.latencies)
+        n = len(latencies)
+        return {
+                'queue_depth': len(self.scheduled),
+                'running': len(self.running),
+                'num_steps': self.num_steps,
+                'num_errors': self.num_errors,
+                'mean_step_latency': sum(latencies) / n if n else 0.,
+                'p95_step_latency': latencies[min(n - 1, int(0.95 * n))] if n else 0.,
+                'max_step_latency': self.max_latency,
+                }
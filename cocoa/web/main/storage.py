@@ -0,0 +1,100 @@
+import sqlite3
+import threading
+
+class Connection(sqlite3.Connection):
+    """sqlite3 connection that runs callbacks after the current transaction commits.
+
+    Callbacks registered by `on_commit` are called (in order) after the next
+    `commit`, e.g. at the end of a `with conn:` block, and dropped on
+    `rollback`. Use them for in-memory state that must match the database.
+    """
+    def __init__(self, *args, **kwargs):
+        super(Connection, self).__init__(*args, **kwargs)
+        self.commit_callbacks = []
+
+    def on_commit(self, callback, *args):
+        self.commit_callbacks.append((callback, args))
+
+    def commit(self):
+        super(Connection, self).commit()
+        callbacks, self.commit_callbacks = self.commit_callbacks, []
+        for callback, args in callbacks:
+            callback(*args)
+
+    def rollback(self):
+        self.commit_callbacks = []
+        super(Connection, self).rollback()
+
+
+class ConnectionPool(object):
+    """Reusable sqlite3 connections to one database file.
+
+    Connections are opened in WAL mode so that the polling endpoints (readers)
+    do not block on the writer. A connection is handed out by `get` and
+    returned by `put`; the pool never blocks and creates a new connection if
+    all idle ones are in use. At most `max_idle` connections are kept open.
+    """
+    pools = {}
+    pools_lock = threading.Lock()
+
+    def __init__(self, db_file, max_idle=16, timeout=30.):
+        self.db_file = db_file
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get_pool(cls, db_file, **kwargs):
+        """Return the process-wide pool for `db_file`.
+        """
+        with cls.pools_lock:
+            if db_file not in cls.pools:
+                cls.pools[db_file] = cls(db_file, **kwargs)
+            return cls.pools[db_file]
+
+    @classmethod
+    def close_pools(cls):
+        with cls.pools_lock:
+            for pool in cls.pools.itervalues():
+                pool.close()
+            cls.pools = {}
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=self.timeout, check_same_thread=False, factory=Connection)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        # Durable at checkpoints; safe from corruption in WAL mode
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def get(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return self.connect()
+
+    def put(self, conn):
+        # Don't leak an unfinished transaction to the next user
+        conn.rollback()
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+
+def create_indexes(cursor):
+    """Create indexes for the lookups done by the polling endpoints.
+
+    `active_user(name)` is already indexed by its UNIQUE constraint.
+    """
+    cursor.execute('''CREATE INDEX IF NOT EXISTS active_user_status ON active_user (status, connected_status)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS event_chat_id ON event (chat_id)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS chat_chat_id ON chat (chat_id)''')
@@ -175,6 +175,7 @@ def index():
                                seconds_until_expiration=waiting_info.num_seconds,
                                waiting_message=waiting_info.message,
                                uid=userid(),
+                               push=app.config['user_params'].get('push_events', False),
                                title=app.config['task_title'],
                                icon=app.config['task_icon'])
     elif status == Status.Finished:
@@ -216,6 +217,7 @@ def index():
                                instructions=Markup(app.config['instructions']),
                                icon=app.config['task_icon'],
                                partner_kb=partner_kb,
+                               push=app.config['user_params'].get('push_events', False),
                                quit_enabled=app.config['user_params']['skip_chat_enabled'],
                                quit_after=app.config['user_params']['status_params']['chat']['num_seconds'] -
                                           app.config['user_params']['quit_after'])
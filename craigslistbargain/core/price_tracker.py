@@ -2,6 +2,7 @@ import math
 import re
 from collections import defaultdict
 from itertools import chain
+from weakref import WeakKeyDictionary
 
 from cocoa.core.entity import Entity, CanonicalEntity
 from cocoa.core.util import read_json, write_pickle, read_pickle
@@ -9,6 +10,37 @@ from cocoa.core.util import read_json, write_pickle, read_pickle
 from tokenizer import tokenize
 
 
+class KBContext(object):
+    '''
+    Values of a KB used by entity linking and price scaling: numbers in the
+    listing (probably specs, not prices), the list price and the parameters
+    of the price scaling. They only depend on the KB, so they are computed
+    once per KB (see `get_kb_context`).
+    '''
+    def __init__(self, kb):
+        self.numbers = PriceTracker.compute_kb_numbers(kb)
+        self.list_price = kb.facts['item']['Price']
+        self.price_range = PriceScaler.get_price_range(kb)
+        b, t = self.price_range
+        # NOTE: get_parameters asserts t != b; only fail when scaling
+        self.parameters = PriceScaler.get_parameters(b, t) if t != b else None
+
+    def get_parameters(self):
+        assert self.parameters is not None
+        return self.parameters
+
+_kb_contexts = WeakKeyDictionary()
+
+def get_kb_context(kb):
+    '''
+    Return the KBContext of `kb`, computed when the KB is first seen.
+    '''
+    try:
+        return _kb_contexts[kb]
+    except KeyError:
+        context = _kb_contexts[kb] = KBContext(kb)
+        return context
+
 class PriceScaler(object):
     @classmethod
     def get_price_range(cls, kb):
@@ -39,8 +71,7 @@ class PriceScaler(object):
     # TODO: this is operated on canonical entities, need to be consistent!
     def unscale_price(cls, kb, price):
         p = PriceTracker.get_price(price)
-        b, t = cls.get_price_range(kb)
-        w, c = cls.get_parameters(b, t)
+        w, c = get_kb_context(kb).get_parameters()
         assert w != 0
         p = (p - c) / w
         p = int(p)
@@ -51,8 +82,7 @@ class PriceScaler(object):
 
     @classmethod
     def _scale_price(cls, kb, p):
-        b, t = cls.get_price_range(kb)
-        w, c = cls.get_parameters(b, t)
+        w, c = get_kb_context(kb).get_parameters()
         p = w * p + c
         # Discretize to two digits
         p = float('{:.2f}'.format(p))
@@ -71,6 +101,7 @@ class PriceScaler(object):
 
 class PriceTracker(object):
     def __init__(self, model_path):
+        self.model_path = model_path
         self.model = read_pickle(model_path)
 
     @classmethod
@@ -100,12 +131,16 @@ class PriceTracker(object):
             return False
 
     def get_kb_numbers(self, kb):
+        return get_kb_context(kb).numbers
+
+    @classmethod
+    def compute_kb_numbers(cls, kb):
         title = tokenize(re.sub(r'[^\w0-9\.,]', ' ', kb.facts['item']['Title']))
         description = tokenize(re.sub(r'[^\w0-9\.,]', ' ', ' '.join(kb.facts['item']['Description'])))
         numbers = set()
         for token in chain(title, description):
             try:
-                numbers.add(float(self.process_string(token)))
+                numbers.add(float(cls.process_string(token)))
             except ValueError:
                 continue
         return numbers
@@ -114,8 +149,9 @@ class PriceTracker(object):
         tokens = ['<s>'] + raw_tokens + ['</s>']
         entity_tokens = []
         if kb:
-            kb_numbers = self.get_kb_numbers(kb)
-            list_price = kb.facts['item']['Price']
+            kb_context = get_kb_context(kb)
+            kb_numbers = kb_context.numbers
+            list_price = kb_context.list_price
         for i in xrange(1, len(tokens)-1):
             token = tokens[i]
             try:
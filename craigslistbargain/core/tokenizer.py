@@ -1,9 +1,10 @@
-import nltk
-nltk.download('punkt')
-from nltk.tokenize import word_tokenize
 import re
 import string
 
+from cocoa.core.tokenizer import word_tokenize, LRUCache
+
+_tokenize_cache = LRUCache()
+
 def is_number(s):
     if re.match(r'[.,0-9]+', s):
         return True
@@ -60,6 +61,9 @@ def tokenize(utterance, lowercase=True):
     #utterance = utterance.encode('utf-8')
     if lowercase:
         utterance = utterance.lower()
+    return list(_tokenize_cache.get(utterance, _tokenize))
+
+def _tokenize(utterance):
     # NLTK would not tokenize "xx..", so normalize dots to "...".
     utterance = re.sub(r'\.{2,}', '...', utterance)
     # Remove some weird chars
@@ -67,7 +71,7 @@ def tokenize(utterance, lowercase=True):
     tokens = word_tokenize(utterance)
     #tokens = stick_marker_sign(tokens)
     tokens = stick_dollar_sign(tokens)
-    return tokens
+    return tuple(tokens)
 
 def detokenize(tokens):
     new_tokens = []
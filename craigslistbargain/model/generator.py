@@ -1,18 +1,49 @@
 from cocoa.model.generator import Templates as BaseTemplates, Generator as BaseGenerator
+from cocoa.model.template_index import TemplateIndex
 
 from core.tokenizer import detokenize
 
 class Generator(BaseGenerator):
+    supports_template_store = True
+
+    def build_tfidf(self):
+        super(Generator, self).build_tfidf()
+        self.index = TemplateIndex(self.templates, self.tfidf_matrix, ('role', 'category', 'tag', 'context_tag'), 'logp')
+
+    def compile(self, path):
+        # Store rows grouped as in the index so that groups are zero-copy slices
+        super(Generator, self).compile(path, sort_by=self.index.keys)
+
     def get_filter(self, used_templates=None, category=None, role=None, context_tag=None, tag=None, **kwargs):
-        locs = [super(Generator, self).get_filter(used_templates)]
+        """Return (group, available) from `self.index`: the strictest of
+        all, role, role+category(+tag)(+context_tag) with templates not in
+        `used_templates`. If all templates are used, `used_templates` is
+        ignored (the strictest non-empty level is chosen).
+        """
         assert category and role
-        self._add_filter(locs, self.templates.role == role)
-        self._add_filter(locs, self.templates.category == category)
+        fields = (('role', role),)
+        levels = [(), fields]
+        fields += (('category', category),)
+        levels.append(fields)
         if tag:
-            self._add_filter(locs, self.templates.tag == tag)
+            fields += (('tag', tag),)
+            levels.append(fields)
         if context_tag:
-            self._add_filter(locs, self.templates.context_tag == context_tag)
-        return self._select_filter(locs)
+            fields += (('context_tag', context_tag),)
+            levels.append(fields)
+        group, available = self.index.select(levels, used_templates=used_templates)
+        if available is not None and not available.any():
+            # All templates are used: filter by role/category/... on all of them
+            group, available = self.index.select(levels)
+        return group, available
+
+    def retrieve(self, context, used_templates=None, topk=20, T=1., **kwargs):
+        group, available = self.get_filter(used_templates=used_templates, **kwargs)
+        if isinstance(context, list):
+            context = detokenize(context)
+        features = self.vectorizer.transform([context])
+        positions, logp = self.index.search(group, available, features, topk=topk)
+        return self.sample(logp, self.templates.take(positions), T)
 
 class Templates(BaseTemplates):
     def ambiguous_template(self, template):
@@ -239,7 +239,7 @@ def parse_dialogue(example, lexicon, counter):
 if __name__ == '__main__':
     import argparse
     from collections import defaultdict
-    from cocoa.core.dataset import read_examples
+    from cocoa.core.dataset import iter_examples
     from core.price_tracker import PriceTracker
     from core.scenario import Scenario
     from neural.preprocess import Preprocessor
@@ -251,7 +251,7 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     price_tracker = PriceTracker(args.price_tracker_model)
-    examples = read_examples(args.transcripts, args.max_examples, Scenario)
+    examples = iter_examples(args.transcripts, args.max_examples, Scenario)
     counter = {'total_lf': 0, 'unk_lf': 0, 'seqs': defaultdict(lambda : defaultdict(lambda : defaultdict(int)))}
     for example in examples:
         if Preprocessor.skip_example(example):
@@ -4,9 +4,10 @@ import numpy as np
 import pandas as pd
 from sklearn.feature_extraction.text import TfidfVectorizer
 
-from cocoa.core.dataset import read_examples
+from cocoa.core.dataset import read_examples, iter_examples
 from cocoa.core.entity import is_entity
 from cocoa.core.util import read_pickle, write_json
+from cocoa.model.template_index import TemplateIndex
 
 from core.scenario import Scenario
 from core.tokenizer import detokenize
@@ -29,20 +30,13 @@ class Templates(object):
         # TODO: context + response?
         documents = self.templates['context'].values
         self.tfidf_matrix = self.vectorizer.fit_transform(documents)
+        self.index = TemplateIndex(self.templates, self.tfidf_matrix, ('category', 'role', 'response_tag', 'context_tag'), 'count')
 
-    def search(self, context, category=None, role=None, context_tag=None, response_tag=None, used_templates=None, T=1.):
-        loc = self.get_filter(category=category, role=role, context_tag=context_tag, response_tag=response_tag, used_templates=used_templates).values
+    def search(self, context, category=None, role=None, context_tag=None, response_tag=None, used_templates=None, T=1., topk=20):
+        group, available = self.get_filter(category=category, role=role, context_tag=context_tag, response_tag=response_tag, used_templates=used_templates)
         features = self.vectorizer.transform([context])
-        scores = self.tfidf_matrix * features.T
-
-        scores = scores.todense()[loc]
-        rows = self.templates[loc]
-
-        scores = np.squeeze(np.array(scores))
-        ids = np.argsort(scores)[::-1][:20]
-        rows = rows.iloc[ids]
-        counts = rows['count'].values
-        return self.sample(counts, rows, T=T)
+        positions, counts = self.index.search(group, available, features, topk=topk)
+        return self.sample(counts, self.templates.iloc[positions], T=T)
 
     def softmax(self, scores, T=1.):
         exp_scores = np.exp((scores - np.max(scores)) / T)
@@ -55,31 +49,26 @@ class Templates(object):
         return template
 
     def get_filter(self, category=None, role=None, context_tag=None, response_tag=None, used_templates=None):
-        locs = []
-        loc = True
-        if used_templates:
-            loc = (~self.templates.id.isin(used_templates))
-            locs.append(loc)
+        """Return (group, available) from `self.index`: the strictest of
+        category+role(+response_tag)(+context_tag) with templates not in
+        `used_templates`.
+        """
         assert category and role
-        loc = loc & (self.templates.category == category) & (self.templates.role == role)
-        locs.append(loc)
+        fields = (('category', category), ('role', role))
+        levels = [fields]
         if response_tag:
-            loc = loc & (self.templates.response_tag == response_tag)
-            locs.append(loc)
+            fields += (('response_tag', response_tag),)
+            levels.append(fields)
         if context_tag:
-            loc = loc & (self.templates.context_tag == context_tag)
-            locs.append(loc)
-        for loc in locs[::-1]:
-            if np.sum(loc) > 0:
-                return loc
-        return locs[0]
+            fields += (('context_tag', context_tag),)
+            levels.append(fields)
+        return self.index.select(levels, used_templates=used_templates)
 
     def choose(self, used_templates=None, category=None, role=None, context_tag=None, response_tag=None, T=1.):
-        loc = self.get_filter(category=category, role=role, context_tag=context_tag, response_tag=response_tag, used_templates=used_templates)
-        templates = self.templates[loc]
-        if len(templates) > 0:
-            counts = templates['count'].values
-            return self.sample(counts, templates, T)
+        group, available = self.get_filter(category=category, role=role, context_tag=context_tag, response_tag=response_tag, used_templates=used_templates)
+        positions, counts = self.index.candidates(group, available)
+        if len(positions) > 0:
+            return self.sample(counts, self.templates.iloc[positions], T)
 
         print 'WARNING: no available templates found, returning a random one'
         counts = self.templates['count'].values
@@ -270,7 +259,11 @@ class TemplateExtractor(object):
             utterance_tags.append(tag)
 
     def extract_templates(self, transcripts_paths, max_examples=-1, ngram_N=4, log=None):
-        examples = read_examples(transcripts_paths, max_examples, Scenario)
+        # Examples are iterated again only to log them
+        if log:
+            examples = read_examples(transcripts_paths, max_examples, Scenario)
+        else:
+            examples = iter_examples(transcripts_paths, max_examples, Scenario)
 
         for example in examples:
             if Preprocessor.skip_example(example):
@@ -30,7 +30,11 @@ def get_data_generator(args, model_args, schema, test=False):
         cache=args.cache, ignore_cache=args.ignore_cache,
         num_context=model_args.num_context,
         batch_size=args.batch_size,
-        model=model_args.model)
+        model=model_args.model,
+        num_workers=args.preprocess_workers,
+        shard_size=args.preprocess_shard_size,
+        batching=args.batching,
+        max_batch_tokens=args.max_batch_tokens)
 
     return data_generator
 
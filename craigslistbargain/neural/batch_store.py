@@ -0,0 +1,175 @@
+'''
+Packed on-disk format of dialogue batches (output of DialogueBatcher.create_batch).
+'''
+
+import os
+import json
+import shutil
+import cPickle as pickle
+
+import numpy as np
+
+
+class PackedBatches(object):
+    '''
+    Dialogue batches packed in a directory of .npy files that are
+    memory-mapped read-only when opened, so that startup does not unpickle
+    every batch and processes training on the same data share its pages.
+
+    All token arrays (int32) are concatenated in `tokens.npy` and indexed by:
+        arrays.npy: (offset, ndim, rows, cols) of each array;
+        turns.npy: for each turn batch, the array ids of its stages (encoder
+            inputs, `num_context` encoder context utterances, decoder inputs,
+            targets);
+        dialogues.npy: for each dialogue batch, its first turn, number of
+            turns and the array ids of its KB context (category, title,
+            description).
+    `stats` (e.g. padding statistics) are kept in meta.json.
+    The `context_data` of each dialogue batch (tokens, kbs, uuids; Python
+    objects) is pickled in `context.bytes.npy` with offsets in
+    `context.offsets.npy` and unpickled only when the batch is built.
+    '''
+    VERSION = 1
+    KB_FIELDS = ('category', 'title', 'description')
+
+    def __init__(self, path, meta, tokens, arrays, turns, dialogues, context_bytes, context_offsets):
+        self.path = path
+        self.meta = meta
+        self.num_context = meta['num_context']
+        self.stats = meta.get('stats')
+        self.tokens = tokens
+        self.arrays = arrays
+        self.turns = turns
+        self.dialogues = dialogues
+        self.context_bytes = context_bytes
+        self.context_offsets = context_offsets
+
+    def __len__(self):
+        return len(self.dialogues)
+
+    @property
+    def num_turn_batches(self):
+        return len(self.turns)
+
+    @classmethod
+    def is_packed(cls, path):
+        return os.path.isdir(path) and os.path.exists(os.path.join(path, 'meta.json'))
+
+    @classmethod
+    def write(cls, path, dialogue_batches, num_context, stats=None):
+        '''
+        Write `dialogue_batches` (list of lists of batch dicts) to the
+        directory `path`. The directory is written under a temporary name and
+        renamed when complete.
+        '''
+        tokens, arrays, turns, dialogues, contexts = [], [], [], [], []
+        num_tokens = [0]
+
+        def add(array):
+            array = np.asarray(array, dtype=np.int32)
+            assert array.ndim in (1, 2)
+            rows = array.shape[0]
+            cols = array.shape[1] if array.ndim == 2 else 0
+            arrays.append((num_tokens[0], array.ndim, rows, cols))
+            tokens.append(array.ravel())
+            num_tokens[0] += array.size
+            return len(arrays) - 1
+
+        for batches in dialogue_batches:
+            kb_context = batches[0]['decoder_args']['context']
+            kb_ids = [add(kb_context[k]) for k in cls.KB_FIELDS]
+            dialogues.append([len(turns), len(batches)] + kb_ids)
+            for batch in batches:
+                encoder_args, decoder_args = batch['encoder_args'], batch['decoder_args']
+                assert len(encoder_args['context']) == num_context
+                turn = [add(encoder_args['inputs'])]
+                turn.extend(add(c) for c in encoder_args['context'])
+                turn.append(add(decoder_args['inputs']))
+                turn.append(add(decoder_args['targets']))
+                turns.append(turn)
+            contexts.append(pickle.dumps([batch['context_data'] for batch in batches], pickle.HIGHEST_PROTOCOL))
+
+        tmp_path = path + '.tmp'
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        def save(name, array):
+            np.save(os.path.join(tmp_path, name + '.npy'), np.ascontiguousarray(array))
+
+        num_stages = num_context + 3
+        save('tokens', np.concatenate(tokens) if tokens else np.zeros(0, dtype=np.int32))
+        save('arrays', np.array(arrays, dtype=np.int64).reshape(-1, 4))
+        save('turns', np.array(turns, dtype=np.int64).reshape(-1, num_stages))
+        save('dialogues', np.array(dialogues, dtype=np.int64).reshape(-1, 2 + len(cls.KB_FIELDS)))
+        context_offsets = np.zeros(len(contexts) + 1, dtype=np.int64)
+        context_offsets[1:] = np.cumsum([len(c) for c in contexts])
+        save('context.bytes', np.array(bytearray(''.join(contexts)), dtype=np.uint8))
+        save('context.offsets', context_offsets)
+
+        meta = {
+                'version': cls.VERSION,
+                'num_context': num_context,
+                'num_dialogue_batches': len(dialogues),
+                'num_turn_batches': len(turns),
+                'stats': stats,
+                }
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as fout:
+            json.dump(meta, fout)
+
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def open(cls, path):
+        '''
+        Open packed batches; arrays are memory-mapped read-only.
+        '''
+        with open(os.path.join(path, 'meta.json')) as fin:
+            meta = json.load(fin)
+        if meta.get('version') != cls.VERSION:
+            raise ValueError('Packed batches {} have version {}, expected {}'.format(path, meta.get('version'), cls.VERSION))
+
+        def load(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+        return cls(path, meta, load('tokens'), load('arrays'), load('turns'), load('dialogues'),
+                load('context.bytes'), load('context.offsets'))
+
+    def get_array(self, i):
+        offset, ndim, rows, cols = self.arrays[i]
+        # Plain ndarray view (Batch checks for np.ndarray)
+        if ndim == 1:
+            return np.asarray(self.tokens[offset:offset+rows])
+        return np.asarray(self.tokens[offset:offset+rows*cols]).reshape(rows, cols)
+
+    def get_context_data(self, d):
+        start, end = self.context_offsets[d], self.context_offsets[d+1]
+        return pickle.loads(self.context_bytes[start:end].tostring())
+
+    def get_dialogue_batch(self, d):
+        '''
+        Return the list of batch dicts (as created by DialogueBatcher) of the
+        `d`-th dialogue batch. Arrays are views of the memory-mapped tokens.
+        '''
+        dialogue = self.dialogues[d]
+        first_turn, num_turns = dialogue[0], dialogue[1]
+        kb_context = {k: self.get_array(i) for k, i in zip(self.KB_FIELDS, dialogue[2:])}
+        context_data = self.get_context_data(d)
+        batches = []
+        for t in xrange(num_turns):
+            ids = self.turns[first_turn + t]
+            batches.append({
+                'encoder_args': {
+                    'inputs': self.get_array(ids[0]),
+                    'context': [self.get_array(i) for i in ids[1:1+self.num_context]],
+                    },
+                'decoder_args': {
+                    'inputs': self.get_array(ids[-2]),
+                    'targets': self.get_array(ids[-1]),
+                    'context': kb_context,
+                    },
+                'context_data': context_data[t],
+                })
+        return batches
@@ -37,6 +37,8 @@ class Batch(object):
 
         self.lengths, sorted_ids = self.sort_by_length(self.encoder_inputs)
         self.tgt_lengths, _ = self.sort_by_length(self.decoder_inputs)
+        # Row i of the batch is example order[i] of the input
+        self.order = sorted_ids if sort_by_length else np.arange(self.size)
         if sort_by_length:
             for k, v in self.context_data.iteritems():
                 if v is not None:
@@ -5,7 +5,7 @@ import onmt.io
 from onmt.Utils import aeq, use_gpu
 
 from cocoa.core.entity import is_entity
-from cocoa.neural.generator import Generator, Sampler
+from cocoa.neural.generator import Generator, BatchedBeamGenerator, Sampler
 
 from symbols import markers, category_markers, sequence_markers
 from utterance import UtteranceBuilder
@@ -25,14 +25,14 @@ class LFSampler(Sampler):
                     or w in (vocab.UNK, '</sum>', '<slot>', '</slot>'))])
         self.actions = map(self.vocab.to_ind, actions)
 
-    def generate_batch(self, batch, gt_prefix=1, enc_state=None):
+    def generate_batch(self, batch, gt_prefix=1, enc_state=None, memory_cache=None):
         # This is to ensure we can stop at EOS for stateful models
         assert batch.size == 1
 
         # (1) Run the encoder on the src.
         lengths = batch.lengths
         dec_states, enc_memory_bank = self._run_encoder(batch, enc_state)
-        memory_bank = self._run_attention_memory(batch, enc_memory_bank)
+        memory_bank = self._run_attention_memory(batch, enc_memory_bank, memory_cache)
 
         # (1.1) Go over forced prefix.
         inp = batch.decoder_inputs[:gt_prefix]
@@ -102,7 +102,8 @@ def get_generator(model, vocab, scorer, args, model_args):
                                 max_length=args.max_length,
                                 cuda=use_gpu(args))
     else:
-        generator = Generator(model, vocab,
+        generator_class = BatchedBeamGenerator if args.batched_beam else Generator
+        generator = generator_class(model, vocab,
                               beam_size=args.beam_size,
                               n_best=args.n_best,
                               max_length=args.max_length,
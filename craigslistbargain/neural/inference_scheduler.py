@@ -0,0 +1,151 @@
+import time
+import threading
+import numpy as np
+
+from batcher import Batch, pad_list_to_array
+from symbols import markers
+
+
+class InferenceRequest(object):
+    """A pending generate() call from one session.
+    """
+    def __init__(self, encoder_args, decoder_args, context_data):
+        self.encoder_args = encoder_args
+        self.decoder_args = decoder_args
+        self.context_data = context_data
+        self.wake = threading.Event()
+        self.leader = False
+        self.finished = False
+        self.output = None
+        self.error = None
+
+
+class InferenceScheduler(object):
+    """
+    Collects generate() calls from concurrent sessions of one system and runs
+    them through the generator as a single padded batch.
+
+    At any time one waiting request is the leader: it waits up to |window|
+    seconds (or until |max_batch_size| requests are queued), runs one
+    `generate_batch` on the queued requests and hands each session its own row
+    of the output. If requests are left in the queue, the oldest one becomes
+    the next leader.
+
+    Requests must come from different threads (or greenlets with gevent
+    monkey-patching); a single caller simply gets a batch of size 1.
+    """
+    def __init__(self, generator, vocab, kb_pad, num_context, window=0.01, max_batch_size=32,
+            gt_prefix=1, cuda=False):
+        self.generator = generator
+        self.vocab = vocab
+        self.pad = vocab.to_ind(markers.PAD)
+        self.kb_pad = kb_pad
+        self.num_context = num_context
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.gt_prefix = gt_prefix
+        self.cuda = cuda
+
+        self.lock = threading.Lock()
+        self.full = threading.Condition(self.lock)
+        self.queue = []
+        self.leader_active = False
+
+    def generate(self, encoder_args, decoder_args, context_data):
+        """Generate a response for one dialogue (batch size 1 args).
+
+        Returns:
+            output of `generate_batch` restricted to this dialogue.
+
+        """
+        request = InferenceRequest(encoder_args, decoder_args, context_data)
+        with self.lock:
+            self.queue.append(request)
+            if not self.leader_active:
+                self.leader_active = True
+                request.leader = True
+            elif len(self.queue) >= self.max_batch_size:
+                self.full.notify()
+
+        while not request.finished:
+            if request.leader:
+                self._run_next_batch()
+            else:
+                request.wake.wait()
+                request.wake.clear()
+
+        if request.error is not None:
+            raise request.error
+        return request.output
+
+    def _run_next_batch(self):
+        with self.lock:
+            deadline = time.time() + self.window
+            while len(self.queue) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.full.wait(remaining)
+            requests = self.queue[:self.max_batch_size]
+            self.queue = self.queue[self.max_batch_size:]
+
+        self._run(requests)
+
+        with self.lock:
+            if self.queue:
+                leader = self.queue[0]
+                leader.leader = True
+                leader.wake.set()
+            else:
+                self.leader_active = False
+
+    def _get_length(self, seq):
+        for i, x in enumerate(seq):
+            if x == self.pad:
+                return i
+        return len(seq)
+
+    def _stack(self, arrays, pad):
+        """Pad a list of (1, seq_len) arrays into one (batch_size, max_seq_len) array.
+        """
+        return pad_list_to_array([a[0] for a in arrays], pad, np.int32)
+
+    def _create_batch(self, requests):
+        encoder_args = {
+                'inputs': self._stack([r.encoder_args['inputs'] for r in requests], self.pad),
+                'context': [self._stack([r.encoder_args['context'][i] for r in requests], self.pad)
+                    for i in xrange(self.num_context)],
+                }
+        decoder_args = {
+                'inputs': self._stack([r.decoder_args['inputs'] for r in requests], self.pad),
+                'targets': self._stack([r.decoder_args['targets'] for r in requests], self.pad),
+                'context': {
+                    'category': np.concatenate([r.decoder_args['context']['category'] for r in requests]),
+                    'title': self._stack([r.decoder_args['context']['title'] for r in requests], self.kb_pad),
+                    'description': self._stack([r.decoder_args['context']['description'] for r in requests], self.kb_pad),
+                    },
+                }
+        context_data = {k: [v for r in requests for v in r.context_data[k]]
+                for k in requests[0].context_data}
+        # Requests are already sorted by encoder length
+        return Batch(encoder_args, decoder_args, context_data, self.vocab,
+                sort_by_length=False, num_context=self.num_context, cuda=self.cuda)
+
+    def _select(self, output, i):
+        return {k: [output[k][i]] for k in ('predictions', 'scores', 'attention', 'gold_score')}
+
+    def _run(self, requests):
+        # The encoder packs padded sequences, which requires decreasing lengths
+        requests = sorted(requests, key=lambda r: self._get_length(r.encoder_args['inputs'][0]), reverse=True)
+        try:
+            batch = self._create_batch(requests)
+            output = self.generator.generate_batch(batch, gt_prefix=self.gt_prefix)
+            for i, request in enumerate(requests):
+                request.output = self._select(output, i)
+        except Exception as e:
+            for request in requests:
+                request.error = e
+        finally:
+            for request in requests:
+                request.finished = True
+                request.wake.set()
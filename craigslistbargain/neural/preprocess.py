@@ -6,8 +6,13 @@ import random
 import re
 import time
 import os
+import glob
+import json
+import shutil
+import hashlib
 import numpy as np
 from itertools import izip
+from multiprocessing import Pool
 
 from cocoa.core.util import read_pickle, write_pickle, read_json
 from cocoa.core.entity import Entity, CanonicalEntity, is_entity
@@ -16,6 +21,7 @@ from cocoa.model.vocab import Vocabulary
 from core.price_tracker import PriceTracker, PriceScaler
 from core.tokenizer import tokenize
 from batcher import DialogueBatcherFactory, Batch
+from batch_store import PackedBatches
 from symbols import markers
 from vocab_builder import create_mappings
 from neural import make_model_mappings
@@ -30,6 +36,26 @@ category_to_marker = {
         }
 
 
+# Bump when the output of Preprocessor.preprocess changes (tokenization, entity
+# linking, filtering) so that cached dialogues are recomputed.
+PREPROCESS_VERSION = 1
+
+def digest(*objs):
+    '''
+    md5 of JSON-serializable objects.
+    '''
+    h = hashlib.md5()
+    for obj in objs:
+        h.update(json.dumps(obj, sort_keys=True))
+    return h.hexdigest()
+
+def file_digest(path):
+    h = hashlib.md5()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(1 << 20), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
 def price_filler(x):
     return x == '<price>'
 
@@ -402,28 +428,66 @@ class Preprocessor(object):
                 dialogues.append(d)
         return dialogues
 
+    def options(self):
+        '''
+        Everything besides the examples that determines the output of `preprocess`.
+        '''
+        lexicon_path = getattr(self.lexicon, 'model_path', None)
+        return {
+                'version': PREPROCESS_VERSION,
+                'entity_forms': self.entity_forms,
+                'model': self.model,
+                'lexicon': file_digest(lexicon_path) if lexicon_path else type(self.lexicon).__name__,
+                }
+
+
+# Per-process state of the preprocessing workers, set by init_preprocess_worker.
+worker_preprocessor = None
+
+def init_preprocess_worker(preprocessor):
+    global worker_preprocessor
+    worker_preprocessor = preprocessor
+
+def preprocess_shard(examples):
+    return worker_preprocessor.preprocess(examples)
+
 class DataGenerator(object):
+    '''
+    Preprocessed dialogues are cached in shards of about `shard_size`
+    examples, keyed by a hash of the examples and the preprocessing options,
+    so only shards whose examples or options changed are reprocessed (in
+    `num_workers` processes). Examples are assigned to shards by a hash of
+    their ex_id, so adding, removing or editing an example only changes its
+    own shard (unless the number of shards changes). Batches are cached per fold, keyed by the
+    shard keys, the vocab and the batching options, in the packed format of
+    `PackedBatches` (memory-mapped; `Batch` objects are built lazily).
+    '''
     def __init__(self, train_examples, dev_examples, test_examples, preprocessor,
             schema, mappings_path=None, cache='.cache',
             ignore_cache=False, num_context=1, batch_size=1,
-            model='seq2seq'):
+            model='seq2seq', num_workers=1, shard_size=1000,
+            batching='fixed', max_batch_tokens=None):
         examples = {'train': train_examples, 'dev': dev_examples, 'test': test_examples}
+        self.examples = {k: v for k, v in examples.iteritems() if v}
         self.num_examples = {k: len(v) if v else 0 for k, v in examples.iteritems()}
         self.num_context = num_context
         self.model = model
+        self.preprocessor = preprocessor
+        self.num_workers = num_workers
+        self.shard_size = shard_size
+        self.batching = batching
+        self.max_batch_tokens = max_batch_tokens
+        if batching == 'tokens':
+            assert max_batch_tokens > 0
 
         self.cache = cache
         self.ignore_cache = ignore_cache
-        if (not os.path.exists(cache)) or ignore_cache:
-            # NOTE: each dialogue is made into two examples from each agent's perspective
-            self.dialogues = {k: preprocessor.preprocess(v)  for k, v in examples.iteritems() if v}
-
-            for fold, dialogues in self.dialogues.iteritems():
-                print '%s: %d dialogues out of %d examples' % (fold, len(dialogues), self.num_examples[fold])
-        else:
-            self.dialogues = {k: None  for k, v in examples.iteritems() if v}
-            print 'Using cached data from', cache
+        options_key = digest(preprocessor.options())
+        self.shard_keys = {k: self.get_shard_keys(v, options_key) for k, v in self.examples.iteritems()}
+        # Loaded on demand (see get_dialogues)
+        self.dialogues = {k: None for k in self.examples}
 
+        self.mappings_path = mappings_path
         self.mappings = self.load_mappings(model, mappings_path, schema, preprocessor)
         self.textint_map = TextIntMap(self.mappings['utterance_vocab'], preprocessor)
 
@@ -436,13 +500,86 @@ class DataGenerator(object):
                         kb_pad=self.mappings['kb_vocab'].to_ind(markers.PAD),
                         mappings=self.mappings, num_context=num_context)
 
-        self.batches = {k: self.create_batches(k, dialogues, batch_size) for k, dialogues in self.dialogues.iteritems()}
+        self.batches = {k: self.create_batches(k, batch_size) for k in self.examples}
+
+    def get_shards(self, examples):
+        '''
+        Split `examples` into non-empty shards by a stable hash of ex_id;
+        examples in a shard are sorted by ex_id.
+        '''
+        num_shards = max(1, (len(examples) + self.shard_size - 1) / self.shard_size)
+        shards = [[] for _ in xrange(num_shards)]
+        for ex in examples:
+            h = int(hashlib.md5(unicode(ex.ex_id).encode('utf-8')).hexdigest(), 16)
+            shards[h % num_shards].append(ex)
+        return [sorted(shard, key=lambda ex: ex.ex_id) for shard in shards if shard]
+
+    def get_shard_keys(self, examples, options_key):
+        return [digest(options_key, [ex.to_dict() for ex in shard]) for shard in self.get_shards(examples)]
+
+    def shard_path(self, key):
+        return os.path.join(self.cache, 'dialogues', '%s.pkl' % key)
+
+    def prune_shards(self):
+        '''
+        Remove cached shards of other data or options (of any fold).
+        '''
+        keys = set(key for keys in self.shard_keys.itervalues() for key in keys)
+        for path in glob.glob(self.shard_path('*')):
+            if os.path.basename(path)[:-len('.pkl')] not in keys:
+                os.remove(path)
+
+    def get_dialogues(self, name):
+        '''
+        Return preprocessed dialogues of fold `name`, reading cached shards
+        and preprocessing the others.
+        '''
+        if self.dialogues[name] is not None:
+            return self.dialogues[name]
+
+        shards = self.get_shards(self.examples[name])
+        keys = self.shard_keys[name]
+        shard_dialogues = [None] * len(shards)
+        missing = []
+        for i, key in enumerate(keys):
+            if os.path.exists(self.shard_path(key)) and not self.ignore_cache:
+                shard_dialogues[i] = read_pickle(self.shard_path(key))
+            else:
+                missing.append(i)
+
+        if missing:
+            print 'Preprocessing %d/%d shards of %s' % (len(missing), len(shards), name)
+            start_time = time.time()
+            if self.num_workers > 1 and len(missing) > 1:
+                pool = Pool(min(self.num_workers, len(missing)), initializer=init_preprocess_worker,
+                        initargs=(self.preprocessor,))
+                results = pool.map(preprocess_shard, [shards[i] for i in missing])
+                pool.close()
+                pool.join()
+            else:
+                results = [self.preprocessor.preprocess(shards[i]) for i in missing]
+            shard_dir = os.path.join(self.cache, 'dialogues')
+            if not os.path.isdir(shard_dir):
+                os.makedirs(shard_dir)
+            for i, dialogues in izip(missing, results):
+                write_pickle(dialogues, self.shard_path(keys[i]))
+                shard_dialogues[i] = dialogues
+            print '[%d s]' % (time.time() - start_time)
+        else:
+            print 'Using cached dialogues of %s from %s' % (name, self.cache)
+        self.prune_shards()
+
+        # NOTE: each dialogue is made into two examples from each agent's perspective
+        dialogues = [d for ds in shard_dialogues for d in ds]
+        print '%s: %d dialogues out of %d examples' % (name, len(dialogues), self.num_examples[name])
+        self.dialogues[name] = dialogues
+        return dialogues
 
     def load_mappings(self, model_type, mappings_path, schema, preprocessor):
         vocab_path = os.path.join(mappings_path, 'vocab.pkl')
         if not os.path.exists(vocab_path):
             print 'Vocab not found at', vocab_path
-            mappings = create_mappings(self.dialogues['train'], schema,
+            mappings = create_mappings(self.get_dialogues('train'), schema,
                 preprocessor.entity_forms.values())
             write_pickle(mappings, vocab_path)
             print('Wrote mappings to {}.'.format(vocab_path))
@@ -471,6 +608,8 @@ class DataGenerator(object):
         return len(d.turns[0])
 
     def create_dialogue_batches(self, dialogues, batch_size):
+        if self.batching == 'tokens':
+            return self.create_token_budget_batches(dialogues, self.max_batch_tokens)
         dialogue_batches = []
         dialogues.sort(key=lambda d: self.dialogue_sort_score(d))
         N = len(dialogues)
@@ -483,42 +622,103 @@ class DataGenerator(object):
             start = end
         return dialogue_batches
 
+    def dialogue_shape(self, d):
+        '''
+        (number of turns, max utterance length over all turns and stages)
+        '''
+        lengths = [len(turn) for turns in d.turns for turn in turns]
+        return len(d.turns[0]), max(lengths) if lengths else 0
+
+    def create_token_budget_batches(self, dialogues, max_tokens):
+        '''
+        Bucket dialogues by (number of turns, max utterance length) and
+        group them so that a batch padded to its largest dialogue has at most
+        `max_tokens` tokens per stage: batch size * max turns * max length
+        (a dialogue exceeding the budget makes its own batch).
+        '''
+        shapes = {id(d): self.dialogue_shape(d) for d in dialogues}
+        dialogues.sort(key=lambda d: shapes[id(d)])
+        groups = []
+        group, max_turns, max_len = [], 0, 0
+        for d in dialogues:
+            num_turns, length = shapes[id(d)]
+            new_turns, new_len = max(max_turns, num_turns), max(max_len, length)
+            if group and (len(group) + 1) * new_turns * new_len > max_tokens:
+                groups.append(group)
+                group, new_turns, new_len = [], num_turns, length
+            group.append(d)
+            max_turns, max_len = new_turns, new_len
+        if group:
+            groups.append(group)
+        return [self.dialogue_batcher.create_batch(group) for group in groups]
+
+    def padding_stats(self, dialogue_batches):
+        '''
+        Number of tokens and of padded tokens (array sizes) in the encoder
+        inputs and decoder targets of all turn batches.
+        '''
+        pad = self.mappings['utterance_vocab'].to_ind(markers.PAD)
+        num_tokens, num_padded = 0, 0
+        for batches in dialogue_batches:
+            for batch in batches:
+                for array in (batch['encoder_args']['inputs'], batch['decoder_args']['targets']):
+                    num_tokens += int(np.count_nonzero(array != pad))
+                    num_padded += array.size
+        return {'tokens': num_tokens, 'padded_tokens': num_padded}
+
     def get_all_responses(self, name):
-        dialogues = self.dialogues[name]
+        dialogues = self.get_dialogues(name)
         responses = {'seller': [], 'buyer': []}
         for dialogue in dialogues:
             for turn, role in izip(dialogue.token_turns, dialogue.roles):
                 responses[role].extend(turn)
         return responses
 
-    def create_batches(self, name, dialogues, batch_size):
+    def batches_key(self, name, batch_size):
+        return digest(self.shard_keys[name], self.num_context, batch_size, self.model,
+                self.batching, self.max_batch_tokens if self.batching == 'tokens' else None,
+                file_digest(os.path.join(self.mappings_path, 'vocab.pkl')))
+
+    def create_batches(self, name, batch_size):
         if not os.path.isdir(self.cache):
             os.makedirs(self.cache)
-        cache_file = os.path.join(self.cache, '%s_batches.pkl' % name)
-        if (not os.path.exists(cache_file)) or self.ignore_cache:
+        cache_path = os.path.join(self.cache, '%s_batches.%s' % (name, self.batches_key(name, batch_size)))
+        if (not PackedBatches.is_packed(cache_path)) or self.ignore_cache:
+            # Remove batches cached with other data or options
+            for path in glob.glob(os.path.join(self.cache, '%s_batches*' % name)):
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            dialogues = self.get_dialogues(name)
             for dialogue in dialogues:
                 dialogue.convert_to_int()
 
             dialogue_batches = self.create_dialogue_batches(dialogues, batch_size)
-            print 'Write %d batches to cache %s' % (len(dialogue_batches), cache_file)
-            start_time = time.time()
-            write_pickle(dialogue_batches, cache_file)
-            print '[%d s]' % (time.time() - start_time)
-        else:
+            print 'Write %d batches to cache %s' % (len(dialogue_batches), cache_path)
             start_time = time.time()
-            dialogue_batches = read_pickle(cache_file)
-            print 'Read %d batches from cache %s' % (len(dialogue_batches), cache_file)
+            PackedBatches.write(cache_path, dialogue_batches, self.num_context,
+                    stats=self.padding_stats(dialogue_batches))
             print '[%d s]' % (time.time() - start_time)
+        start_time = time.time()
+        dialogue_batches = PackedBatches.open(cache_path)
+        print 'Read %d batches from cache %s' % (len(dialogue_batches), cache_path)
+        print '[%d s]' % (time.time() - start_time)
         return dialogue_batches
 
     def generator(self, name, shuffle=True, cuda=True):
         dialogue_batches = self.batches[name]
-        yield sum([len(b) for b in dialogue_batches])
+        stats = dialogue_batches.stats
+        if stats and stats['padded_tokens'] > 0:
+            print '%s: %d turn batches, %d tokens, %d padded tokens (padding efficiency %.1f%%)' % (
+                    name, dialogue_batches.num_turn_batches, stats['tokens'], stats['padded_tokens'],
+                    100. * stats['tokens'] / stats['padded_tokens'])
+        yield dialogue_batches.num_turn_batches
         inds = range(len(dialogue_batches))
         if shuffle:
             random.shuffle(inds)
         for ind in inds:
-            for batch in dialogue_batches[ind]:
+            for batch in dialogue_batches.get_dialogue_batch(ind):
                 yield Batch(batch['encoder_args'],
                             batch['decoder_args'],
                             batch['context_data'],
@@ -1,9 +1,15 @@
 import argparse
+import os
 import random
 import json
+import shutil
+import tempfile
+import time
+import traceback
 import numpy as np
 import copy
-from collections import defaultdict
+from collections import defaultdict, deque
+from multiprocessing import Pool
 
 import torch
 import torch.nn as nn
@@ -13,11 +19,14 @@ from cocoa.neural.rl_trainer import Statistics
 
 from core.controller import Controller
 from neural.trainer import Trainer
+from neural.batcher import Batch
+from neural.preprocess import Dialogue
 from utterance import UtteranceBuilder
 
 
 class RLTrainer(Trainer):
-    def __init__(self, agents, scenarios, train_loss, optim, training_agent=0, reward_func='margin'):
+    def __init__(self, agents, scenarios, train_loss, optim, training_agent=0, reward_func='margin',
+            update_batch_size=1, reward_window=None):
         self.agents = agents
         self.scenarios = scenarios
 
@@ -29,9 +38,16 @@ class RLTrainer(Trainer):
 
         self.best_valid_reward = None
 
-        self.all_rewards = [[], []]
+        # Rewards of the last `reward_window` dialogues (None: all dialogues)
+        self.all_rewards = [deque(maxlen=reward_window), deque(maxlen=reward_window)]
         self.reward_func = reward_func
 
+        # Dialogues (and their scaled rewards) waiting for a batched update
+        self.update_batch_size = update_batch_size
+        self.pending = []
+        # Number of updates (optimizer steps) of the model
+        self.num_steps = 0
+
     def update(self, batch_iter, reward, model, discount=0.95):
         model.train()
         model.generator.train()
@@ -66,6 +82,78 @@ class RLTrainer(Trainer):
         nn.utils.clip_grad_norm(model.parameters(), 1.)
         self.optim.step()
 
+    def _align_state(self, enc_state, prev_order, order):
+        """Rows of a `Batch` are sorted by length. Reorder the hidden state
+        of the previous turn (rows in `prev_order`) to the rows of the
+        current turn (`order`).
+        """
+        ids = torch.LongTensor(np.argsort(prev_order)[order])
+        if self.agents[self.training_agent].env.cuda:
+            ids = ids.cuda()
+        ids = Variable(ids)
+        return tuple(h.index_select(1, ids) for h in enc_state)
+
+    def update_batch(self, dialogues, rewards, model, discount=0.95):
+        """REINFORCE update on several dialogues in one step.
+
+        The dialogues are batched by `DialogueBatcher.create_batch` (padded to
+        the same number of turns), and the return of each target token is
+        reward * discount^(number of the dialogue's tokens after it), which
+        is what `update` computes for a single dialogue. The loss is averaged
+        over dialogues.
+        """
+        model.train()
+        model.generator.train()
+
+        env = self.agents[self.training_agent].env
+        pad = self.train_loss.padding_idx
+        batches = env.dialogue_batcher.create_batch(dialogues)
+
+        nll, mask = [], []
+        dec_state, prev_order = None, None
+        for batch in batches:
+            batch = Batch(batch['encoder_args'],
+                          batch['decoder_args'],
+                          batch['context_data'],
+                          env.vocab,
+                          num_context=Dialogue.num_context, cuda=env.cuda)
+            if not model.stateful:
+                dec_state = None
+            enc_state = dec_state.hidden if dec_state is not None else None
+            if enc_state is not None:
+                enc_state = self._align_state(enc_state, prev_order, batch.order)
+
+            outputs, _, dec_state = self._run_batch(batch, None, enc_state)
+            loss, _ = self.train_loss.compute_loss(batch.targets, outputs)  # (seq_len, batch_size)
+
+            # Back to the order of `dialogues`
+            restore = np.argsort(batch.order)
+            restore_ids = torch.LongTensor(restore)
+            if env.cuda:
+                restore_ids = restore_ids.cuda()
+            nll.append(loss.index_select(1, Variable(restore_ids)))
+            mask.append(batch.targets.data.ne(pad).cpu().numpy()[:, restore])
+            prev_order = batch.order
+
+            # Don't backprop fully.
+            if dec_state is not None:
+                dec_state.detach()
+
+        nll = torch.cat(nll)  # (total_seq_len, num_dialogues)
+        mask = np.concatenate(mask).astype(np.float32)
+        # Number of (non-padding) tokens of the dialogue after each token
+        num_after = np.cumsum(mask[::-1], axis=0)[::-1] - mask
+        returns = np.power(discount, num_after) * mask * np.array(rewards, dtype=np.float32)
+        returns = torch.from_numpy(np.ascontiguousarray(returns, dtype=np.float32))
+        if env.cuda:
+            returns = returns.cuda()
+
+        loss = (nll * Variable(returns)).sum() / len(dialogues)
+        model.zero_grad()
+        loss.backward()
+        nn.utils.clip_grad_norm(model.parameters(), 1.)
+        self.optim.step()
+
     def _get_scenario(self, scenario_id=None, split='train'):
         scenarios = self.scenarios[split]
         if scenario_id is None:
@@ -83,16 +171,23 @@ class RLTrainer(Trainer):
                     self.agents[1].new_session(1, scenario.kbs[1])]
         return Controller(scenario, sessions)
 
+    def simulate(self, scenario, max_turns, split='train', verbose=False):
+        """Simulate a dialogue; return the example, the session of the
+        training agent and its reward.
+        """
+        controller = self._get_controller(scenario, split=split)
+        example = controller.simulate(max_turns, verbose=verbose)
+        session = controller.sessions[self.training_agent]
+        reward = self.get_reward(example, session)
+        return example, session, reward
+
     def validate(self, args):
         split = 'dev'
         self.model.eval()
         total_stats = Statistics()
         print '='*20, 'VALIDATION', '='*20
         for scenario in self.scenarios[split][:200]:
-            controller = self._get_controller(scenario, split=split)
-            example = controller.simulate(args.max_turns, verbose=args.verbose)
-            session = controller.sessions[self.training_agent]
-            reward = self.get_reward(example, session)
+            example, session, reward = self.simulate(scenario, args.max_turns, split=split, verbose=args.verbose)
             stats = Statistics(reward=reward)
             total_stats.update(stats)
         print '='*20, 'END VALIDATION', '='*20
@@ -117,36 +212,49 @@ class RLTrainer(Trainer):
                     episode=episode)
         return path
 
+    def reinforce(self, i, session, reward, args):
+        """Standardize the reward of the training agent and update the model
+        on the dialogue of `session`. If `update_batch_size` > 1, dialogues
+        are accumulated and updated together (see `update_batch`).
+        """
+        all_rewards = self.all_rewards[self.training_agent]
+        all_rewards.append(reward)
+        print 'step:', i
+        print 'reward:', reward
+        reward = (reward - np.mean(all_rewards)) / max(1e-4, np.std(all_rewards))
+        print 'scaled reward:', reward
+        print 'mean reward:', np.mean(all_rewards)
+
+        if self.update_batch_size > 1:
+            session.convert_to_int()
+            self.pending.append((session.dialogue, reward))
+            if len(self.pending) >= self.update_batch_size:
+                self.flush_updates(args)
+        else:
+            batch_iter = session.iter_batches()
+            T = batch_iter.next()
+            self.update(batch_iter, reward, self.model, discount=args.discount_factor)
+            self.num_steps += 1
+
+    def flush_updates(self, args):
+        if self.pending:
+            dialogues, rewards = zip(*self.pending)
+            self.pending = []
+            self.update_batch(list(dialogues), list(rewards), self.model, discount=args.discount_factor)
+            self.num_steps += 1
+
     def learn(self, args):
         for i in xrange(args.num_dialogues):
             # Rollout
             scenario = self._get_scenario()
-            controller = self._get_controller(scenario, split='train')
-            example = controller.simulate(args.max_turns, verbose=args.verbose)
-
-            for session_id, session in enumerate(controller.sessions):
-                # Only train one agent
-                if session_id != self.training_agent:
-                    continue
-
-                # Compute reward
-                reward = self.get_reward(example, session)
-                # Standardize the reward
-                all_rewards = self.all_rewards[session_id]
-                all_rewards.append(reward)
-                print 'step:', i
-                print 'reward:', reward
-                reward = (reward - np.mean(all_rewards)) / max(1e-4, np.std(all_rewards))
-                print 'scaled reward:', reward
-                print 'mean reward:', np.mean(all_rewards)
-
-                batch_iter = session.iter_batches()
-                T = batch_iter.next()
-                self.update(batch_iter, reward, self.model, discount=args.discount_factor)
+            example, session, reward = self.simulate(scenario, args.max_turns, split='train', verbose=args.verbose)
+            # Only train one agent
+            self.reinforce(i, session, reward, args)
 
             if i > 0 and i % 100 == 0:
                 valid_stats = self.validate(args)
                 self.drop_checkpoint(args, i, valid_stats, model_opt=self.agents[self.training_agent].env.model_args)
+        self.flush_updates(args)
 
     def _is_valid_dialogue(self, example):
         special_actions = defaultdict(int)
@@ -223,3 +331,183 @@ class RLTrainer(Trainer):
             rewards = self._length_reward(example)
         reward = rewards[session.kb.role]
         return reward
+
+
+# Per-process state of the rollout workers, set by init_rollout_worker.
+worker_args = None
+worker_trainer = None
+worker_weights_path = None
+worker_version = -1
+
+def init_rollout_worker(args, schema, scenarios, training_agent, reward_func, weights_path):
+    """Load the agents once per worker process. Workers run on CPU; the
+    weights of the training agent are loaded from `weights_path` when a task
+    asks for a newer version than the one the worker holds.
+    """
+    global worker_args, worker_trainer, worker_weights_path, worker_version
+    from systems import get_system
+    torch.set_num_threads(1)
+    worker_args = copy.copy(args)
+    worker_args.gpuid = []
+    systems = [get_system(name, worker_args, schema, False, worker_args.agent_checkpoints[i])
+               for i, name in enumerate(worker_args.agents)]
+    worker_trainer = RLTrainer(systems, scenarios, None, None, training_agent, reward_func)
+    worker_weights_path = weights_path
+    worker_version = -1
+
+def _sync_worker(version):
+    global worker_version
+    if version > worker_version:
+        state = torch.load(worker_weights_path, map_location=lambda storage, loc: storage)
+        worker_trainer.model.load_state_dict(state['state_dict'])
+        worker_version = state['version']
+
+def run_rollout(task):
+    """Simulate one dialogue for the task (split, scenario_id, seed, version).
+
+    Returns:
+        (version, reward, dialogue, error): version of the policy weights
+        that generated the dialogue, reward of the training agent and its
+        `Dialogue` (None for validation). Exceptions are returned as a
+        traceback in `error` so that the learner gets the worker's traceback.
+    """
+    split, scenario_id, seed, version = task
+    try:
+        _sync_worker(version)
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        if split == 'train':
+            worker_trainer.model.train()
+        else:
+            worker_trainer.model.eval()
+        scenario = worker_trainer._get_scenario(scenario_id, split=split)
+        example, session, reward = worker_trainer.simulate(scenario, worker_args.max_turns,
+                split=split, verbose=worker_args.verbose)
+        dialogue = session.dialogue if split == 'train' else None
+        return worker_version, reward, dialogue, None
+    except Exception:
+        return worker_version, None, None, traceback.format_exc()
+
+
+class ActorLearnerRLTrainer(RLTrainer):
+    """RLTrainer where dialogues are generated by a pool of rollout workers.
+
+    Each worker holds its own copy of the agents. The learner publishes the
+    weights of the training agent every `sync_interval` updates (a versioned
+    file that workers reload when a task asks for a newer version) and
+    consumes (dialogue, reward) results from a queue, rebuilding the batches
+    with its own model. Results generated by weights more than
+    `max_staleness` updates old are dropped (None: no bound). Validation is
+    also fanned out to the workers. Updates are optimizer steps (`num_steps`),
+    i.e. one per `update_batch_size` dialogues; the version of the weights is
+    the number of updates. If no task finishes within `rollout_timeout`
+    seconds (e.g. a worker was killed and its task lost), training fails.
+    """
+    def __init__(self, agents, scenarios, train_loss, optim, training_agent=0, reward_func='margin',
+            update_batch_size=1, reward_window=None,
+            args=None, schema=None, num_workers=2, sync_interval=1, max_staleness=None, rollout_timeout=600):
+        super(ActorLearnerRLTrainer, self).__init__(agents, scenarios, train_loss, optim, training_agent, reward_func,
+                update_batch_size, reward_window)
+        if max_staleness is not None and max_staleness < sync_interval:
+            raise ValueError('max_staleness ({}) must be at least sync_interval ({})'.format(max_staleness, sync_interval))
+        self.num_workers = num_workers
+        self.sync_interval = sync_interval
+        self.max_staleness = max_staleness
+        self.rollout_timeout = rollout_timeout
+        self.num_dialogues = 0
+        self.version = -1
+        self.weights_dir = tempfile.mkdtemp(prefix='rollout_weights')
+        self.weights_path = os.path.join(self.weights_dir, 'weights.pt')
+        self.publish_weights()
+        self.pool = Pool(num_workers, initializer=init_rollout_worker,
+                initargs=(args, schema, scenarios, training_agent, reward_func, self.weights_path))
+
+    def publish_weights(self):
+        state = {
+                'version': self.num_steps,
+                'state_dict': {k: v.cpu() for k, v in self.model.state_dict().iteritems()},
+                }
+        # Workers may be loading the previous version: write then rename
+        tmp_path = self.weights_path + '.tmp'
+        torch.save(state, tmp_path)
+        os.rename(tmp_path, self.weights_path)
+        self.version = self.num_steps
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        shutil.rmtree(self.weights_dir, ignore_errors=True)
+
+    def _check_result(self, result):
+        version, reward, dialogue, error = result
+        if error is not None:
+            raise RuntimeError('Rollout worker failed:\n{}'.format(error))
+        return version, reward, dialogue
+
+    def _next_result(self, in_flight):
+        """Remove the first finished task from `in_flight` (AsyncResults) and
+        return its checked result.
+        """
+        deadline = time.time() + self.rollout_timeout
+        while True:
+            for i, async_result in enumerate(in_flight):
+                if async_result.ready():
+                    del in_flight[i]
+                    # Re-raises errors of the pool, e.g. a result that failed to pickle
+                    return self._check_result(async_result.get())
+            if time.time() > deadline:
+                raise RuntimeError('No rollout finished in {} s ({} tasks in flight); a worker may have died'.format(
+                    self.rollout_timeout, len(in_flight)))
+            time.sleep(0.01)
+
+    def _session(self, dialogue):
+        session = self.agents[self.training_agent].new_session(dialogue.agent, dialogue.kb)
+        session.dialogue = dialogue
+        return session
+
+    def validate(self, args):
+        split = 'dev'
+        if self.version != self.num_steps:
+            self.publish_weights()
+        num_scenarios = min(200, len(self.scenarios[split]))
+        tasks = [(split, i, i, self.version) for i in xrange(num_scenarios)]
+        total_stats = Statistics()
+        print '='*20, 'VALIDATION', '='*20
+        in_flight = [self.pool.apply_async(run_rollout, (task,)) for task in tasks]
+        while in_flight:
+            version, reward, _ = self._next_result(in_flight)
+            total_stats.update(Statistics(reward=reward))
+        print '='*20, 'END VALIDATION', '='*20
+        return total_stats
+
+    def learn(self, args):
+        # Keep every worker busy while the learner updates
+        max_in_flight = 2 * self.num_workers
+        in_flight = []
+        num_dropped = 0
+        try:
+            while self.num_dialogues < args.num_dialogues:
+                while len(in_flight) < max_in_flight:
+                    scenario_id = random.randrange(len(self.scenarios['train']))
+                    task = ('train', scenario_id, random.getrandbits(31), self.version)
+                    in_flight.append(self.pool.apply_async(run_rollout, (task,)))
+
+                version, reward, dialogue = self._next_result(in_flight)
+                if self.max_staleness is not None and self.num_steps - version > self.max_staleness:
+                    num_dropped += 1
+                    continue
+
+                i = self.num_dialogues
+                self.reinforce(i, self._session(dialogue), reward, args)
+                self.num_dialogues += 1
+                if self.num_steps - self.version >= self.sync_interval:
+                    self.publish_weights()
+
+                if i > 0 and i % 100 == 0:
+                    valid_stats = self.validate(args)
+                    self.drop_checkpoint(args, i, valid_stats, model_opt=self.agents[self.training_agent].env.model_args)
+            self.flush_updates(args)
+        finally:
+            self.close()
+        print 'Dropped {} stale dialogues'.format(num_dropped)
@@ -13,7 +13,13 @@ def add_preprocess_arguments(parser):
     parser.add_argument('--entity-target-form', choices=['canonical', 'type'], default='canonical', help='Output entity form to the decoder')
     parser.add_argument('--cache', default='.cache', help='Path to cache for preprocessed batches')
     parser.add_argument('--ignore-cache', action='store_true', help='Ignore existing cache')
+    parser.add_argument('--preprocess-workers', type=int, default=1, help='Number of processes preprocessing examples')
+    parser.add_argument('--preprocess-shard-size', type=int, default=1000, help='Average number of examples per preprocessing (and cache) shard')
     parser.add_argument('--mappings', help='Path to vocab mappings')
+    parser.add_argument('--batching', choices=['fixed', 'tokens'], default='fixed',
+            help='fixed: batches of --batch-size dialogues sorted by number of turns; tokens: bucket dialogues by number of turns and utterance length, under --max-batch-tokens')
+    parser.add_argument('--max-batch-tokens', type=int, default=4096,
+            help='Maximum number of (padded) tokens per stage of a dialogue batch, i.e. dialogues x turns x utterance length (--batching tokens)')
 
 def add_data_generator_arguments(parser):
     cocoa.options.add_scenario_arguments(parser)
@@ -82,11 +88,31 @@ def add_rl_arguments(parser):
     cocoa.options.add_rl_arguments(parser)
     parser.add_argument('--reward', choices=['margin', 'length', 'fair'],
             help='Which reward function to use')
+    parser.add_argument('--update-batch-size', type=int, default=1,
+            help='Number of dialogues per REINFORCE update')
+    parser.add_argument('--reward-window', type=int, default=1000,
+            help='Standardize rewards by the mean and std of the last this many dialogues')
+    group = parser.add_argument_group('Actor-learner')
+    group.add_argument('--num-rollout-workers', type=int, default=0,
+            help='Number of processes generating dialogues for the learner (0 = generate in the learner process)')
+    group.add_argument('--sync-interval', type=int, default=10,
+            help='Number of model updates (optimizer steps, see --update-batch-size) between publishing the policy weights to rollout workers')
+    group.add_argument('--max-staleness', type=int, default=None,
+            help='Drop dialogues generated by weights more than this many model updates old (default: no bound)')
+    group.add_argument('--rollout-timeout', type=float, default=600,
+            help='Fail if no rollout worker returns a dialogue within this many seconds (e.g. a worker died)')
 
 
 # =============== systems ===============
 def add_neural_system_arguments(parser):
     cocoa.options.add_generator_arguments(parser)
+    group = parser.add_argument_group('Inference')
+    group.add_argument('--inference-batch-window', type=float, default=0,
+                       help='Seconds to wait for concurrent sessions to batch their generation (0 = no batching)')
+    group.add_argument('--inference-max-batch-size', type=int, default=32,
+                       help='Maximum number of sessions generating in one batch')
+    group.add_argument('--incremental-encoding', action='store_true',
+                       help='Cache turn arrays and KB memory banks across turns of a session')
 
 def add_system_arguments(parser):
     cocoa.options.add_rulebased_arguments(parser)
@@ -1,7 +1,7 @@
 import argparse
 import copy
 
-from cocoa.core.dataset import read_examples
+from cocoa.core.dataset import iter_examples
 from cocoa.model.manager import Manager
 from cocoa.analysis.utils import intent_breakdown
 from cocoa.io.utils import write_json
@@ -53,15 +53,19 @@ if __name__ == '__main__':
     parser.add_argument('--max-examples', default=-1, type=int)
     parser.add_argument('--templates', help='Path to load templates')
     parser.add_argument('--templates-output', help='Path to save templates')
+    parser.add_argument('--templates-store-output', help='Directory to save compiled (memory-mapped) templates')
     parser.add_argument('--model-output', help='Path to save the dialogue manager model')
     args = parser.parse_args()
 
     price_tracker = PriceTracker(args.price_tracker_model)
-    examples = read_examples(args.transcripts, args.max_examples, Scenario)
+    # Only keep examples in memory if we need to write them out
+    examples = []
     parsed_dialogues = []
     templates = Templates()
 
-    for example in examples:
+    for example in iter_examples(args.transcripts, args.max_examples, Scenario):
+        if args.transcripts_output:
+            examples.append(example)
         if Preprocessor.skip_example(example):
             continue
         utterances = parse_example(example, price_tracker, templates)
@@ -90,6 +94,8 @@ if __name__ == '__main__':
 
     # Test model and generator
     generator = Generator(templates)
+    if args.templates_store_output:
+        generator.compile(args.templates_store_output)
     action = manager.choose_action(None, context=('<start>', '<start>'))
     print action
     print generator.retrieve('<start>', context_tag='<start>', tag=action, category='car', role='seller').template
@@ -19,7 +19,7 @@ import cocoa.options
 from core.scenario import Scenario
 from core.controller import Controller
 from systems import get_system
-from neural.rl_trainer import RLTrainer
+from neural.rl_trainer import RLTrainer, ActorLearnerRLTrainer
 from neural import build_optim
 import options
 
@@ -61,5 +61,13 @@ if __name__ == '__main__':
     optim = build_optim(args, model, None)
 
     scenarios = {'train': scenario_db.scenarios_list, 'dev': valid_scenario_db.scenarios_list}
-    trainer = RLTrainer(systems, scenarios, loss, optim, rl_agent, reward_func=args.reward)
+    if args.num_rollout_workers > 0:
+        trainer = ActorLearnerRLTrainer(systems, scenarios, loss, optim, rl_agent, reward_func=args.reward,
+                update_batch_size=args.update_batch_size, reward_window=args.reward_window,
+                args=args, schema=schema, num_workers=args.num_rollout_workers,
+                sync_interval=args.sync_interval, max_staleness=args.max_staleness,
+                rollout_timeout=args.rollout_timeout)
+    else:
+        trainer = RLTrainer(systems, scenarios, loss, optim, rl_agent, reward_func=args.reward,
+                update_batch_size=args.update_batch_size, reward_window=args.reward_window)
     trainer.learn(args)
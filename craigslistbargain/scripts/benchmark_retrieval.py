@@ -0,0 +1,109 @@
+'''
+Per-turn latency of template retrieval (Generator.retrieve).
+
+"before" filters the whole DataFrame with boolean masks and fully sorts the
+densified tf-idf scores (what Generator.retrieve used to do), "after" uses the
+group-partitioned TemplateIndex. Each simulated dialogue keeps its own
+used_templates like RulebasedSession.
+'''
+
+import random
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+from cocoa.model.generator import Generator as BaseGenerator
+
+from model.generator import Templates, Generator
+
+CATEGORIES = ['furniture', 'housing', 'car', 'phone', 'bike', 'electronics']
+ROLES = ['buyer', 'seller']
+TAGS = ['intro', 'greet', 'init-price', 'agree', 'vague-price', 'counter-price', 'inquiry', 'inform', 'unknown']
+WORDS = ['is', 'this', 'still', 'available', 'how', 'about', '{price}', 'can', 'you', 'do', 'the', '{title}',
+         'great', 'condition', 'deal', 'pick', 'it', 'up', 'lower', 'would', 'take', 'cash', 'today', 'sounds', 'good']
+
+class LegacyGenerator(BaseGenerator):
+    def _select_filter(self, locs):
+        for loc in locs[::-1]:
+            if np.sum(loc) > 0:
+                return loc
+        return locs[0]
+
+    def get_filter(self, used_templates=None, category=None, role=None, context_tag=None, tag=None, **kwargs):
+        locs = [super(LegacyGenerator, self).get_filter(used_templates)]
+        self._add_filter(locs, self.templates.role == role)
+        self._add_filter(locs, self.templates.category == category)
+        if tag:
+            self._add_filter(locs, self.templates.tag == tag)
+        if context_tag:
+            self._add_filter(locs, self.templates.context_tag == context_tag)
+        return self._select_filter(locs)
+
+def random_sentence():
+    return ' '.join(random.choice(WORDS) for _ in xrange(random.randint(3, 12)))
+
+def synthetic_templates(num_templates):
+    rows = []
+    for i in xrange(num_templates):
+        rows.append({
+            'category': random.choice(CATEGORIES),
+            'role': random.choice(ROLES),
+            'tag': random.choice(TAGS),
+            'context_tag': random.choice(TAGS),
+            'template': random_sentence(),
+            'context': random_sentence(),
+            'id': i,
+            'logp': -random.random() * 20,
+            })
+    return pd.DataFrame(rows)
+
+def queries(num_dialogues, num_turns):
+    for _ in xrange(num_dialogues):
+        category, role = random.choice(CATEGORIES), random.choice(ROLES)
+        yield [(random_sentence(), dict(category=category, role=role, tag=random.choice(TAGS), context_tag=random.choice(TAGS)))
+               for _ in xrange(num_turns)]
+
+def benchmark(generator, dialogues):
+    latencies = []
+    for turns in dialogues:
+        used_templates = set()
+        for context, kwargs in turns:
+            start_time = time.time()
+            template = generator.retrieve(context, used_templates=used_templates, **kwargs)
+            latencies.append(time.time() - start_time)
+            used_templates.add(template['id'])
+    return np.array(latencies) * 1000.
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--templates', help='Path to templates (pickle); synthetic templates are used if not given')
+    parser.add_argument('--num-templates', type=int, default=50000, help='Number of synthetic templates')
+    parser.add_argument('--num-dialogues', type=int, default=50)
+    parser.add_argument('--num-turns', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    if args.templates:
+        templates = Templates.from_pickle(args.templates)
+    else:
+        templates = Templates(synthetic_templates(args.num_templates), finalized=True)
+    dialogues = list(queries(args.num_dialogues, args.num_turns))
+    if args.templates:
+        # Use contexts and tags from the data
+        t = templates.templates
+        dialogues = [[(random.choice(t.context.values), dict(kwargs, category=random.choice(t.category.values)))
+                      for _, kwargs in turns] for turns in dialogues]
+
+    print '{} templates, {} dialogues x {} turns'.format(len(templates.templates), args.num_dialogues, args.num_turns)
+    for name, cls in (('before', LegacyGenerator), ('after', Generator)):
+        start_time = time.time()
+        generator = cls(templates)
+        build_time = time.time() - start_time
+        latencies = benchmark(generator, dialogues)
+        print '{:<8} build: {:.2f}s  per-turn latency (ms): mean={:.2f} p50={:.2f} p95={:.2f} max={:.2f}'.format(
+                name, build_time, np.mean(latencies), np.percentile(latencies, 50),
+                np.percentile(latencies, 95), np.max(latencies))
@@ -115,6 +115,12 @@ class PytorchNeuralSession(NeuralSession):
         self.new_turn = False
         self.end_turn = False
 
+        # Incremental mode: reuse integer turn arrays and the KB (title,
+        # description) attention memory banks computed in previous turns
+        self.incremental = self.env.incremental_encoding
+        self.encoder_turn_batches = []
+        self.memory_cache = {} if self.incremental else None
+
     def get_decoder_inputs(self):
         # Don't include EOS
         utterance = self.dialogue._insert_markers(self.agent, [], True)[:-1]
@@ -122,12 +128,20 @@ class PytorchNeuralSession(NeuralSession):
         inputs = np.array(inputs, dtype=np.int32).reshape([1, -1])
         return inputs
 
-    def _create_batch(self):
+    def _get_encoder_turns(self):
+        if not self.incremental:
+            return self.batcher._get_turn_batch_at([self.dialogue], Dialogue.ENC, None)
+        # Only create arrays for turns received since the last call
+        for i in xrange(len(self.encoder_turn_batches), self.dialogue.num_turns):
+            self.encoder_turn_batches.append(self.batcher._get_turn_batch_at([self.dialogue], Dialogue.ENC, i))
+        return self.encoder_turn_batches
+
+    def _create_batch_args(self):
         num_context = Dialogue.num_context
 
         # All turns up to now
         self.convert_to_int()
-        encoder_turns = self.batcher._get_turn_batch_at([self.dialogue], Dialogue.ENC, None)
+        encoder_turns = self._get_encoder_turns()
 
         encoder_inputs = self.batcher.get_encoder_inputs(encoder_turns)
         encoder_context = self.batcher.get_encoder_context(encoder_turns, num_context)
@@ -146,16 +160,26 @@ class PytorchNeuralSession(NeuralSession):
                 'kbs': [self.kb],
                 }
 
+        return encoder_args, decoder_args, context_data
+
+    def _create_batch(self):
+        encoder_args, decoder_args, context_data = self._create_batch_args()
         return Batch(encoder_args, decoder_args, context_data,
-                self.vocab, sort_by_length=False, num_context=num_context, cuda=self.cuda)
+                self.vocab, sort_by_length=False, num_context=Dialogue.num_context, cuda=self.cuda)
 
     def generate(self):
         if len(self.dialogue.agents) == 0:
             self.dialogue._add_utterance(1 - self.agent, [])
-        batch = self._create_batch()
 
-        enc_state = self.dec_state.hidden if self.dec_state is not None else None
-        output_data = self.generator.generate_batch(batch, gt_prefix=self.gt_prefix, enc_state=enc_state)
+        scheduler = self.env.inference_scheduler
+        if scheduler is not None:
+            # Batched with concurrent sessions; only used by stateless models
+            output_data = scheduler.generate(*self._create_batch_args())
+        else:
+            batch = self._create_batch()
+            enc_state = self.dec_state.hidden if self.dec_state is not None else None
+            output_data = self.generator.generate_batch(batch, gt_prefix=self.gt_prefix, enc_state=enc_state,
+                    memory_cache=self.memory_cache)
 
         if self.stateful:
             # TODO: only works for Sampler for now. cannot do beam search.
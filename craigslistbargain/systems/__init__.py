@@ -11,13 +11,13 @@ def get_system(name, args, schema=None, timed=False, model_path=None):
         from rulebased_system import RulebasedSystem
         from model.generator import Templates, Generator
         from model.manager import Manager
-        templates = Templates.from_pickle(args.templates)
+        templates = Templates.load(args.templates)
         generator = Generator(templates)
         manager = Manager.from_pickle(args.policy)
         return RulebasedSystem(lexicon, generator, manager, timed)
     elif name == 'hybrid':
         from hybrid_system import HybridSystem
-        templates = Templates.from_pickle(args.templates)
+        templates = Templates.load(args.templates)
         manager = PytorchNeuralSystem(args, schema, lexicon, model_path, timed)
         generator = Generator(templates)
         return HybridSystem(lexicon, generator, manager, timed)
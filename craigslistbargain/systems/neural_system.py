@@ -8,7 +8,8 @@ from cocoa.sessions.timed_session import TimedSessionWrapper
 from cocoa.core.util import read_pickle, read_json
 from cocoa.neural.beam import Scorer
 
-from neural.generator import get_generator
+from neural.generator import get_generator, LFSampler
+from neural.inference_scheduler import InferenceScheduler
 from sessions.neural_session import PytorchNeuralSession
 from neural import model_builder, get_data_generator, make_model_mappings
 from neural.preprocess import markers, TextIntMap, Preprocessor, Dialogue
@@ -61,15 +62,27 @@ class PytorchNeuralSystem(System):
         Dialogue.mappings = mappings
         Dialogue.num_context = model_args.num_context
 
+        # Share forward passes among concurrent sessions. Stateful models carry
+        # per-session decoder states and LFSampler only supports batch size 1.
+        inference_scheduler = None
+        batch_window = getattr(args, 'inference_batch_window', 0)
+        if batch_window > 0 and not model.stateful and not isinstance(generator, LFSampler):
+            inference_scheduler = InferenceScheduler(generator, vocab, kb_padding, model_args.num_context,
+                    window=batch_window, max_batch_size=args.inference_max_batch_size,
+                    gt_prefix=1, cuda=use_cuda)
+
         Env = namedtuple('Env', ['model', 'vocab', 'preprocessor', 'textint_map',
             'stop_symbol', 'remove_symbols', 'gt_prefix',
             'max_len', 'dialogue_batcher', 'cuda',
-            'dialogue_generator', 'utterance_builder', 'model_args'])
+            'dialogue_generator', 'utterance_builder', 'model_args',
+            'inference_scheduler', 'incremental_encoding'])
         self.env = Env(model, vocab, preprocessor, textint_map,
             stop_symbol=vocab.to_ind(markers.EOS), remove_symbols=remove_symbols,
             gt_prefix=1,
             max_len=20, dialogue_batcher=dialogue_batcher, cuda=use_cuda,
-            dialogue_generator=generator, utterance_builder=builder, model_args=model_args)
+            dialogue_generator=generator, utterance_builder=builder, model_args=model_args,
+            inference_scheduler=inference_scheduler,
+            incremental_encoding=getattr(args, 'incremental_encoding', False))
 
     @classmethod
     def name(cls):
@@ -14,6 +14,8 @@ from cocoa.core.schema import Schema
 from cocoa.core.util import read_json
 from cocoa.systems.human_system import HumanSystem
 from cocoa.web.main.logger import WebLogger
+from cocoa.web.main.push import EventPusher
+from cocoa.web.main.scheduler import ControllerScheduler
 import cocoa.options
 
 from core.scenario import Scenario
@@ -33,7 +35,7 @@ from flask import g
 from web.main.backend import Backend
 
 ###############
-from flask import Flask, current_app
+from flask import Flask, current_app, jsonify
 
 from flask_socketio import SocketIO
 socketio = SocketIO()
@@ -228,6 +230,12 @@ if __name__ == "__main__":
     if 'debug' not in params:
         params['debug'] = False
 
+    if 'push_events' not in params:
+        params['push_events'] = False
+
+    if 'schedule_controllers' not in params:
+        params['schedule_controllers'] = False
+
     systems, pairing_probabilities = add_systems(args, params['models'], schema, debug=params['debug'])
 
     db.add_scenarios(scenario_db, systems, update=args.reuse)
@@ -250,8 +258,27 @@ if __name__ == "__main__":
     else:
         app.config['task_icon'] = params['icon']
 
+    # Pushed chats have no polling requests to step the bots
+    if params['schedule_controllers'] or params['push_events']:
+        scheduler = ControllerScheduler(app, Backend).start()
+        app.config['controller_scheduler'] = scheduler
+        app.add_url_rule('/_scheduler_metrics/', 'scheduler_metrics', lambda: jsonify(**scheduler.metrics()))
+
+    handler_class = None
+    if params['push_events']:
+        pusher = EventPusher(socketio, app, Backend)
+        pusher.register()
+        app.config['event_pusher'] = pusher
+        try:
+            from geventwebsocket.handler import WebSocketHandler
+            handler_class = WebSocketHandler
+        except ImportError:
+            # Socket.IO falls back to long-polling
+            warnings.warn('gevent-websocket is not installed; push events will use long-polling.')
+
     print "App setup complete"
 
-    server = WSGIServer(('', args.port), app, log=WebLogger.get_logger(), error_log=error_log_file)
+    server = WSGIServer(('', args.port), app, log=WebLogger.get_logger(), error_log=error_log_file,
+                        handler_class=handler_class)
     atexit.register(cleanup, flask_app=app)
     server.serve_forever()
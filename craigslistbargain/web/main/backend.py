@@ -158,19 +158,8 @@ class Backend(BaseBackend):
             self._update_user(cursor, userid, status=Status.Finished)
 
         def _update_scenario_db(chat_id, scenario_id, partner_type):
-            # make sure that the # of completed dialogues for the scenario is only updated once if both agents are human
-            cursor.execute('''SELECT complete FROM scenario WHERE scenario_id=? AND partner_type=?''',
-                           (scenario_id, partner_type))
-            complete_set = set(json.loads(cursor.fetchone()[0]))
-            complete_set.add(chat_id)
-            cursor.execute('''
-                UPDATE scenario
-                SET complete=?
-                WHERE scenario_id=? AND partner_type=?
-                AND (SELECT COUNT(survey.name)
-                    FROM survey
-                    WHERE survey.chat_id=?) = 0;
-            ''', (json.dumps(list(complete_set)), scenario_id, partner_type, chat_id))
+            # the complete set is only updated once if both agents are human
+            self.conn.on_commit(self.scenario_index.add_complete_chat, scenario_id, partner_type, chat_id)
 
         try:
             with self.conn:
@@ -22,6 +22,33 @@ import torch.nn.functional as F
 import vis
 import domain
 
+
+def concat_padded(first, first_lengths, second, second_lengths, to_device):
+    """Concatenates, for each column b, the first first_lengths[b] rows of `first`
+    and the first second_lengths[b] rows of `second`.
+
+    first, second: (len x bsz) or (len x bsz x nhid) variables.
+    first_lengths, second_lengths: LongTensor (bsz).
+
+    Returns the padded concatenation and its lengths.
+    """
+    lengths = first_lengths + second_lengths
+    max_len, bsz = int(lengths.max()), lengths.size(0)
+    pos = torch.arange(0, max_len).long().unsqueeze(1).expand(max_len, bsz)
+    offset = first_lengths.unsqueeze(0).expand(max_len, bsz)
+    in_first = pos < offset
+    first_idx = pos.clamp(max=first.size(0) - 1)
+    second_idx = (pos - offset).clamp(min=0, max=second.size(0) - 1)
+    if first.dim() == 3:
+        size = (max_len, bsz, first.size(2))
+        in_first = in_first.unsqueeze(2).expand(*size)
+        first_idx = first_idx.unsqueeze(2).expand(*size)
+        second_idx = second_idx.unsqueeze(2).expand(*size)
+    first = first.gather(0, Variable(to_device(first_idx.contiguous())))
+    second = second.gather(0, Variable(to_device(second_idx.contiguous())))
+    return torch.where(to_device(in_first.contiguous()), first, second), lengths
+
+
 class Agent(object):
     """Agent's interface.
 
@@ -79,6 +106,8 @@ class LstmAgent(Agent):
         self.name = name
         self.human = False
         self.domain = domain.get_domain(args.domain)
+        # (item counts, device) -> item indices of the choices
+        self.choice_idxs = {}
 
     def _encode(self, inpt, dictionary):
         """A helper function that encodes the passed in words using the dictionary.
@@ -137,9 +166,21 @@ class LstmAgent(Agent):
         # decode into English words
         return self._decode(outs, self.model.word_dict)
 
-    def _choose(self, lang_hs=None, words=None, sample=False):
+    def _choice_idxs(self, table):
+        """Item indices of all the choices of the table, (selection_length, num_choices)."""
+        key = (table.cnts, self.model.device_id)
+        idxs = self.choice_idxs.get(key)
+        if idxs is None:
+            idxs = table.token_ids(self.model.item_dict).T.copy()
+            idxs = self.choice_idxs[key] = self.model.to_device(Variable(torch.from_numpy(idxs)))
+        return idxs
+
+    def _choose_idx(self, lang_hs=None, words=None, sample=False):
+        """Same as _choose, but returns the index of the choice in
+        domain.choice_table(self.context) instead of the choice.
+        """
         # get all the possible choices
-        choices = self.domain.generate_choices(self.context)
+        table = self.domain.choice_table(self.context)
         # concatenate the list of the hidden states into one tensor
         lang_hs = lang_hs if lang_hs is not None else torch.cat(self.lang_hs)
         # concatenate all the words into one tensor
@@ -147,15 +188,9 @@ class LstmAgent(Agent):
         # logits for each of the item
         logits = self.model.generate_choice_logits(words, lang_hs, self.ctx_h)
 
-        # construct probability distribution over only the valid choices
-        choices_logits = []
-        for i in range(self.domain.selection_length()):
-            idxs = [self.model.item_dict.get_idx(c[i]) for c in choices]
-            idxs = Variable(torch.from_numpy(np.array(idxs)))
-            idxs = self.model.to_device(idxs)
-            choices_logits.append(torch.gather(logits[i], 0, idxs).unsqueeze(1))
-
-        choice_logit = torch.sum(torch.cat(choices_logits, 1), 1, keepdim=False)
+        # construct probability distribution over only the valid choices:
+        # sum the logits of the item of each position of each choice
+        choice_logit = torch.sum(torch.gather(torch.stack(logits), 1, self._choice_idxs(table)), 0, keepdim=False)
         # subtract the max to softmax more stable
         choice_logit = choice_logit.sub(choice_logit.max().item())
 
@@ -173,8 +208,53 @@ class LstmAgent(Agent):
 
         p_agree = prob[idx.item()]
 
+        return idx.item(), logprob, p_agree.item()
+
+    def _choose(self, lang_hs=None, words=None, sample=False):
+        idx, logprob, p_agree = self._choose_idx(lang_hs, words, sample)
+        choices = self.domain.generate_choices(self.context)
         # Pick only your choice
-        return choices[idx.item()][:self.domain.selection_length()], logprob, p_agree.item()
+        return choices[idx][:self.domain.selection_length()], logprob, p_agree
+
+    def _choose_batch(self, words, lang_hs, lengths):
+        """Batched, greedy version of _choose_idx over padded dialogues.
+
+        words: (max_len x bsz), lang_hs: (max_len x bsz x nhid_lang),
+        lengths: LongTensor (bsz), length of each dialogue.
+
+        Returns the index of the choice of each dialogue in
+        domain.choice_table(self.context) and its probability (bsz).
+        """
+        table = self.domain.choice_table(self.context)
+        logits = torch.stack(self.model.generate_choice_logits_batch(words, lang_hs, self.ctx_h, lengths), 0)
+        # (selection_length x bsz x num_choices)
+        idxs = self._choice_idxs(table)
+        idxs = idxs.unsqueeze(1).expand(idxs.size(0), logits.size(1), idxs.size(1))
+        choice_logit = torch.sum(torch.gather(logits, 2, idxs), 0, keepdim=False)
+        prob = F.softmax(choice_logit, dim=1)
+        p_agree, idx = prob.max(1)
+        return idx.data.cpu(), p_agree.data.cpu()
+
+    def _history(self, bsz):
+        """Words and hidden states of the dialogue so far, repeated for a batch."""
+        if not self.words:
+            return None, None
+        words = torch.cat(self.words).view(-1, 1)
+        lang_hs = torch.cat(self.lang_hs).unsqueeze(1)
+        return words.expand(words.size(0), bsz), lang_hs.expand(lang_hs.size(0), bsz, lang_hs.size(2))
+
+    def _score_batch(self, words, lang_hs, lengths):
+        """Expected reward (p_agree * score of the choice) of each dialogue of
+        the batch continuing the dialogue so far.
+        """
+        hist_words, hist_lang_hs = self._history(words.size(1))
+        if hist_words is not None:
+            words = torch.cat([hist_words, words], 0)
+            lang_hs = torch.cat([hist_lang_hs, lang_hs], 0)
+            lengths = lengths + hist_words.size(0)
+        idx, p_agree = self._choose_batch(words, lang_hs, lengths)
+        choice_scores = torch.from_numpy(self.domain.choice_scores(self.context)).float()
+        return p_agree * choice_scores.index_select(0, idx)
 
     def choose(self):
         choice, _, _ = self._choose()
@@ -193,50 +273,55 @@ class LstmRolloutAgent(LstmAgent):
         self.rollout_len = 100
 
     def write(self):
-        best_score = -1
-        res = None
-
-        for _ in range(self.ncandidate):
-            # generate the beginning of the conversation
-            _, move, move_lang_h, move_lang_hs = self.model.write(
-                self.lang_h, self.ctx_h, 100, self.args.temperature)
-
-            # if this is not the end of the conversation
-            is_selection = len(move) == 1 and \
-                self.model.word_dict.get_word(move.data[0][0]) == '<selection>'
-
-            score = 0
-            # try nrollout rollouts to estimate the reward
-            for _ in range(self.nrollout):
-                combined_lang_hs = self.lang_hs + [move_lang_hs]
-                combined_words = self.words + [self.model.word2var('YOU:').unsqueeze(1), move]
-
-                if not is_selection:
-                    # complete the conversation with rollout_length samples
-                    _, rollout, _, rollout_lang_hs = self.model.write(
-                        move_lang_h, self.ctx_h, self.rollout_len, self.args.temperature,
-                        stop_tokens=['<selection>'], resume=True)
-                    combined_lang_hs += [rollout_lang_hs]
-                    combined_words += [rollout]
-
-                # choose items
-                rollout_score = None
-
-                combined_lang_hs = torch.cat(combined_lang_hs)
-                combined_words = torch.cat(combined_words)
-                rollout_choice, _, p_agree = self._choose(combined_lang_hs, combined_words, sample=False)
-                rollout_score = self.domain.score(self.context, rollout_choice)
-                score += p_agree * rollout_score
-
-            # take the candidate with the max expected reward
-            if score > best_score:
-                res = (move, move_lang_h, move_lang_hs)
-                best_score = score
+        """Samples ncandidate first utterances and nrollout completions of
+        each as two batches, scores all rollouts in one batch and returns the
+        utterance with the highest expected reward.
+        """
+        ncandidate, nrollout = self.ncandidate, self.nrollout
+        word_dict = self.model.word_dict
+
+        # generate the beginnings of the conversation
+        lang_h = self.lang_h.view(1, -1).expand(ncandidate, self.lang_h.size(-1))
+        moves, move_lang_hs, move_lengths, move_lang_h = self.model.write_batch_until(
+            lang_h, self.ctx_h, 100, self.args.temperature)
+        # candidates that end the conversation are not rolled out
+        is_selection = (move_lengths == 1) & (moves.data[0].cpu() == word_dict.get_idx('<selection>'))
+
+        # complete each conversation nrollout times
+        candidate = torch.arange(0, ncandidate).long().unsqueeze(1).expand(ncandidate, nrollout).contiguous().view(-1)
+        candidate_var = self.model.to_device(candidate)
+        rollouts, rollout_lang_hs, rollout_lengths, _ = self.model.write_batch_until(
+            move_lang_h.index_select(0, Variable(candidate_var)), self.ctx_h, self.rollout_len,
+            self.args.temperature, stop_tokens=['<selection>'], resume=True,
+            done=is_selection.index_select(0, candidate))
+
+        # 'YOU:' + move + rollout of each rollout
+        you = self.model.word2var('YOU:').view(1, 1).expand(1, ncandidate)
+        move_words = torch.cat([you, moves], 0).index_select(1, Variable(candidate_var))
+        words, lengths = concat_padded(move_words, move_lengths.index_select(0, candidate) + 1,
+            rollouts, rollout_lengths, self.model.to_device)
+        lang_hs, _ = concat_padded(move_lang_hs.index_select(1, Variable(candidate_var)),
+            move_lengths.index_select(0, candidate) + 1, rollout_lang_hs, rollout_lengths, self.model.to_device)
+
+        # expected reward of each candidate, averaged over identical utterances
+        scores = self._score_batch(words, lang_hs, lengths).view(ncandidate, nrollout).sum(1)
+        sents = [tuple(moves.data[:int(move_lengths[i]), i].cpu().tolist()) for i in range(ncandidate)]
+        groups, firsts = {}, []
+        for i, sent in enumerate(sents):
+            if sent not in groups:
+                groups[sent] = len(groups)
+                firsts.append(i)
+        group = torch.LongTensor([groups[sent] for sent in sents])
+        group_scores = torch.zeros(len(groups)).index_add_(0, group, scores)
+        group_counts = torch.zeros(len(groups)).index_add_(0, group, torch.ones(ncandidate))
+        _, best = (group_scores / group_counts).max(0)
+        best = firsts[int(best)]
 
         # store the best candidate and output the produced utterance
-        outs, lang_h, lang_hs = res
-        self.lang_h = lang_h
-        self.lang_hs.append(lang_hs)
+        length = int(move_lengths[best])
+        outs = moves.narrow(0, 0, length).narrow(1, best, 1)
+        self.lang_h = move_lang_h.narrow(0, best, 1).unsqueeze(1)
+        self.lang_hs.append(move_lang_hs.narrow(0, 0, length + 1).narrow(1, best, 1).squeeze(1))
         self.words.append(self.model.word2var('YOU:').unsqueeze(1))
         self.words.append(outs)
         return self._decode(outs, self.model.word_dict)
@@ -249,45 +334,44 @@ class BatchedRolloutAgent(LstmRolloutAgent):
         self.eos = self.model.word_dict.get_idx('<eos>')
         self.eod = self.model.word_dict.get_idx('<selection>')
 
-    def _find(self, seq, tokens):
-        n = seq.size(0)
-        for i in range(n):
-            if seq[i] in tokens:
-                return i
-        return n
+    def _first(self, is_token):
+        """Index of the first True row of each column of is_token (len x bsz),
+        len if there is none.
+        """
+        n = is_token.size(0)
+        rank = torch.arange(n, 0, -1).long().unsqueeze(1).expand_as(is_token)
+        value, pos = (is_token.long() * rank).max(0)
+        pos[value == 0] = n
+        return pos
 
     def write(self):
         batch_outs, batch_lang_hs = self.model.write_batch(
             self.args.rollout_bsz, self.lang_h, self.ctx_h, self.args.temperature)
 
+        outs = batch_outs.data.cpu()
+        # find the end of the dialogue and of the first utterance
+        is_eod = outs == self.eod
+        eod_pos = self._first(is_eod)
+        first_turn_length = self._first(is_eod | (outs == self.eos)) + 1
+        # unfinished dialogues are not counted
+        finished = (eod_pos < outs.size(0)).nonzero().view(-1)
+
         counts, scores, states = defaultdict(float), defaultdict(int), defaultdict(list)
-        for i in range(self.args.rollout_bsz):
-            outs = batch_outs.narrow(1, i, 1).squeeze(1).data.cpu()
-            lang_hs = batch_lang_hs.narrow(1, i, 1).squeeze(1)
-
-            # find the end of the dialogue
-            eod_pos = self._find(outs, [self.eod])
-            if eod_pos == outs.size(0):
-                # unfinished dialogue, don't count this
-                continue
-
-            # find the end of the first utterance
-            first_turn_length = self._find(outs, [self.eos, self.eod]) + 1
-            move = outs.narrow(0, 0, first_turn_length)
-            sent = ' '.join(self.model.word_dict.i2w(move.numpy()))
-            sent_lang_hs = lang_hs.narrow(0, 0, first_turn_length + 1)
-            lang_h = lang_hs.narrow(0, first_turn_length + 1, 1).unsqueeze(0)
-
-            dialog_lang_hs = lang_hs.narrow(0, 0, eod_pos + 1)
-            dialog_words = Variable(self.model.to_device(outs.narrow(0, 0, eod_pos + 1)))
-            choice, _, p_agree = self._choose(
-                torch.cat(self.lang_hs + [dialog_lang_hs]),
-                torch.cat(self.words + [dialog_words]).squeeze().unsqueeze(1), sample=False)
+        if finished.numel() > 0:
+            rows = Variable(self.model.to_device(finished))
+            words = batch_outs.index_select(1, rows)
+            lang_hs = batch_lang_hs.narrow(0, 0, outs.size(0)).index_select(1, rows)
+            rewards = self._score_batch(words, lang_hs, eod_pos.index_select(0, finished) + 1).tolist()
 
             # group by the first utterance
-            counts[sent] += 1
-            scores[sent] += self.domain.score(self.context, choice) * p_agree
-            states[sent] = (lang_h, sent_lang_hs, move)
+            for j, i in enumerate(finished.tolist()):
+                length = int(first_turn_length[i])
+                move = outs[:length, i]
+                sent = ' '.join(self.model.word_dict.i2w(move.numpy()))
+                counts[sent] += 1
+                scores[sent] += rewards[j]
+                lang_hs = batch_lang_hs.narrow(1, i, 1).squeeze(1)
+                states[sent] = (lang_hs.narrow(0, length + 1, 1).unsqueeze(0), lang_hs.narrow(0, 0, length + 1), move)
 
         # filter out the candidates that appeared less than 'threshold' times
         for threshold in range(self.args.rollout_count_threshold, -1, -1):
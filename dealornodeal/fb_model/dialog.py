@@ -122,10 +122,16 @@ class Dialog(object):
         self.agents = agents
         self.args = args
         self.domain = domain.get_domain(args.domain)
+        self.ref_text = None
         self.metrics = MetricsContainer()
         self._register_metrics()
         self.reward_func = args.reward
 
+    def reset_metrics(self):
+        """Starts recording metrics in a new container."""
+        self.metrics = MetricsContainer()
+        self._register_metrics()
+
     def _register_metrics(self):
         """Registers valuable metrics."""
         self.metrics.register_average('dialog_len')
@@ -139,8 +145,9 @@ class Dialog(object):
             self.metrics.register_percentage('%s_sel' % agent.name)
             self.metrics.register_uniqueness('%s_unique' % agent.name)
         # text metrics
-        ref_text = ' '.join(data.read_lines(self.args.ref_text))
-        self.metrics.register_ngram('full_match', text=ref_text)
+        if self.ref_text is None:
+            self.ref_text = ' '.join(data.read_lines(self.args.ref_text))
+        self.metrics.register_ngram('full_match', text=self.ref_text)
 
     def _is_selection(self, out):
         return len(out) == 1 and out[0] == '<selection>'
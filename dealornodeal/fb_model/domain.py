@@ -9,6 +9,8 @@ A collection of the implemented negotiation domain.
 
 import re
 
+import numpy as np
+
 
 def get_domain(name):
     """Creates domain by name."""
@@ -73,10 +75,55 @@ class Domain(object):
         pass
 
 
+class ChoiceTable(object):
+    """All the choices for the given item counts, as generated by
+    ObjectDivisionDomain.generate_choices.
+
+    choices: list of choices (lists of 'itemX=Y' strings), shared, do not modify.
+    counts: int array (num_choices, num_items) of the counts taken by the
+        agent; zero for '<no_agreement>' and '<disconnect>'.
+    index: maps the agent's half of a choice to its row.
+    """
+    def __init__(self, cnts, choices, selection_length):
+        self.cnts = cnts
+        self.choices = choices
+        num_items = len(cnts)
+        self.counts = np.zeros((len(choices), num_items), dtype=np.int64)
+        self.index = {}
+        for i, choice in enumerate(choices):
+            my_choice = tuple(choice[:selection_length // 2])
+            if my_choice[0] == '<no_agreement>':
+                self.index[my_choice] = i
+            elif my_choice[0] != '<disconnect>':
+                self.counts[i] = [int(c.split('=')[1]) for c in my_choice]
+                self.index[my_choice] = i
+        self._token_ids = {}
+        self._scores = {}
+
+    def token_ids(self, dictionary):
+        """Int array (num_choices, selection_length) of the choice tokens
+        indexed by `dictionary`.
+        """
+        ids = self._token_ids.get(dictionary)
+        if ids is None:
+            ids = self._token_ids[dictionary] = np.array([dictionary.w2i(c) for c in self.choices], dtype=np.int64)
+        return ids
+
+    def scores(self, vals):
+        """Scores of all choices given the item values `vals` (a tuple).
+        """
+        scores = self._scores.get(vals)
+        if scores is None:
+            scores = self._scores[vals] = self.counts.dot(np.array(vals, dtype=np.int64))
+        return scores
+
+
 class ObjectDivisionDomain(Domain):
     """Instance of the object division domain."""
     def __init__(self):
         self.item_pattern = re.compile('^item([0-9])=([0-9\-])+$')
+        # item counts -> ChoiceTable
+        self.choice_tables = {}
 
     def selection_length(self):
         return 6
@@ -84,9 +131,24 @@ class ObjectDivisionDomain(Domain):
     def input_length(self):
         return 3
 
-    def generate_choices(self, inpt):
+    def choice_table(self, inpt):
+        """Returns the (cached) ChoiceTable of the given context."""
         cnts, _ = self.parse_context(inpt)
+        cnts = tuple(cnts)
+        table = self.choice_tables.get(cnts)
+        if table is None:
+            table = self.choice_tables[cnts] = ChoiceTable(cnts, self._generate_choices(cnts), self.selection_length())
+        return table
+
+    def choice_scores(self, inpt):
+        """Returns the scores of all the choices of choice_table(inpt)."""
+        _, vals = self.parse_context(inpt)
+        return self.choice_table(inpt).scores(tuple(vals))
+
+    def generate_choices(self, inpt):
+        return self.choice_table(inpt).choices
 
+    def _generate_choices(self, cnts):
         def gen(cnts, idx=0, choice=[]):
             if idx >= len(cnts):
                 left_choice = ['item%d=%d' % (i, c) for i, c in enumerate(choice)]
@@ -113,6 +175,9 @@ class ObjectDivisionDomain(Domain):
         choice = choice[0:len(choice) // 2]
         if choice[0] == '<no_agreement>':
             return 0
+        idx = self.choice_table(context).index.get(tuple(choice))
+        if idx is not None:
+            return int(self.choice_scores(context)[idx])
         _, vals = self.parse_context(context)
         score = 0
         for i, (c, v) in enumerate(zip(choice, vals)):
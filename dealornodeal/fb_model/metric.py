@@ -27,9 +27,12 @@ class TimeMetric(object):
         self.t += time.time() - self.last_t
         self.n += 1
 
+    def merge(self, other):
+        self.t += other.t
+        self.n += other.n
+
     def value(self):
-        self.n = max(1, self.n)
-        return 1.0 * self.t / self.n
+        return 1.0 * self.t / max(1, self.n)
 
     def show(self):
         return '%.3fs' % (1. * self.value())
@@ -48,9 +51,12 @@ class NumericMetric(object):
         self.k += k
         self.n += n
 
+    def merge(self, other):
+        self.k += other.k
+        self.n += other.n
+
     def value(self):
-        self.n = max(1, self.n)
-        return 1.0 * self.k / self.n
+        return 1.0 * self.k / max(1, self.n)
 
 
 class PercentageMetric(NumericMetric):
@@ -75,13 +81,23 @@ class TextMetric(object):
     def reset(self):
         pass
 
+    def merge(self, other):
+        self.k += other.k
+        self.n += other.n
+
     def value(self):
-        self.n = max(1, self.n)
-        return 1. * self.k / self.n
+        return 1. * self.k / max(1, self.n)
 
     def show(self):
         return '%.2f' % (1. * self.value())
 
+    def __getstate__(self):
+        # the reference text is not sent between processes, merged metrics
+        # only need the counts
+        state = dict(self.__dict__)
+        state['text'] = None
+        return state
+
 
 class NGramMetric(TextMetric):
     """Metric that evaluates n gramms."""
@@ -109,6 +125,9 @@ class UniquenessMetric(object):
     def record(self, sen):
         self.seen.add(' '.join(sen))
 
+    def merge(self, other):
+        self.seen.update(other.seen)
+
     def value(self):
         return len(self.seen)
 
@@ -135,9 +154,12 @@ class SimilarityMetric(object):
                 break
         self.history.append(sen)
 
+    def merge(self, other):
+        self.k += other.k
+        self.n += other.n
+
     def value(self):
-        self.n = max(1, self.n)
-        return 1. * self.k / self.n
+        return 1. * self.k / max(1, self.n)
 
     def show(self):
         return '%.2f' % (1. * self.value())
@@ -180,6 +202,13 @@ class MetricsContainer(object):
         for m in self.metrics.values():
             m.reset()
 
+    def merge(self, other):
+        """Adds the records of another container with the same metrics."""
+        assert list(self.metrics.keys()) == list(other.metrics.keys())
+        for name, m in self.metrics.items():
+            m.merge(other.metrics[name])
+        return self
+
     def value(self, name):
         return self.metrics[name].value()
 
@@ -19,6 +19,7 @@ import torch.nn.functional as F
 import torch.nn.init
 from torch.autograd import Variable
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 from data import STOP_TOKENS
 from domain import get_domain
@@ -219,6 +220,127 @@ class DialogModel(modules.CudaModule):
         logits = [decoder.forward(h).squeeze(0) for decoder in self.sel_decoders]
         return logits
 
+    def generate_choice_logits_batch(self, inpt, lang_h, ctx_h, lengths):
+        """Batched version of generate_choice_logits over padded sequences.
+
+        inpt: words, (max_len x bsz).
+        lang_h: language model hidden states, (max_len x bsz x nhid_lang).
+        ctx_h: context hidden state of the (single) context.
+        lengths: LongTensor (bsz), length of each sequence.
+
+        Returns a list of logits (bsz x len(item_dict)), one per item.
+        """
+        bsz = inpt.size(1)
+        inpt_emb = self.word_encoder(inpt)
+        h = torch.cat([lang_h, inpt_emb], 2)
+        h = self.dropout(h)
+
+        # pack by decreasing length so that the backward direction of the
+        # selection rnn starts at the end of each sequence
+        sorted_lengths, order = torch.sort(lengths, 0, descending=True)
+        _, inverse_order = torch.sort(order, 0)
+        order = self.to_device(order)
+        inverse_order = self.to_device(inverse_order)
+        h = pack_padded_sequence(h.index_select(1, order), sorted_lengths.tolist())
+        attn_h = self.zero_hid(bsz, self.args.nhid_attn, copies=2)
+        self.sel_rnn.flatten_parameters()
+        h, _ = self.sel_rnn(h, attn_h)
+        h, _ = pad_packed_sequence(h)
+        h = h.index_select(1, inverse_order)
+        max_len = h.size(0)
+
+        # perform attention over the non-padded positions
+        logit = self.attn(h.view(-1, 2 * self.args.nhid_attn)).view(max_len, bsz)
+        positions = torch.arange(0, max_len).long().unsqueeze(1).expand(max_len, bsz)
+        padding = self.to_device((positions >= lengths.unsqueeze(0).expand(max_len, bsz)).float())
+        logit = logit.add(Variable(padding * -1e9))
+        prob = F.softmax(logit, dim=0).unsqueeze(2).expand_as(h)
+        attn = torch.sum(torch.mul(h, prob), 0)
+
+        # concatenate attention and context hidden and pass it to the selection encoder
+        ctx_h = ctx_h.view(1, -1).expand(bsz, ctx_h.size(-1))
+        h = torch.cat([attn, ctx_h], 1)
+        h = self.sel_encoder.forward(h)
+
+        # generate logits for each item separately
+        return [decoder.forward(h) for decoder in self.sel_decoders]
+
+    def write_batch_until(self, lang_h, ctx_h, max_words, temperature,
+            stop_tokens=STOP_TOKENS, resume=False, done=None):
+        """Batched version of `write`: generates a sentence for each row of
+        lang_h (bsz x nhid_lang), each row stopping at its first stop token.
+
+        done: ByteTensor (bsz), rows that should not generate anything.
+
+        Returns:
+            outs: words, (max_len x bsz); words after the end of a row are padding.
+            lang_hs: hidden states after reading each word (and 'YOU:' if not
+                resume), (num_states x bsz x nhid_lang).
+            lengths: LongTensor (bsz), number of words of each row.
+            lang_h: the hidden state of each row after its last word (bsz x nhid_lang).
+        """
+        bsz = lang_h.size(0)
+        ctx_h = ctx_h.view(1, -1).expand(bsz, ctx_h.size(-1))
+        stop = torch.LongTensor([self.word_dict.get_idx(w) for w in stop_tokens])
+        done = torch.zeros(bsz).byte() if done is None else done.clone()
+        lengths = torch.zeros(bsz).long()
+        init_lang_h = lang_h
+
+        if resume:
+            inpt = None
+        else:
+            # if we start a new sentence, prepend it with 'YOU:'
+            inpt = Variable(self.to_device(torch.LongTensor(bsz).fill_(self.word_dict.get_idx('YOU:'))))
+
+        # rows are not frozen once done: their states after the end are
+        # never used since they only depend on earlier words
+        outs, lang_hs = [], []
+        for _ in range(max_words):
+            if int(done.sum()) == bsz:
+                break
+            if inpt is not None:
+                inpt_emb = torch.cat([self.word_encoder(inpt), ctx_h], 1)
+                lang_h = self.writer(inpt_emb, lang_h)
+                lang_hs.append(lang_h)
+
+            out = self.decoder(lang_h)
+            scores = F.linear(out, self.word_encoder.weight).div(temperature)
+            # subtract max to make softmax more stable
+            scores = scores.sub(scores.max(1, keepdim=True)[0].expand_as(scores))
+            # disable special tokens from being generated in a normal turns
+            if not resume:
+                scores = scores.add(Variable(self.special_token_mask).unsqueeze(0).expand_as(scores))
+            word = torch.multinomial(F.softmax(scores, dim=1), 1).squeeze(1)
+            outs.append(word.unsqueeze(0))
+            inpt = word
+
+            lengths += (1 - done).long()
+            data = word.data.cpu()
+            done |= ((data.unsqueeze(1) == stop.unsqueeze(0)).sum(1) > 0)
+
+        if inpt is not None:
+            # update the hidden state with the last word
+            inpt_emb = torch.cat([self.word_encoder(inpt), ctx_h], 1)
+            lang_h = self.writer(inpt_emb, lang_h)
+            lang_hs.append(lang_h)
+
+        if outs:
+            outs = torch.cat(outs, 0)
+            lang_hs = torch.stack(lang_hs, 0)
+        else:
+            outs = Variable(self.to_device(torch.LongTensor(1, bsz).fill_(self.word_dict.get_idx('<pad>'))))
+            lang_hs = init_lang_h.unsqueeze(0)
+
+        # the last state of each row; rows that generated nothing keep their state
+        num_states = lengths if resume else lengths + 1
+        last = self.to_device((num_states - 1).clamp(min=0))
+        last = Variable(last.view(1, bsz, 1).expand(1, bsz, lang_hs.size(2)))
+        lang_h = lang_hs.gather(0, last).squeeze(0)
+        if resume:
+            empty = Variable(self.to_device((lengths == 0).float().unsqueeze(1).expand_as(lang_h)))
+            lang_h = lang_h * (1 - empty) + init_lang_h * empty
+        return outs, lang_hs, lengths, lang_h
+
     def write_batch(self, bsz, lang_h, ctx_h, temperature, max_words=100):
         """Generate sentenses for a batch simultaneously."""
         eod = self.word_dict.get_idx('<selection>')
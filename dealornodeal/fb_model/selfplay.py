@@ -8,9 +8,11 @@ Selfplaying util.
 """
 
 import argparse
+import os
 import pdb
 import re
 import random
+from multiprocessing import Pool, Value
 
 import numpy as np
 import torch
@@ -38,14 +40,100 @@ class SelfPlay(object):
         # goes through the list of contexes and kicks off a dialogue
         for ctxs in self.ctx_gen.iter():
             n += 1
-            self.logger.dump('=' * 80)
-            self.dialog.run(ctxs, self.logger)
-            self.logger.dump('=' * 80)
-            self.logger.dump('')
+            run_dialog(self.dialog, ctxs, self.logger)
             if n % 100 == 0:
                 self.logger.dump('%d: %s' % (n, self.dialog.show_metrics()), forced=True)
 
 
+def run_dialog(dialog, ctxs, logger):
+    logger.dump('=' * 80)
+    dialog.run(ctxs, logger)
+    logger.dump('=' * 80)
+    logger.dump('')
+
+
+# Per-process state of the parallel selfplay workers, set by init_worker.
+worker_args = None
+worker_dialog = None
+worker_logger = None
+
+
+def worker_log_file(log_file, worker_id):
+    return '%s.worker%d' % (log_file, worker_id)
+
+
+def init_worker(args, worker_counter):
+    """Loads the models once per worker process."""
+    global worker_args, worker_dialog, worker_logger
+    with worker_counter.get_lock():
+        worker_id = worker_counter.value
+        worker_counter.value += 1
+    # one thread per process, parallelism comes from the processes
+    torch.set_num_threads(1)
+    worker_args = args
+    worker_dialog = load_dialog(args)
+    log_file = worker_log_file(args.log_file, worker_id) if args.log_file else ''
+    worker_logger = DialogLogger(verbose=args.verbose, log_file=log_file)
+
+
+def run_shard(shard):
+    """Runs the dialogues of one shard and returns their metrics. The seed
+    depends only on the shard id, not on the worker running it.
+    """
+    shard_id, shard_ctxs = shard
+    utils.set_seed(worker_args.seed + shard_id)
+    worker_dialog.reset_metrics()
+    for ctxs in shard_ctxs:
+        run_dialog(worker_dialog, ctxs, worker_logger)
+    return len(shard_ctxs), worker_dialog.metrics
+
+
+class ParallelSelfPlay(object):
+    """Selfplay runner that shards the contexes across a pool of processes.
+
+    Each worker loads the models once and logs to its own file
+    (<log_file>.worker<i>); the metrics of the shards are merged and the
+    worker logs are concatenated into log_file at the end.
+    """
+    def __init__(self, ctx_gen, args, num_workers, shard_size=20, logger=None):
+        self.ctx_gen = ctx_gen
+        self.args = args
+        self.num_workers = num_workers
+        self.shard_size = shard_size
+        self.logger = logger if logger else DialogLogger()
+
+    def get_shards(self):
+        ctxs = list(self.ctx_gen.iter())
+        return [(shard_id, ctxs[start:start + self.shard_size])
+                for shard_id, start in enumerate(range(0, len(ctxs), self.shard_size))]
+
+    def run(self):
+        pool = Pool(self.num_workers, initializer=init_worker, initargs=(self.args, Value('i', 0)))
+        metrics = None
+        n = 0
+        for num_dialogs, shard_metrics in pool.imap_unordered(run_shard, self.get_shards()):
+            metrics = shard_metrics if metrics is None else metrics.merge(shard_metrics)
+            n += num_dialogs
+            self.logger.dump('%d: %s' % (n, metrics.show()), forced=True)
+        pool.close()
+        pool.join()
+
+        if self.args.log_file:
+            self.concat_logs()
+        return metrics
+
+    def concat_logs(self):
+        with open(self.args.log_file, 'w') as fout:
+            for worker_id in range(self.num_workers):
+                path = worker_log_file(self.args.log_file, worker_id)
+                if not os.path.exists(path):
+                    continue
+                with open(path) as fin:
+                    for line in fin:
+                        fout.write(line)
+                os.remove(path)
+
+
 def get_agent_type(model, smart=False, fast=False):
     if isinstance(model, DialogModel):
         if smart:
@@ -56,6 +144,18 @@ def get_agent_type(model, smart=False, fast=False):
         assert False, 'unknown model type: %s' % (model)
 
 
+def load_dialog(args):
+    alice_model = utils.load_model(args.alice_model_file)
+    alice_ty = get_agent_type(alice_model, args.smart_alice, args.fast_rollout)
+    alice = alice_ty(alice_model, args, name='Alice')
+
+    bob_model = utils.load_model(args.bob_model_file)
+    bob_ty = get_agent_type(bob_model, args.smart_bob, args.fast_rollout)
+    bob = bob_ty(bob_model, args, name='Bob')
+
+    return Dialog([alice, bob], args)
+
+
 def main():
     parser = argparse.ArgumentParser(description='selfplaying script')
     parser.add_argument('--alice_model_file', type=str,
@@ -90,21 +190,23 @@ def main():
         help='file with the reference text')
     parser.add_argument('--domain', type=str, default='object_division',
         help='domain for the dialogue')
+    parser.add_argument('--num_workers', type=int, default=1,
+        help='number of selfplay processes; each loads its own models')
+    parser.add_argument('--shard_size', type=int, default=20,
+        help='number of dialogues run by a worker per task')
     args = parser.parse_args()
 
     utils.set_seed(args.seed)
 
-    alice_model = utils.load_model(args.alice_model_file)
-    alice_ty = get_agent_type(alice_model, args.smart_alice, args.fast_rollout)
-    alice = alice_ty(alice_model, args, name='Alice')
+    ctx_gen = ContextGenerator(args.context_file)
 
-    bob_model = utils.load_model(args.bob_model_file)
-    bob_ty = get_agent_type(bob_model, args.smart_bob, args.fast_rollout)
-    bob = bob_ty(bob_model, args, name='Bob')
+    if args.num_workers > 1:
+        selfplay = ParallelSelfPlay(ctx_gen, args, args.num_workers, args.shard_size)
+        selfplay.run()
+        return
 
-    dialog = Dialog([alice, bob], args)
+    dialog = load_dialog(args)
     logger = DialogLogger(verbose=args.verbose, log_file=args.log_file)
-    ctx_gen = ContextGenerator(args.context_file)
 
     selfplay = SelfPlay(dialog, ctx_gen, args, logger)
     selfplay.run()
@@ -1,7 +1,7 @@
 import argparse
 import copy
 
-from cocoa.core.dataset import read_examples
+from cocoa.core.dataset import iter_examples
 from cocoa.model.manager import Manager
 from cocoa.io.utils import write_json
 
@@ -53,12 +53,15 @@ if __name__ == '__main__':
     parser.add_argument('--model-output', help='Path to save the dialogue manager model')
     args = parser.parse_args()
 
-    examples = read_examples(args.transcripts, args.max_examples, Scenario)
+    # Only keep examples in memory if we need to write them out
+    examples = []
     parsed_dialogues = []
     templates = Templates()
 
     lexicon = Lexicon(['ball', 'hat', 'book'])
-    for example in examples:
+    for example in iter_examples(args.transcripts, args.max_examples, Scenario):
+        if args.transcripts_output:
+            examples.append(example)
         utterances = parse_example(example, lexicon, templates)
         parsed_dialogues.append(utterances)
 
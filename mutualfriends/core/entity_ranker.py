@@ -26,6 +26,11 @@ class EntityRanker(object):
         :return:
         """
         self._get_uuid_to_kbs(scenarios)
+        # Memoized KB entity sets, span/entity tokens and KB-independent pair features
+        self.kb_entities_cache = {}
+        self.tokens_cache = {}
+        self.pair_features_cache = {}
+        self.max_cache_size = 100000
         # Rudimentary python stop word list
         self.stop_words = set(get_stop_words("en"))
         self._train_tfidf_vectorizer(transcripts_infile)
@@ -86,30 +91,44 @@ class EntityRanker(object):
         self.uuid_to_kbs = uuid_to_kbs
 
 
-    def _feature_func(self, span, entity, agent, uuid):
+    def _get_kb_entities(self, uuid, agent):
         """
-        Get a series of features between a span of text and a candidate entity
-        :param span:
-        :param entity:
-        :param agent: Id of agent so we know which set of entities to use from scenario
-        :param uuid: uuid of scenario to with available KBs
-        :return:
+        Set of entity surface forms in the KB of `agent` in scenario `uuid` (None if not found)
         """
-        entity_clean = re.sub("-", " ", entity)
-        entity_clean_tokens = entity_clean.split()
-        span_tokens = span.split()
-
-        try:
-            # Set of entities for given agent
-            kb_entities = self.uuid_to_kbs[uuid][agent]
-            # Only consider entity surface form and not type
-            kb_entities = set([e[1] for e in kb_entities])
-        except:
-            kb_entities = None
-            print "No entities found for scenario: {0} and agent: {1}".format(uuid, str(agent))
+        key = (uuid, agent)
+        if key not in self.kb_entities_cache:
+            try:
+                # Only consider entity surface form and not type
+                kb_entities = set([e[1] for e in self.uuid_to_kbs[uuid][agent]])
+            except:
+                kb_entities = None
+                print "No entities found for scenario: {0} and agent: {1}".format(uuid, str(agent))
+            self.kb_entities_cache[key] = kb_entities
+        return self.kb_entities_cache[key]
+
+    def _get_tokens(self, s):
+        tokens = self.tokens_cache.get(s)
+        if tokens is None:
+            if len(self.tokens_cache) >= self.max_cache_size:
+                self.tokens_cache.clear()
+            tokens = self.tokens_cache[s] = (s.split(), set(s.replace("-", " ").split()))
+        return tokens
+
+    def _pair_features(self, span, entity):
+        """
+        Features that do not depend on the KB
+        """
+        key = (span, entity)
+        features = self.pair_features_cache.get(key)
+        if features is not None:
+            return features
+        if len(self.pair_features_cache) >= self.max_cache_size:
+            self.pair_features_cache.clear()
 
+        span_tokens = self._get_tokens(span)[0]
+        entity_clean_tokens = self._get_tokens(entity)[1]
 
-        features = collections.defaultdict(float)
+        features = {}
         if span == entity:
             features["EXACT_MATCH"] = 1.0
 
@@ -124,12 +143,8 @@ class EntityRanker(object):
         elif ed > 2:
             features["EDIT_DISTANCE>2"] = 1.0
 
-        all_in = True
-        for s in span_tokens:
-            if s not in entity_clean_tokens:
-                all_in = False
         # All tokens of span our a token of the entity
-        if all_in:
+        if all(s in entity_clean_tokens for s in span_tokens):
             features["SUBSET_TOKENS"] = 1.0
 
         # Edit distance of largest common substring (scaled)
@@ -142,15 +157,8 @@ class EntityRanker(object):
             features["PARTIAL_RATIO_<50"] = 1.0
 
         # TF-IDF scores
-        span_tfidf = self.token_to_tfidf[span]
-        entity_tfidf = self.token_to_tfidf[entity]
         # TODO: Good way to incorporate TF-IDF scores?
-        #features["TFIDF_DIFF"] = -1*entity_tfidf + span_tfidf
-
-
-        # KB context - upweight if entity is in current agent's KB
-        if kb_entities is not None and entity in kb_entities:
-            features["IN_KB"] = 1.0
+        #features["TFIDF_DIFF"] = -1*self.token_to_tfidf[entity] + self.token_to_tfidf[span]
 
         # TODO: Use type features?
 
@@ -158,6 +166,24 @@ class EntityRanker(object):
         if span in self.stop_words and entity in self.stop_words:
             features["SPAN_AND_ENTITY_STOP"] = 1.0
 
+        self.pair_features_cache[key] = features
+        return features
+
+    def _feature_func(self, span, entity, agent, uuid):
+        """
+        Get a series of features between a span of text and a candidate entity
+        :param span:
+        :param entity:
+        :param agent: Id of agent so we know which set of entities to use from scenario
+        :param uuid: uuid of scenario to with available KBs
+        :return:
+        """
+        features = collections.defaultdict(float, self._pair_features(span, entity))
+
+        # KB context - upweight if entity is in current agent's KB
+        kb_entities = self._get_kb_entities(uuid, agent)
+        if kb_entities is not None and entity in kb_entities:
+            features["IN_KB"] = 1.0
 
         return features
 
@@ -236,10 +262,15 @@ class EntityRanker(object):
         :param uuid:
         :return:
         """
-        features = self._feature_func(span, entity, agent, uuid)
-        features_transformed = self.vectorizer.transform(features)
+        return self.score_batch(span, [entity], agent, uuid)
 
-        #print "Score: ", self.classifier.predict(features_transformed)
+    def score_batch(self, span, entities, agent, uuid):
+        """
+        Score a span against a list of entities with a single classifier call
+        :return: array of shape (len(entities), 2), as predict_proba
+        """
+        features = [self._feature_func(span, entity, agent, uuid) for entity in entities]
+        features_transformed = self.vectorizer.transform(features)
         return self.classifier.predict_proba(features_transformed)
 
 
@@ -10,6 +10,7 @@ from fuzzywuzzy import fuzz
 from cocoa.core.util import read_pickle, write_pickle
 from cocoa.core.entity import Entity, is_entity
 from lexicon_utils import get_prefixes, get_acronyms, get_edits, get_morphological_variants
+from lexicon_index import LexiconIndex
 
 def add_lexicon_arguments(parser):
     parser.add_argument('--stop-words', type=str, default='data/common_words.txt', help='Path to stop words list')
@@ -42,6 +43,7 @@ class BaseLexicon(object):
         else:
             print 'Load lexicon from {}'.format(lexicon_path)
             self.lexicon = read_pickle(lexicon_path)
+        self.index = LexiconIndex(self.lexicon)
 
 
     def load_entities(self):
@@ -178,38 +180,21 @@ class Lexicon(BaseLexicon):
         # Use heuristic scoring system
         #print 'span:', span
         if not self.learned_lex:
+            span_tokens = span.split()
+            # Whether the span is made of stop words (unless it matches the entity exactly)
+            span_is_stopwords = (len(span_tokens) == 1 and span in self.stop_words) or \
+                    span_tokens[0] in ('and', 'or', 'to', 'from', 'of', 'in', 'at') or \
+                    all(x in self.stop_words for x in span_tokens)
             entity_scores = []
             for c in candidates:
                 #print 'c:', c
-                # Clean up punctuation
-                c_s = re.sub("-", " ", c[0])
-                span_tokens = span.split()
-                entity_tokens = c_s.split()
-
-                ed = editdistance.eval(span, c[0])
                 # Filter false positives
                 if c[1] not in kb_entity_types:
                     continue
-
-                def is_stopwords():
-                    if span == c[0]:
-                        return False
-                    if len(span_tokens) == 1 and span in self.stop_words:
-                        return True
-                    if span_tokens[0] in ('and', 'or', 'to', 'from', 'of', 'in', 'at'):
-                        return True
-                    all_stop = True
-                    for x in span_tokens:
-                        if x not in self.stop_words:
-                            all_stop = False
-                            break
-                    if all_stop:
-                        return True
-                    return False
-
-                if is_stopwords():
+                if span_is_stopwords and span != c[0]:
                     continue
-                if len(span_tokens) > len(entity_tokens):
+                c_s, entity_tokens, num_entity_tokens = self.index.get_entity_info(c[0])
+                if len(span_tokens) > num_entity_tokens:
                     continue
                 if c[0] not in kb_entities and known_kb:
                     # Prioritize exact match
@@ -223,7 +208,7 @@ class Lexicon(BaseLexicon):
                 elif len(span_tokens) > 1 and span in c_s:
                     score = 1
                 else:
-                    score = ed + 2
+                    score = self.index.edit_distance(span, c[0]) + 2
                 # Prioritize entity in KB even if we are not sure
                 if not known_kb and c[0] not in kb_entities and c[0] != span:
                     score += 3
@@ -254,14 +239,13 @@ class Lexicon(BaseLexicon):
             #else:
             #    best_match = (span, None)
         else:
-            # Use learned ranker
-            entity_scores = []
-            for c in candidates:
-                score = self.entity_ranker.score(span, c[0], agent, uuid).squeeze()
-                entity_scores.append(c + (score[0] - score[1],))
+            # Use learned ranker; score all candidates and the span itself in one batch
+            candidates = list(candidates)
+            scores = self.entity_ranker.score_batch(span, [c[0] for c in candidates] + [span], agent, uuid)
+            entity_scores = [c + (score[0] - score[1],) for c, score in zip(candidates, scores[:-1])]
 
             # Where does original span fit into all this? If smaller than some threshold
-            span_score = self.entity_ranker.score(span, span, agent, uuid).squeeze()
+            span_score = scores[-1]
 
             # Sort entity scores
             entity_scores = sorted(entity_scores, key=lambda x: x[2])
@@ -321,49 +305,30 @@ class Lexicon(BaseLexicon):
         i = 0
         found_entities = []
         linked = []
-        stop_words = set(['of'])
         while i < len(raw_tokens):
-            candidate_entities = None
-            single_char = False
+            matched = False
             # Find longest phrase (if any) that matches an entity
-            for l in range(6, 0, -1):
+            for l, candidate_entities in self.index.span_candidates(raw_tokens, i):
                 phrase = ' '.join(raw_tokens[i:i+l])
-                raw = raw_tokens[i:i+l]
-
-                for idx, token in enumerate(raw):
-                    results = self.lookup(token)
-                    if idx == 0: candidate_entities = results
-                    if token not in stop_words:
-                        candidate_entities = list(set(candidate_entities).intersection(set(results)))
-
                 # Single character token so disregard candidate entities
                 if l == 1 and len(phrase) == 1:
-                    single_char = True
                     break
 
-                # Found some match
-                if len(candidate_entities) > 0:
-                    if kb_entities is not None:
-                        best_match = self.score_and_match(phrase, candidate_entities, agent, uuid, kb_entities, kb_entity_types, known_kb)
-                    else:
-                        # TODO: Fix default system, if no kb_entities provided -- only returns random candidate now
-                        best_match = random.sample(candidate_entities, 1)[0]
-                    # If best_match is entity from KB add to list
-                    if best_match[1] is not None:
-                        # Return as (surface form, (canonical, type))
-                        linked.append((phrase, best_match))
-                        found_entities.append((phrase, best_match))
-                        i += l
-                        break
-                    else:
-                        candidate_entities = None
-                        continue
-                    # else:
-                    #     i += l
-                    #     entities.append(candidate_entities)
-                    #     break
+                if kb_entities is not None:
+                    best_match = self.score_and_match(phrase, candidate_entities, agent, uuid, kb_entities, kb_entity_types, known_kb)
+                else:
+                    # TODO: Fix default system, if no kb_entities provided -- only returns random candidate now
+                    best_match = random.sample(candidate_entities, 1)[0]
+                # If best_match is entity from KB add to list
+                if best_match[1] is not None:
+                    # Return as (surface form, (canonical, type))
+                    linked.append((phrase, best_match))
+                    found_entities.append((phrase, best_match))
+                    i += l
+                    matched = True
+                    break
 
-            if not candidate_entities or single_char:
+            if not matched:
                 linked.append(raw_tokens[i])
                 i += 1
 
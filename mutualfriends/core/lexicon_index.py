@@ -0,0 +1,94 @@
+import editdistance
+
+
+class SpanTrie(object):
+    """
+    Trie over token sequences. The node of a span stores its candidate
+    entities: the intersection of the lexicon entries of its tokens (tokens in
+    `skip_tokens` other than the first are not intersected). Since adding a
+    token can only shrink the candidate set, only spans with candidates are
+    stored and the walk stops at the first empty one.
+    """
+    def __init__(self, lookup, skip_tokens=('of',)):
+        self.lookup = lookup
+        self.skip_tokens = set(skip_tokens)
+        self.root = {}
+
+    def walk(self, tokens, max_length):
+        """
+        Return a list of candidate sets (non-empty) of the spans tokens[:1], tokens[:2], ...
+        """
+        spans = []
+        children = self.root
+        candidates = None
+        for l, token in enumerate(tokens[:max_length]):
+            node = children.get(token)
+            if node is None:
+                results = self.lookup(token)
+                if l == 0:
+                    candidates = results
+                elif token not in self.skip_tokens:
+                    candidates = candidates & results
+                if not candidates:
+                    break
+                node = (candidates, {})
+                children[token] = node
+            candidates, children = node
+            spans.append(candidates)
+        return spans
+
+
+class LexiconIndex(object):
+    """
+    Compiled view of a lexicon (phrase -> list of (entity, type)) used by
+    `Lexicon.link_entity`.
+        - entries are frozensets, so candidate intersection is done on sets;
+        - a `SpanTrie` caches candidates of token spans across utterances;
+        - entity surface forms are tokenized once;
+        - edit distances between spans and entities are memoized.
+    """
+    def __init__(self, lexicon, max_cache_size=1000000):
+        self.entries = {phrase: frozenset(entities) for phrase, entities in lexicon.iteritems()}
+        self.empty = frozenset()
+        self.trie = SpanTrie(self.lookup)
+        self.entity_info = {}
+        for entities in self.entries.itervalues():
+            for entity, type_ in entities:
+                if entity not in self.entity_info:
+                    # Clean up punctuation
+                    entity_s = entity.replace('-', ' ')
+                    entity_tokens = entity_s.split()
+                    self.entity_info[entity] = (entity_s, frozenset(entity_tokens), len(entity_tokens))
+        self.max_cache_size = max_cache_size
+        self.edit_distances = {}
+
+    def lookup(self, phrase):
+        return self.entries.get(phrase, self.empty)
+
+    def span_candidates(self, tokens, start, max_length=6):
+        """
+        Return [(length, candidates)] of spans starting at `start` that have
+        candidate entities, longest first.
+        """
+        spans = self.trie.walk(tokens[start:start+max_length], max_length)
+        return [(l + 1, candidates) for l, candidates in reversed(list(enumerate(spans)))]
+
+    def get_entity_info(self, entity):
+        """
+        Return (surface form with '-' replaced, set of tokens, number of tokens).
+        """
+        info = self.entity_info.get(entity)
+        if info is None:
+            entity_s = entity.replace('-', ' ')
+            entity_tokens = entity_s.split()
+            info = self.entity_info[entity] = (entity_s, frozenset(entity_tokens), len(entity_tokens))
+        return info
+
+    def edit_distance(self, span, entity):
+        key = (span, entity)
+        ed = self.edit_distances.get(key)
+        if ed is None:
+            if len(self.edit_distances) >= self.max_cache_size:
+                self.edit_distances.clear()
+            ed = self.edit_distances[key] = editdistance.eval(span, entity)
+        return ed
@@ -1,7 +1,7 @@
 import argparse
 import copy
 
-from cocoa.core.dataset import read_examples
+from cocoa.core.dataset import iter_examples
 from cocoa.model.manager import Manager
 from cocoa.core.schema import Schema
 from cocoa.analysis.utils import sample_intents, intent_breakdown
@@ -56,7 +56,7 @@ if __name__ == '__main__':
 
     schema = Schema(args.schema_path)
     lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words, lexicon_path=args.lexicon)
-    examples = read_examples(args.transcripts, args.max_examples, Scenario)
+    examples = iter_examples(args.transcripts, args.max_examples, Scenario)
     parsed_dialogues = []
     templates = Templates()
 
@@ -34,18 +34,14 @@ class DatabaseManager(BaseDatabaseManager):
     def add_scenarios(self, scenario_db, systems, update=False):
         """Add used scenarios to DB so that we don't collect data on duplicated scenarios.
         """
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-        for scenario in scenario_db.scenarios_list:
-            sid = scenario.uuid
-            for agent_type in systems.keys():
-                if update:
-                    c.execute('''INSERT OR IGNORE INTO scenario VALUES (?,?, "[]", "[]")''', (sid, agent_type))
-                else:
-                    c.execute('''INSERT INTO scenario VALUES (?,?, "[]", "[]")''', (sid, agent_type))
-
-        conn.commit()
-        conn.close()
+        conn = self.pool.get()
+        rows = [(scenario.uuid, agent_type) for scenario in scenario_db.scenarios_list for agent_type in systems.keys()]
+        with conn:
+            if update:
+                conn.executemany('''INSERT OR IGNORE INTO scenario VALUES (?,?, "[]", "[]")''', rows)
+            else:
+                conn.executemany('''INSERT INTO scenario VALUES (?,?, "[]", "[]")''', rows)
+        self.pool.put(conn)
 
 class Backend(BaseBackend):
     def display_received_event(self, event):
@@ -114,19 +110,8 @@ class Backend(BaseBackend):
             self._update_user(cursor, userid, status=Status.Finished)
 
         def _update_scenario_db(chat_id, scenario_id, partner_type):
-            # make sure that the # of completed dialogues for the scenario is only updated once if both agents are human
-            cursor.execute('''SELECT complete FROM scenario WHERE scenario_id=? AND partner_type=?''',
-                           (scenario_id, partner_type))
-            complete_set = set(json.loads(cursor.fetchone()[0]))
-            complete_set.add(chat_id)
-            cursor.execute('''
-                UPDATE scenario
-                SET complete=?
-                WHERE scenario_id=? AND partner_type=?
-                AND (SELECT COUNT(survey.name)
-                    FROM survey
-                    WHERE survey.chat_id=?) = 0;
-            ''', (json.dumps(list(complete_set)), scenario_id, partner_type, chat_id))
+            # the complete set is only updated once if both agents are human
+            self.conn.on_commit(self.scenario_index.add_complete_chat, scenario_id, partner_type, chat_id)
 
         try:
             with self.conn:
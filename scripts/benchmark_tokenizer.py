@@ -0,0 +1,68 @@
+'''
+Startup and throughput benchmark of cocoa.core.tokenizer.
+
+"before" replays what the module used to do at import time (import nltk and
+build a MosesDetokenizer; the nltk.download network call is not included),
+"after" imports the lazy module.
+'''
+
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+BEFORE = 'import nltk; from nltk.tokenize import word_tokenize; ' \
+         'from nltk.tokenize.moses import MosesDetokenizer; MosesDetokenizer()'
+AFTER = 'import cocoa.core.tokenizer'
+
+UTTERANCES = [
+        "Hi, is this still available?",
+        "Yes it is. Are you interested?",
+        "I can't go higher than $1,000... would you take that?",
+        "That's too low. How about 1200?",
+        "Deal! When can I pick it up?",
+        "It's in great condition (barely used).",
+        ]
+
+def import_time(stmt, repeat):
+    code = 'import time; t = time.time(); {}; print(time.time() - t)'.format(stmt)
+    times = []
+    for _ in xrange(repeat):
+        try:
+            output = subprocess.check_output([sys.executable, '-c', code], stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            return None, e.output.strip().split('\n')[-1]
+        times.append(float(output.strip().split('\n')[-1]))
+    return min(times), None
+
+def throughput(tokenize, utterances):
+    start_time = time.time()
+    for utterance in utterances:
+        tokenize(utterance)
+    return len(utterances) / (time.time() - start_time)
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each import (min is reported)')
+    parser.add_argument('--num-utterances', type=int, default=100000)
+    parser.add_argument('--backend', default='auto', choices=['auto', 'nltk', 'regex'])
+    args = parser.parse_args()
+
+    for name, stmt in (('before', BEFORE), ('after', AFTER)):
+        t, error = import_time(stmt, args.repeat)
+        if t is None:
+            print '{:<8} import failed: {}'.format(name, error)
+        else:
+            print '{:<8} import time: {:.3f}s'.format(name, t)
+
+    from cocoa.core import tokenizer
+    tokenizer.configure(backend=args.backend)
+    start_time = time.time()
+    tokenizer.tokenize(UTTERANCES[0])
+    print 'first tokenize() (loads backend): {:.3f}s'.format(time.time() - start_time)
+
+    # Unique utterances miss the cache; repeated ones hit it
+    unique = ['{} {}'.format(UTTERANCES[i % len(UTTERANCES)], i) for i in xrange(args.num_utterances)]
+    repeated = [UTTERANCES[i % len(UTTERANCES)] for i in xrange(args.num_utterances)]
+    print 'tokenize, uncached: {:.0f} utterances/s'.format(throughput(tokenizer.tokenize, unique))
+    print 'tokenize, cached:   {:.0f} utterances/s'.format(throughput(tokenizer.tokenize, repeated))
@@ -5,9 +5,11 @@ Takes two agent implementations and generates the dialogues.
 import argparse
 import random
 import json
+import time
 import numpy as np
+from multiprocessing import Pool
 
-from cocoa.core.util import read_json
+from cocoa.core.util import read_json, is_jsonl
 from cocoa.core.schema import Schema
 from cocoa.core.scenario_db import ScenarioDB
 import cocoa.options
@@ -17,29 +19,117 @@ from core.controller import Controller
 from systems import get_system
 import options
 
-def generate_examples(num_examples, scenario_db, examples_path, max_examples, remove_fail, max_turns):
+def set_random_seed(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        import torch
+        torch.manual_seed(seed)
+    except ImportError:
+        pass
+
+def load_agents(args, schema):
+    assert len(args.agent_checkpoints) == len(args.agents)
+    return [get_system(name, args, schema, model_path=model_path)
+            for name, model_path in zip(args.agents, args.agent_checkpoints)]
+
+def generate_examples(agents, scenarios, num_examples, max_examples, remove_fail, max_turns, verbose=False):
+    '''
+    Simulate |max_examples| dialogues; the i-th successful dialogue is grounded
+    in scenario |num_examples| + i.
+    Return the examples and the number of failed dialogues.
+    '''
     examples = []
     num_failed = 0
-    scenarios = scenario_db.scenarios_list
-    #scenarios = [scenario_db.scenarios_map['S_8COuPdjZZkYgrzhb']]
-    #random.shuffle(scenarios)
     for i in range(max_examples):
         scenario = scenarios[num_examples % len(scenarios)]
         sessions = [agents[0].new_session(0, scenario.kbs[0]), agents[1].new_session(1, scenario.kbs[1])]
         controller = Controller(scenario, sessions)
-        ex = controller.simulate(max_turns, verbose=args.verbose)
+        ex = controller.simulate(max_turns, verbose=verbose)
         if not controller.complete():
             num_failed += 1
             if remove_fail:
                 continue
         examples.append(ex)
         num_examples += 1
+    return examples, num_failed
+
+def get_shards(num_examples, max_examples, shard_size):
+    '''
+    Split |max_examples| dialogues into shards of (shard_id, scenario offset, size).
+
+    NOTE: shard offsets assume every dialogue succeeds. With --remove-fail,
+    the scenarios used differ from a single serial loop: a serial loop only
+    moves to the next scenario after a success, while each shard starts at
+    its fixed offset. Each shard still draws exactly |size| dialogues, so
+    fewer than |max_examples| examples are written if some fail.
+    '''
+    shards = []
+    for shard_id, start in enumerate(range(0, max_examples, shard_size)):
+        shards.append((shard_id, num_examples + start, min(shard_size, max_examples - start)))
+    return shards
+
+# Per-process state of the self-play workers, set by init_worker.
+worker_args = None
+worker_agents = None
+worker_scenarios = None
+worker_seed = None
+
+def init_worker(args, schema, scenarios, seed):
+    '''
+    Load the agents once per worker process.
+    '''
+    global worker_args, worker_agents, worker_scenarios, worker_seed
+    worker_args = args
+    worker_scenarios = scenarios
+    worker_seed = seed
+    worker_agents = load_agents(args, schema)
+
+def generate_shard(shard):
+    '''
+    Simulate one shard. The seed depends only on the base seed and the shard
+    id so that results do not depend on how shards are scheduled across
+    workers (forked workers would otherwise share their random state).
+    '''
+    shard_id, num_examples, max_examples = shard
+    set_random_seed(worker_seed + shard_id)
+    examples, num_failed = generate_examples(worker_agents, worker_scenarios, num_examples, max_examples,
+            worker_args.remove_fail, worker_args.max_turns, verbose=worker_args.verbose)
+    return [e.to_dict() for e in examples], num_failed
+
+def write_examples(results, examples_path, remove_fail=False):
+    '''
+    Write examples from an iterator of (examples, num_failed) without holding
+    all of them in memory: one example per line for JSON lines files (.jsonl),
+    otherwise a single JSON list.
+    Failed dialogues count as generated dialogues in the progress report if
+    |remove_fail| (they are not in the examples).
+    Return the number of examples written and failed.
+    '''
+    jsonl = is_jsonl(examples_path)
+    num_examples = 0
+    num_failed = 0
+    start_time = time.time()
     with open(examples_path, 'w') as out:
-        print >>out, json.dumps([e.to_dict() for e in examples])
-    if num_failed == 0:
-        print 'All {} dialogues succeeded!'.format(num_examples)
-    else:
-        print 'Number of failed dialogues:', num_failed
+        if not jsonl:
+            out.write('[')
+        for examples, failed in results:
+            for ex in examples:
+                if jsonl:
+                    print >>out, json.dumps(ex)
+                else:
+                    if num_examples > 0:
+                        out.write(', ')
+                    out.write(json.dumps(ex))
+                num_examples += 1
+            num_failed += failed
+            num_dialogues = num_examples + (num_failed if remove_fail else 0)
+            elapsed = time.time() - start_time
+            print '[generate] {} dialogues in {:.1f}s ({:.2f} dialogues/sec)'.format(
+                    num_dialogues, elapsed, num_dialogues / max(elapsed, 1e-6))
+        if not jsonl:
+            print >>out, ']'
+    return num_examples, num_failed
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(conflict_handler='resolve')
@@ -47,27 +137,44 @@ if __name__ == '__main__':
     parser.add_argument('--agents', default=['rulebased', 'rulebased'], help='What kind of agent to use', nargs='*')
     parser.add_argument('--agent-checkpoints', nargs='+', default=['', ''], help='Directory to learned models')
     parser.add_argument('--scenario-offset', default=0, type=int, help='Number of scenarios to skip at the beginning')
-    parser.add_argument('--remove-fail', default=False, action='store_true', help='Remove failed dialogues')
+    parser.add_argument('--remove-fail', default=False, action='store_true', help='Remove failed dialogues (see get_shards for how this interacts with sharding)')
     parser.add_argument('--max-turns', default=100, type=int, help='Maximum number of turns')
     parser.add_argument('--results-path', default=None,
-            help='json path to store the results of the chat examples')
+            help='json path to store the results of the chat examples (.jsonl to write one example per line)')
     parser.add_argument('--max-examples', default=20, type=int,
             help='Number of test examples to predict')
+    parser.add_argument('--num-workers', default=1, type=int,
+            help='Number of self-play processes; each loads its own agents')
+    parser.add_argument('--shard-size', default=100, type=int,
+            help='Number of dialogues simulated by a worker per task')
     parser.add_argument('-v', '--verbose', default=False, action='store_true', help='whether or not to have verbose prints')
     cocoa.options.add_scenario_arguments(parser)
     cocoa.options.add_dataset_arguments(parser)
     options.add_system_arguments(parser)
     args = parser.parse_args()
     if args.random_seed:
-        random.seed(args.random_seed)
-        np.random.seed(args.random_seed)
+        set_random_seed(args.random_seed)
+    # Shards are always seeded; without --random-seed, from a fresh base seed
+    seed = args.random_seed or random.SystemRandom().randrange(1, 2**31)
 
     schema = Schema(args.schema_path)
     scenario_db = ScenarioDB.from_dict(schema, read_json(args.scenarios_path), Scenario)
+    scenarios = scenario_db.scenarios_list
 
-    assert len(args.agent_checkpoints) == len(args.agents)
-    agents = [get_system(name, args, schema, model_path=model_path)
-            for name, model_path in zip(args.agents, args.agent_checkpoints)]
-    num_examples = args.scenario_offset
+    shards = get_shards(args.scenario_offset, args.max_examples, args.shard_size)
+    if args.num_workers > 1:
+        pool = Pool(args.num_workers, initializer=init_worker, initargs=(args, schema, scenarios, seed))
+        results = pool.imap(generate_shard, shards)
+    else:
+        init_worker(args, schema, scenarios, seed)
+        results = (generate_shard(shard) for shard in shards)
+
+    num_examples, num_failed = write_examples(results, args.results_path, args.remove_fail)
+    if args.num_workers > 1:
+        pool.close()
+        pool.join()
 
-    generate_examples(num_examples, scenario_db, args.results_path, args.max_examples, args.remove_fail, args.max_turns)
+    if num_failed == 0:
+        print 'All {} dialogues succeeded!'.format(num_examples)
+    else:
+        print 'Number of failed dialogues:', num_failed
@@ -0,0 +1,140 @@
+'''
+Load test of the web backend database: simulates concurrent users polling
+/_check_inbox/ and /_check_status_change/ through `Backend` and reports
+requests/sec for the legacy setup (one connection per request, rollback
+journal, no indexes) and the pooled WAL storage layer.
+'''
+
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import logging
+from argparse import ArgumentParser
+
+from cocoa.core.event import Event
+from cocoa.web.main.backend import Backend, DatabaseManager
+from cocoa.web.main.storage import Connection, ConnectionPool
+from cocoa.web.main.allocation import ScenarioAllocationIndex
+from cocoa.web.main.utils import Status
+
+class LegacyConnectionPool(ConnectionPool):
+    """Open a new connection with the default journal for every request.
+    """
+    def __init__(self, db_file):
+        super(LegacyConnectionPool, self).__init__(db_file, max_idle=0)
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=self.timeout, check_same_thread=False, factory=Connection)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+class LoadTestScenarioDB(object):
+    scenarios_list = []
+    scenarios_map = {}
+
+def get_params(db_file):
+    # No timeouts: users stay in the waiting state during the test
+    return {
+            'db': {'location': db_file},
+            'status_params': {status: {'num_seconds': -1} for status in
+                (Status.Waiting, Status.Chat, Status.Finished, Status.Survey, Status.Redirected,
+                 Status.Incomplete, Status.Reporting)},
+            'idle_timeout_num_seconds': -1,
+            'connection_timeout_num_seconds': -1,
+            }
+
+def get_backend(db_file):
+    # A new Backend per request, as created by Backend.get_backend
+    return Backend(get_params(db_file), None, LoadTestScenarioDB, {}, {}, {}, {})
+
+def init_db(db_file, num_users, num_chats, legacy):
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    ConnectionPool.close_pools()
+    ScenarioAllocationIndex.indexes = {}
+    DatabaseManager.init_database(db_file)
+    backend = get_backend(db_file)
+    for i in xrange(num_users):
+        backend.create_user_if_not_exists('U_{}'.format(i))
+    for i in xrange(num_chats):
+        chat_id = 'C_{}'.format(i)
+        backend.add_chat_to_db(chat_id, '', 'U_{}'.format(i), 'U_{}'.format(i + num_chats), 'human', 'human')
+        backend.add_events_to_db(chat_id, [Event.MessageEvent(j % 2, 'hello', str(time.time()), str(time.time()))
+            for j in xrange(20)])
+    backend.close()
+    # Release the connections held by the backend
+    ConnectionPool.close_pools()
+    if legacy:
+        conn = sqlite3.connect(db_file)
+        with conn:
+            for index in ('active_user_status', 'event_chat_id', 'chat_chat_id'):
+                conn.execute('DROP INDEX IF EXISTS {}'.format(index))
+        conn.execute('PRAGMA journal_mode=DELETE')
+        conn.close()
+        ConnectionPool.pools[db_file] = LegacyConnectionPool(db_file)
+
+def poll(db_file, userid, num_chats, insert_events):
+    '''
+    Backend calls of one polling request: status check, connection check and
+    update and (sometimes) logging new events.
+    '''
+    backend = get_backend(db_file)
+    try:
+        backend.get_updated_status(userid)
+        backend.is_connected(userid)
+        backend.connect(userid)
+        if insert_events:
+            chat_id = 'C_{}'.format(random.randint(0, num_chats - 1))
+            events = [Event.MessageEvent(0, 'hi', str(time.time()), str(time.time())) for _ in xrange(2)]
+            backend.add_events_to_db(chat_id, events)
+    finally:
+        backend.close()
+
+def run(db_file, legacy, args):
+    init_db(db_file, args.num_users, args.num_chats, legacy)
+    errors = []
+
+    def worker(num_requests):
+        for i in xrange(num_requests):
+            userid = 'U_{}'.format(random.randint(0, args.num_users - 1))
+            insert_events = random.random() < args.write_ratio
+            try:
+                poll(db_file, userid, args.num_chats, insert_events)
+            except sqlite3.OperationalError as e:
+                errors.append(e)
+
+    requests_per_thread = args.num_requests / args.num_threads
+    threads = [threading.Thread(target=worker, args=(requests_per_thread,)) for _ in xrange(args.num_threads)]
+    start_time = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start_time
+    ConnectionPool.close_pools()
+
+    num_requests = requests_per_thread * args.num_threads
+    name = 'legacy' if legacy else 'pooled'
+    print '{:<8} {} requests in {:.2f}s: {:.1f} requests/sec ({} lock errors)'.format(
+            name, num_requests, elapsed, num_requests / elapsed, len(errors))
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--db', help='Path to the test database (default: a temporary file)')
+    parser.add_argument('--num-users', type=int, default=300, help='Number of active users')
+    parser.add_argument('--num-chats', type=int, default=150, help='Number of chats with logged events')
+    parser.add_argument('--num-requests', type=int, default=20000, help='Total number of polling requests')
+    parser.add_argument('--num-threads', type=int, default=16, help='Number of concurrent clients')
+    parser.add_argument('--write-ratio', type=float, default=0.1, help='Fraction of requests that log events')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # Backend logs debug messages on every status check
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(args.seed)
+    db_file = args.db or os.path.join(tempfile.mkdtemp(), 'load_test.db')
+    for legacy in (True, False):
+        run(db_file, legacy, args)